@@ -2,19 +2,32 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from datetime import datetime
-import json
 import hashlib
-from PIL import Image
-import io
 import base64
 import plotly.graph_objects as go
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 import os
-import time
 from pathlib import Path
+from expense_store import (get_store, year_month, format_year_month,
+                           expense_filter, update_op, delete_op, ConflictError,
+                           list_users, user_rollups, SUMMARY_COLUMNS, BASE_CURRENCY, SHARED_FILES)
+from receipt_store import save_receipt, load_receipt, migrate_inline_receipts
+from ocr_queue import get_ocr_queue, backfill as backfill_receipts
+from thumbnails import thumbnail, clear_thumbnails, cache_size as thumbnail_cache_size, THUMB_CACHE_BYTES
+from snapshot_store import get_snapshots
+from report_engine import cancel_report, request_report
+from engine import (BUDGET_LIMITS as DEFAULT_BUDGET_LIMITS, financial_metrics, frame_metrics,
+                    validate_expense, budget_alert, category_spending, budget_comparison,
+                    spending_aggregates, spending_forecast, category_tree, budget_vs_actual)
+from budgets import ALL as ALL_SPENDING, budgets_version, limits_file, load_limits, save_limits
+from recurring import schedule_file, schedule_version
+from categories import category_file_version
+from currency import CURRENCY_SYMBOLS, convert_rollup, currencies, format_money
+from statement_import import import_statement, imported_ids_file
+from backup_store import write_backup, restore_backup, backup_dir, BackupError
+from profiling import start_trace, section, span, timed, export_traces, background_spans
 
 
+@timed()
 def get_base64_of_bin_file(png_file):
     with open(png_file, "rb") as f:
         data = f.read()
@@ -51,6 +64,18 @@ def set_png_as_page_bg(png_file):
 # Page configuration must be the first Streamlit command
 st.set_page_config(page_title="Financial Takeover", layout="wide")
 
+# Timing for this rerun; the last few finished reruns stay for the debug panel
+TRACE_HISTORY = 20
+if 'traces' not in st.session_state:
+    st.session_state.traces = []
+if st.session_state.get('trace') is not None:
+    finished = st.session_state.trace.finish()
+    st.session_state.traces = (st.session_state.traces + [finished])[-TRACE_HISTORY:]
+    if os.environ.get("EXPENSE_PROFILE_FILE"):
+        export_traces([finished])
+st.session_state.trace = start_trace(f"rerun at {datetime.now():%H:%M:%S}")
+section("session setup")
+
 if 'welcome_completed' not in st.session_state:
     st.session_state.welcome_completed = False
 
@@ -60,8 +85,8 @@ if 'disclaimer_accepted' not in st.session_state:
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
 
-if 'financial_history' not in st.session_state:
-    st.session_state.financial_history = []
+if 'username' not in st.session_state:
+    st.session_state.username = None
 
 if 'recent_activities' not in st.session_state:
     st.session_state.recent_activities = []
@@ -77,67 +102,59 @@ if 'recalled_data' not in st.session_state:
     st.session_state.recalled_data = None
 if 'current_data' not in st.session_state:
     st.session_state.current_data = None
+if 'staged_changes' not in st.session_state:
+    st.session_state.staged_changes = []
+if 'currency' not in st.session_state:
+    st.session_state.currency = BASE_CURRENCY
+
+def set_financial_metrics(metrics):
+    # total_balance, monthly_spend, budget_used and recent_activities
+    for name, value in metrics.items():
+        st.session_state[name] = value
 
 # Update financial metrics function
 def update_financial_metrics():
-    data = load_data()
-    if not data.empty:
-        st.session_state.total_balance = data["Amount"].sum()
-        st.session_state.monthly_spend = data[
-            pd.to_datetime(data["Date"]).dt.strftime("%Y-%m") == datetime.now().strftime("%Y-%m")
-        ]["Amount"].sum()
-        budget = sum(BUDGET_LIMITS.values())
-        st.session_state.budget_used = (st.session_state.monthly_spend / budget) * 100 if budget > 0 else 0
-        st.session_state.recent_activities = data.tail(5).to_dict('records')
-        st.session_state.current_data = data
-    else:
-        st.session_state.total_balance = 0
-        st.session_state.monthly_spend = 0
-        st.session_state.budget_used = 0
-        st.session_state.recent_activities = []
+    data = load_data(st.session_state.username)
+    set_financial_metrics(financial_metrics(get_store(st.session_state.username), data, limits=BUDGET_LIMITS,
+                                            currency=st.session_state.currency, schedule=SCHEDULE_FILE))
+    st.session_state.current_data = data
 
 # Recall functionality
-def recall_financial_history(index):
-    if 0 <= index < len(st.session_state.financial_history):
-        recalled_data = pd.DataFrame(st.session_state.financial_history[index]['transactions'])
-        recalled_data['Date'] = pd.to_datetime(recalled_data['Date']).dt.strftime('%Y-%m-%d')
+def recall_financial_history(snapshot_id):
+    try:
+        recalled_data = get_snapshots(st.session_state.username).load(snapshot_id)
+    except FileNotFoundError:
+        recalled_data = None
+    if recalled_data is not None:
         
         # Update all session state variables before saving
         st.session_state.current_data = recalled_data
         st.session_state.recalled_data = recalled_data
-        st.session_state.total_balance = recalled_data["Amount"].sum()
-        st.session_state.monthly_spend = recalled_data[
-            pd.to_datetime(recalled_data["Date"]).dt.strftime("%Y-%m") == datetime.now().strftime("%Y-%m")
-        ]["Amount"].sum()
-        budget = sum(BUDGET_LIMITS.values())
-        st.session_state.budget_used = (st.session_state.monthly_spend / budget) * 100 if budget > 0 else 0
-        st.session_state.recent_activities = recalled_data.tail(5).to_dict('records')
+        set_financial_metrics(frame_metrics(recalled_data, limits=BUDGET_LIMITS, currency=st.session_state.currency))
         st.session_state.force_refresh = True
         
         # Save to file
-        recalled_data.to_csv("expenses.csv", index=False)
+        get_store(st.session_state.username).replace_all(recalled_data, keep_ids=True)
         
         # Clear all caches
-        load_data.clear()
-        st.cache_data.clear()
+        load_data.clear(st.session_state.username)
         
         return recalled_data
     return None
 
 # Helper functions
 @st.cache_data
-def load_data():
-    try:
-        data = pd.read_csv("expenses.csv")
-        st.session_state.current_data = data  # Update session state when loading data
-        return data
-    except:
-        return pd.DataFrame(columns=["Date", "Amount", "Category", "Receipt"])
+@timed("load_data")
+def load_data(username):
+    data = get_store(username).load(columns=SUMMARY_COLUMNS)
+    st.session_state.current_data = data  # Update session state when loading data
+    return data
     
 
 
 
 # Custom CSS for enhanced visual appeal
+section("styles")
 st.markdown("""
     <style>
     .welcome-header {
@@ -225,6 +242,7 @@ if not st.session_state.welcome_completed:
 
 
 # Welcome screen
+section("welcome")
 if not st.session_state.welcome_completed:
     st.markdown("""
     <style>
@@ -485,12 +503,14 @@ input {
     
         '''
 
+section("theme css")
 st.markdown(f'<style>{get_theme_css()}</style>', unsafe_allow_html=True)
 
 if not st.session_state.authenticated:
     set_png_as_page_bg('images/picture_1.jpg')
 
 # Authentication
+section("login")
 if not st.session_state.authenticated:
     st.title("Login")
     username = st.text_input("Username")
@@ -498,73 +518,218 @@ if not st.session_state.authenticated:
     if st.button("Login"):
         if username.strip() and password.strip():
             st.session_state.authenticated = True
+            st.session_state.username = username.strip()
             st.rerun()
         else:
             st.error("Please enter both username and password")       
     st.stop()
 
-# Budget limits
-BUDGET_LIMITS = {
-    "Food": 500,
-    "Transport": 200,
-    "Utilities": 300,
-    "Entertainment": 150,
-    "Shopping": 300,
-    "Healthcare": 200,
-    "Education": 250,
-    "Housing": 1000,
-    "Savings": 400,
-    "Insurance": 200,
-    "Subscriptions": 100,
-    "Personal Care": 150,
-    "Gifts": 100,
-    "Travel": 300,
-    "Other": 200
-}
+# Budget limits as last saved in Settings; a copy per rerun, so categories
+# added in Settings stay local to it until they are saved
+BUDGET_LIMITS = load_limits(DEFAULT_BUDGET_LIMITS, limits_file(st.session_state.username))
+
+# Subcategories from csv_collection/categories.csv sit under these budgets
+CATEGORY_TREE = category_tree(BUDGET_LIMITS)
+CATEGORY_NAMES = CATEGORY_TREE.names()
+CURRENCIES = currencies()
+
+# This user's recurring schedules, kept in their partition
+SCHEDULE_FILE = schedule_file(st.session_state.username)
+
+# Rows per page on the Transactions page
+PAGE_SIZES = [10, 25, 50, 100]
+
+# Trend charts with more points than this are drawn with WebGL
+WEBGL_POINTS = 1000
+
+# Timing breakdown in the sidebar; also shown with ?debug=1 in the URL
+DEBUG_PANEL = os.environ.get("EXPENSE_DEBUG") == "1"
+
+# Logins that see the cross-user Admin page. Login takes any password, so
+# nobody is an admin unless the server is started with EXPENSE_ADMINS set.
+ADMIN_USERS = [name.strip() for name in os.environ.get("EXPENSE_ADMINS", "").split(",") if name.strip()]
 
 # Helper functions
 @st.cache_data
-def load_data():
-    try:
-        return pd.read_csv("expenses.csv")
-    except:
-        return pd.DataFrame(columns=["Date", "Amount", "Category", "Receipt"])
+@timed("load_data")
+def load_data(username):
+    # Cached per user, so one user's writes never evict another's frame.
+    # Pages that show receipts query them per row, so they aren't loaded here.
+    store = get_store(username)
+    migrate_inline_receipts(store)
+    return store.load(columns=SUMMARY_COLUMNS)
 
 def validate_input(date, amount, category):
-    try:
-        amount_float = float(amount)
-        if amount_float <= 0:
-            st.error("Amount must be positive")
-            return False
-        if datetime.strptime(str(date), "%Y-%m-%d") > datetime.now():
-            st.error("Date cannot be in the future")
-            return False
-        return True
-    except ValueError:
-        st.error("Invalid amount format")
-        return False
+    error = validate_expense(date, amount)
+    if error:
+        st.error(error)
+    return error is None
+
+def check_budget_alerts(amount, category, currency=BASE_CURRENCY):
+    # Checked against the category's own budget and each parent's
+    exceeded = budget_alert(get_store(st.session_state.username), amount, category, limits=BUDGET_LIMITS,
+                            currency=currency, schedule=SCHEDULE_FILE, tree=CATEGORY_TREE)
+    if exceeded is not None:
+        name, limit = exceeded
+        st.warning(f"⚠️ This expense will exceed your {name} budget limit of {format_money(limit)}!")
+
+def transactions_csv(username, filters):
+    # Every transaction the filters match, not just the page on screen. Built
+    # only when the button is clicked, on a thread with no session state.
+    def build():
+        export = get_store(username).query(**filters, columns=SUMMARY_COLUMNS)
+        return export[SUMMARY_COLUMNS].to_csv()
+    return build
+
+def pdf_report_button(filters):
+    # A PDF is built only when asked for, for the filters and data on screen
+    # then; once either changes the request is dropped, its build stopped,
+    # and the Prepare button comes back
+    username = st.session_state.username
+    wanted = (filters, get_store(username).version())
+    pending = st.session_state.get("pdf_report")
+    if pending is not None and pending[0] != wanted:
+        cancel_report(username)
+        del st.session_state.pdf_report
+        pending = None
+    if pending is None:
+        st.button("Prepare PDF", on_click=prepare_pdf, args=(filters, wanted))
+        return
+    report = pending[1]
+    if not report.done():
+        wait_for_report(report)
+    elif report.cancelled() or report.exception() is not None:
+        del st.session_state.pdf_report
+        error = "it was cancelled" if report.cancelled() else report.exception()
+        st.error(f"Could not build the PDF report: {error}")
+    else:
+        st.download_button("Export PDF", report.result(), "expense_report.pdf", "application/pdf")
+
+def prepare_pdf(filters, wanted):
+    # Runs before the page, so the page already finds the request
+    with span("request_report"):
+        st.session_state.pdf_report = (wanted, request_report(st.session_state.username, filters))
 
-def check_budget_alerts(amount, category):
-    if category in BUDGET_LIMITS:
-        data = load_data()
-        monthly_category_spend = data[
-            (data["Category"] == category) & 
-            (pd.to_datetime(data["Date"]).dt.strftime("%Y-%m") == datetime.now().strftime("%Y-%m"))
-        ]["Amount"].sum()
-        if monthly_category_spend + amount > BUDGET_LIMITS[category]:
-            st.warning(f"⚠️ This expense will exceed your {category} budget limit of ${BUDGET_LIMITS[category]}!")
-
-def generate_pdf_report(data):
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    c.drawString(100, 750, "Expense Report")
-    y = 700
-    for _, row in data.iterrows():
-        c.drawString(100, y, f"{row['Date']} - {row['Category']}: ${row['Amount']:.2f}")
-        y -= 20
-    c.save()
-    buffer.seek(0)
-    return buffer
+@st.fragment(run_every=2)
+def wait_for_report(report):
+    # The report builds on a worker thread; this fragment re-checks on its own
+    # without rerunning the rest of the page, and once the report is ready
+    # reruns the page once so the download button replaces it and the
+    # polling stops
+    if report.done():
+        st.rerun()
+    st.button("Preparing PDF...", disabled=True)
+
+def show_load_progress(progress_bar, step):
+    status = f"{step.rows:,} rows parsed"
+    if step.total_bytes:
+        status += f", {step.bytes_read / 1e6:,.1f} of {step.total_bytes / 1e6:,.1f} MB read"
+    progress_bar.progress(step.fraction, text=status)
+
+def warm_store(store):
+    # The first read of a journal store parses its whole base file, so it is
+    # streamed here with progress by bytes read, whichever page asks first;
+    # every read after it comes from memory
+    if store.loaded():
+        return
+    progress_bar = st.progress(0.0, text="Loading expenses")
+    for step in store.stream(columns=SUMMARY_COLUMNS):
+        show_load_progress(progress_bar, step)
+    progress_bar.empty()
+
+def stream_spending_aggregates(store, currency=BASE_CURRENCY):
+    progress_bar = st.progress(0.0)
+    preview = st.empty()
+
+    def show_progress(step, aggregates):
+        show_load_progress(progress_bar, step)
+        if aggregates['by_category'] is not None:
+            preview.bar_chart(aggregates['by_category'])
+
+    aggregates = spending_aggregates(store, show_progress, currency)
+    progress_bar.empty()
+    preview.empty()
+    return aggregates
+
+def style_figure(fig):
+    fig.update_layout(
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        margin=dict(t=30, b=0, l=0, r=0),
+        showlegend=True,
+        legend=dict(
+            bgcolor='rgba(255,255,255,0.1)',
+            bordercolor='rgba(255,255,255,0.2)',
+            borderwidth=1
+        )
+    )
+    return fig
+
+@timed()
+def category_figure(by_category):
+    # Click a parent to drill into its subcategories; every ring comes from
+    # the per-category sums and the tree's closure index
+    totals = CATEGORY_TREE.subtree_totals(by_category)
+    fig = px.sunburst(names=totals.index, values=totals.values,
+                      parents=[CATEGORY_TREE.parents.get(name) or "" for name in totals.index],
+                      branchvalues="total", template="plotly_dark")
+    return style_figure(fig)
+
+@timed()
+def trend_figure(by_month, period, currency=BASE_CURRENCY):
+    # One point per month (or year) and category, however many rows there are
+    trend = by_month.reset_index()
+    if period == "Monthly":
+        trend['Month'] = trend['YearMonth'].map(format_year_month)
+        x = "Month"
+    else:
+        trend['Year'] = trend['YearMonth'] // 100
+        trend = trend.groupby(['Year', 'Category'])['Amount'].sum().reset_index()
+        x = "Year"
+    fig = px.line(trend, x=x, y="Amount", color="Category",
+                  title=f"{period} Spending Trend",
+                  labels={"Amount": f"Amount ({currency})", x: x},
+                  template="plotly_dark",
+                  render_mode="webgl" if len(trend) > WEBGL_POINTS else "auto")
+    return style_figure(fig)
+
+@timed()
+def budget_figure(monthly_spending):
+    # Budgets are set in BASE_CURRENCY, so spending is compared in it too
+    comparison = budget_comparison(monthly_spending, BUDGET_LIMITS, tree=CATEGORY_TREE)
+    fig = go.Figure(data=[
+        go.Bar(name='Budget', x=comparison['Category'], y=comparison['Budget']),
+        go.Bar(name='Actual', x=comparison['Category'], y=comparison['Actual'])
+    ])
+    fig.update_layout(barmode='group', template="plotly_dark")
+    return style_figure(fig)
+
+@timed()
+def periods_figure(comparison):
+    comparison = comparison[comparison['Category'] == ALL_SPENDING]
+    fig = go.Figure(data=[
+        go.Bar(name='Budget', x=comparison['Period'], y=comparison['Budget']),
+        go.Bar(name='Actual', x=comparison['Period'], y=comparison['Actual'])
+    ])
+    fig.update_layout(barmode='group', template="plotly_dark")
+    return style_figure(fig)
+
+@timed()
+def forecast_figure(forecast, currency=BASE_CURRENCY):
+    forecast = forecast.assign(Month=forecast['YearMonth'].map(format_year_month))
+    fig = px.bar(forecast, x="Month", y="Total", color="Category",
+                 hover_data=["Scheduled", "Other"],
+                 labels={"Total": f"Expected ({currency})"},
+                 template="plotly_dark")
+    return style_figure(fig)
+
+def cached_figure(analytics, key, build):
+    # Figures live beside the aggregates they came from, so they are only
+    # rebuilt when the data version or their own parameters change
+    figures = analytics.setdefault('figures', {})
+    if key not in figures:
+        figures[key] = build()
+    return figures[key]
 
 def clear_financial_data():
     if st.session_state.get('show_clear_confirm', False):
@@ -573,20 +738,13 @@ def clear_financial_data():
             if st.button("Yes, Clear Everything"):
                 try:
                     # Get current data before clearing
-                    current_data = load_data()
+                    current_data = get_store(st.session_state.username).load()
                     if not current_data.empty:
-                        # Save current state to history
-                        current_history = {
-                            'date_cleared': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                            'transactions': current_data.to_dict('records')
-                        }
-                        if 'financial_history' not in st.session_state:
-                            st.session_state.financial_history = []
-                        st.session_state.financial_history.insert(0, current_history)
-                        st.session_state.financial_history = st.session_state.financial_history[:5]
+                        # Save current state to the on-disk history
+                        get_snapshots(st.session_state.username).save(current_data)
                     
-                    # Create empty DataFrame and save
-                    pd.DataFrame(columns=["Date", "Amount", "Category", "Receipt"]).to_csv("expenses.csv", index=False)
+                    # Record the clear in the expense journal
+                    get_store(st.session_state.username).clear()
                     
                     # Reset session state
                     st.session_state.current_data = None
@@ -596,8 +754,7 @@ def clear_financial_data():
                     st.session_state.recent_activities = []
                     
                     # Clear caches
-                    load_data.clear()
-                    st.cache_data.clear()
+                    load_data.clear(st.session_state.username)
                     
                     st.session_state.show_clear_confirm = False
                     st.success("All financial data has been cleared!")
@@ -613,24 +770,28 @@ def clear_financial_data():
             st.session_state.show_clear_confirm = True
             st.rerun()
 
-def recall_financial_history(index):
-    if 0 <= index < len(st.session_state.financial_history):
-        return pd.DataFrame(st.session_state.financial_history[index]['transactions'])
-    return None
+def recall_financial_history(snapshot_id):
+    # None when the snapshot's files are gone from disk
+    try:
+        return get_snapshots(st.session_state.username).load(snapshot_id)
+    except FileNotFoundError:
+        return None
 
+@timed()
 def edit_transaction(data, index, new_date, new_amount, new_category):
     try:
         # Convert new_date to string format if it's a datetime object
         if isinstance(new_date, datetime):
             new_date = new_date.strftime('%Y-%m-%d')
             
-        # Update the transaction
-        data.at[index, 'Date'] = new_date
-        data.at[index, 'Amount'] = new_amount
-        data.at[index, 'Category'] = new_category
-        
-        # Save to CSV
-        data.to_csv("expenses.csv", index=False)
+        # The store rejects the edit if someone else changed the row since it was shown
+        seen = data.loc[index, ['Date', 'Amount', 'Category']].to_dict()
+        get_store(st.session_state.username).apply([update_op(index, {
+            'Date': new_date,
+            'Amount': new_amount,
+            'Category': new_category
+        }, expect=seen)])
+        load_data.clear(st.session_state.username)
         
         # Force dashboard refresh
         st.session_state.force_refresh = True
@@ -638,24 +799,63 @@ def edit_transaction(data, index, new_date, new_amount, new_category):
         # Update metrics
         update_financial_metrics()
         return True
+    except ConflictError as e:
+        load_data.clear(st.session_state.username)
+        st.error(f"{str(e)}. Reload the page to see the latest version.")
+        return False
     except Exception as e:
         st.error(f"Error updating transaction: {str(e)}")
         return False
 
+def stage_change(description, op):
+    st.session_state.staged_changes.append({'description': description, 'op': op})
+
+@timed()
+def apply_staged_changes():
+    # Every staged change goes to the store as one batch: one write, one
+    # cache clear and one metrics refresh however many rows it touches
+    try:
+        get_store(st.session_state.username).apply([change['op'] for change in st.session_state.staged_changes])
+    except Exception as e:
+        st.error(f"Error applying changes: {str(e)}")
+        return False
+    st.session_state.staged_changes = []
+    load_data.clear(st.session_state.username)
+    st.session_state.force_refresh = True
+    update_financial_metrics()
+    return True
+
 # Sidebar navigation
+section("sidebar")
 st.sidebar.title('Navigation')
-selected_page = st.sidebar.radio('Go to', ['Home', 'Transactions', 'Analytics', 'History', 'Settings', 'Creators'])
+pages = ['Home', 'Transactions', 'Analytics', 'History', 'Settings', 'Creators']
+if st.session_state.username in ADMIN_USERS:
+    pages.insert(-1, 'Admin')
+selected_page = st.sidebar.radio('Go to', pages)
 
 
 # Backup data
+incremental_backup = st.sidebar.checkbox("Only changes since last backup", key="incremental_backup")
 if st.sidebar.button("Backup Data"):
-    data = load_data()
-    st.sidebar.download_button(
-        "Download Backup",
-        data.to_json(),
-        "expense_backup.json",
-        "application/json"
-    )
+    # Streamed to a gzip file a chunk at a time, then offered for download
+    try:
+        backup_path = write_backup(get_store(st.session_state.username), backup_dir(st.session_state.username),
+                                   incremental=incremental_backup)
+    except BackupError as e:
+        st.sidebar.error(str(e))
+    else:
+        with open(backup_path, "rb") as backup_file:
+            st.sidebar.download_button(
+                "Download Backup",
+                backup_file,
+                os.path.basename(backup_path),
+                "application/gzip"
+            )
+
+st.session_state.trace.label = f"{selected_page} {st.session_state.trace.label}"
+section("warm store")
+warm_store(get_store(st.session_state.username))
+section(f"page {selected_page}")
 
 # Home Page (Dashboard)
 if selected_page == 'Home':
@@ -700,22 +900,24 @@ if selected_page == 'Home':
     col1, col2, col3 = st.columns(3)
    # Data loading for dashboard
     if st.session_state.get('force_refresh', False):
-        data = load_data()
+        data = load_data(st.session_state.username)
         st.session_state.force_refresh = False
     else:
         data = (st.session_state.current_data 
             if st.session_state.current_data is not None 
-            else load_data())
-    total_balance = data["Amount"].sum() if not data.empty else 0
-    monthly_spend = data[pd.to_datetime(data["Date"]).dt.strftime("%Y-%m") == datetime.now().strftime("%Y-%m")]["Amount"].sum() if not data.empty else 0
-    budget = sum(BUDGET_LIMITS.values())
-    remaining_budget = budget - monthly_spend
+            else load_data(st.session_state.username))
+    # update_financial_metrics() above already read these from the rollup
+    total_balance = st.session_state.total_balance
+    monthly_spend = st.session_state.monthly_spend
+    # Worked out in BASE_CURRENCY, whatever currency the amounts are shown in
+    budget_used = st.session_state.budget_used
+    currency = st.session_state.get('currency', BASE_CURRENCY)
     
     with col1:
         st.markdown(
             f"""
             <div data-testid="stMetricValue" class="{'negative' if total_balance > 0 else 'positive'}">
-                ${abs(total_balance):,.2f}
+                {format_money(abs(total_balance), currency)}
             </div>
             <div data-testid="stMetricLabel">Total Expenses</div>
             """,
@@ -725,23 +927,28 @@ if selected_page == 'Home':
         st.markdown(
             f"""
             <div data-testid="stMetricValue" class="{'negative' if monthly_spend > 0 else 'positive'}">
-                ${monthly_spend:,.2f}
+                {format_money(monthly_spend, currency)}
             </div>
             <div data-testid="stMetricLabel">Monthly Spend</div>
             """,
             unsafe_allow_html=True
         )
     with col3:
-        progress = min((monthly_spend / budget) * 100, 100)
+        progress = min(budget_used, 100)
         st.markdown(
             f"""
-            <div data-testid="stMetricValue" class="{'negative' if remaining_budget < 0 else 'positive'}">
+            <div data-testid="stMetricValue" class="{'negative' if budget_used > 100 else 'positive'}">
                 {progress:.1f}%
             </div>
             <div data-testid="stMetricLabel">Budget Used</div>
             """,
             unsafe_allow_html=True
         )
+    # Scheduled recurring charges are projected, never stored as expenses
+    upcoming_recurring = st.session_state.get('upcoming_recurring', 0)
+    if upcoming_recurring:
+        st.caption(f"{format_money(upcoming_recurring, currency)} in recurring charges is still due this month, "
+                   f"for a projected {format_money(st.session_state.projected_spend, currency)} in total.")
     
     st.markdown("""
     <h3 style='display: inline-block;'>Recent Activity
@@ -770,9 +977,9 @@ if selected_page == 'Home':
         }
     </style>
 """, unsafe_allow_html=True)
-    data = st.session_state.current_data if st.session_state.current_data is not None else load_data()
+    data = st.session_state.current_data if st.session_state.current_data is not None else load_data(st.session_state.username)
     if not data.empty:
-        st.dataframe(data.tail(5), use_container_width=True)
+        st.dataframe(data.tail(5).drop('YearMonth', axis=1), use_container_width=True)
     
     st.markdown("""
     <h3 style='display: inline-block;'>Quick Add Expense
@@ -804,30 +1011,34 @@ if selected_page == 'Home':
     with st.form("quick_expense"):
         date = st.date_input("Date")
         amount = st.number_input("Amount", min_value=0.01)
-        category = st.selectbox("Category", list(BUDGET_LIMITS.keys()))
+        expense_currency = st.selectbox("Currency", CURRENCIES, index=CURRENCIES.index(currency)
+                                        if currency in CURRENCIES else 0)
+        category = st.selectbox("Category", CATEGORY_NAMES)
         receipt = st.file_uploader("Upload Receipt", type=["png", "jpg", "jpeg"])
         submitted = st.form_submit_button("Add")
         
         if submitted:
             if validate_input(date, amount, category):
-                check_budget_alerts(amount, category)
+                check_budget_alerts(amount, category, expense_currency)
                 receipt_data = None
                 if receipt:
                     try:
-                        receipt_data = base64.b64encode(receipt.getvalue()).decode()
+                        receipt_data = save_receipt(receipt.getvalue())
                     except:
                         st.error("Error processing receipt image")
                         receipt_data = None
                 
-                new_expense = pd.DataFrame({
-                    "Date": [date],
-                    "Amount": [amount],
-                    "Category": [category],
-                    "Receipt": [receipt_data]
+                get_store(st.session_state.username).insert({
+                    "Date": date,
+                    "Amount": amount,
+                    "Category": category,
+                    "Receipt": receipt_data,
+                    "Currency": expense_currency
                 })
-                data = pd.concat([data, new_expense], ignore_index=True)
-                data.to_csv("expenses.csv", index=False)
-                load_data.clear()
+                if receipt_data:
+                    # Read in the background; the expense is saved either way
+                    get_ocr_queue().enqueue([receipt_data])
+                load_data.clear(st.session_state.username)
                 st.success("Expense added successfully!")
                 st.rerun()
 
@@ -862,23 +1073,92 @@ elif selected_page == 'Transactions':
     </style>
 """, unsafe_allow_html=True)
     
+    with st.expander("Import Statement"):
+        statement = st.file_uploader("Bank or card statement", type=["csv", "ofx", "qfx"])
+        if statement is not None and st.button("Import"):
+            try:
+                # Valid rows land in one write; rejected ones are listed by row
+                result = import_statement(get_store(st.session_state.username), statement,
+                                          statement.name, CATEGORY_NAMES,
+                                          imported_ids_file(st.session_state.username))
+            except ValueError as e:
+                st.error(f"Could not read the statement: {e}")
+            else:
+                if result.inserted:
+                    load_data.clear(st.session_state.username)
+                    st.session_state.force_refresh = True
+                    st.success(f"Imported {result.inserted:,} expenses")
+                if not result.errors.empty:
+                    st.warning(f"{len(result.errors):,} rows were not imported")
+                    st.dataframe(result.errors, use_container_width=True, hide_index=True)
+    
     col1, col2 = st.columns(2)
     with col1:
         date_range = st.date_input("Date Range", [])
     with col2:
-        category_filter = st.multiselect("Categories", list(BUDGET_LIMITS.keys()))
+        category_filter = st.multiselect("Categories", CATEGORY_NAMES)
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        sort_by = st.selectbox("Sort By", ["Date", "Amount", "Category"])
+    with col2:
+        sort_order = st.selectbox("Order", ["Descending", "Ascending"])
+    with col3:
+        page_size = st.selectbox("Rows Per Page", PAGE_SIZES, key="page_size")
     
-    data = load_data()
+    # Only the visible page is fetched from the store and gets edit widgets
+    # A parent category also matches everything under it
+    filters = {'categories': CATEGORY_TREE.expand(category_filter)}
     if len(date_range) == 2:
-        data = data[
-            (pd.to_datetime(data['Date']) >= pd.to_datetime(date_range[0])) & 
-            (pd.to_datetime(data['Date']) <= pd.to_datetime(date_range[1]))
-        ]
-    if category_filter:
-        data = data[data['Category'].isin(category_filter)]
+        filters['start'], filters['end'] = date_range
+    total_rows = get_store(st.session_state.username).count(**filters)
+    page_count = max(1, -(-total_rows // page_size))
+    if st.session_state.get('transactions_page', 1) > page_count:
+        st.session_state.transactions_page = page_count
+    page = st.number_input("Page", min_value=1, max_value=page_count, step=1, key="transactions_page")
+    data = get_store(st.session_state.username).query(**filters, sort=sort_by, descending=sort_order == "Descending",
+                             limit=page_size, offset=(page - 1) * page_size)
     
     if not data.empty:
-        st.dataframe(data.drop('Receipt', axis=1), use_container_width=True)
+        st.caption(f"Showing {len(data)} of {total_rows} transactions (page {page} of {page_count})")
+        st.dataframe(data.drop(['Receipt', 'YearMonth'], axis=1), use_container_width=True)
+        
+        # Batch mode stages edits and bulk changes, then commits them together
+        batch_mode = st.checkbox("Batch Edit Mode", key="batch_mode")
+        if batch_mode:
+            matching = expense_filter(**filters)
+            with st.expander(f"Bulk Changes ({total_rows} matching transactions)"):
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    bulk_category = st.selectbox("New Category", CATEGORY_NAMES, key="bulk_category")
+                    if st.button("Stage Recategorize"):
+                        stage_change(f"Recategorize {total_rows} matching transactions to {bulk_category}",
+                                     {'op': 'update_where', 'where': matching, 'row': {'Category': bulk_category}})
+                with col2:
+                    shift_days = st.number_input("Shift Dates By (days)", value=0, step=1, key="bulk_shift_days")
+                    if st.button("Stage Date Shift") and shift_days:
+                        stage_change(f"Shift {total_rows} matching transactions by {shift_days} days",
+                                     {'op': 'shift_dates', 'where': matching, 'days': int(shift_days)})
+                with col3:
+                    if st.button("Stage Delete Matching"):
+                        stage_change(f"Delete {total_rows} matching transactions",
+                                     {'op': 'delete_where', 'where': matching})
+            
+            staged = st.session_state.staged_changes
+            if staged:
+                st.write(f"**{len(staged)} staged changes**")
+                for change in staged:
+                    st.write(f"- {change['description']}")
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button(f"Apply {len(staged)} Changes"):
+                        if apply_staged_changes():
+                            st.success("Changes applied!")
+                            st.rerun()
+                with col2:
+                    if st.button("Discard Changes"):
+                        st.session_state.staged_changes = []
+                        st.rerun()
         
         st.markdown("""
     <h3 style='display: inline-block;'>Manage Transactions
@@ -907,49 +1187,80 @@ elif selected_page == 'Transactions':
         }
     </style>
 """, unsafe_allow_html=True)
-    data = load_data()
     
     if not data.empty:
         for index, row in data.iterrows():
-            with st.expander(f"Transaction {index + 1}: {row['Date']} - {row['Category']} - ${row['Amount']}"):
+            # Values this session saw, checked by the store when the row is saved or deleted
+            seen = {'Date': row['Date'], 'Amount': row['Amount'], 'Category': row['Category']}
+            with st.expander(f"Transaction {index + 1}: {row['Date']:%Y-%m-%d} - {row['Category']} - {format_money(row['Amount'], row['Currency'])}"):
                 col1, col2 = st.columns([3, 1])
                 
                 with col1:
-                    new_date = st.date_input(f"Date {index}", pd.to_datetime(row['Date']))
+                    new_date = st.date_input(f"Date {index}", row['Date'])
                     new_amount = st.number_input(f"Amount {index}", value=float(row['Amount']))
+                    # Categories outside the tree (imported, legacy or blank) stay selectable
+                    current_category = row['Category'] if pd.notna(row['Category']) else ""
+                    category_options = CATEGORY_NAMES if current_category in CATEGORY_NAMES \
+                        else CATEGORY_NAMES + [current_category]
                     new_category = st.selectbox(f"Category {index}", 
-                                              options=list(BUDGET_LIMITS.keys()), 
-                                              index=list(BUDGET_LIMITS.keys()).index(row['Category']))
+                                              options=category_options, 
+                                              index=category_options.index(current_category))
                     
                     if st.button(f"Save Changes {index}"):
-                        if edit_transaction(data, index, new_date, new_amount, new_category):
+                        if batch_mode:
+                            stage_change(f"Edit transaction {index + 1}",
+                                         update_op(index, {'Date': new_date, 'Amount': new_amount, 'Category': new_category},
+                                                   expect=seen))
+                            st.rerun()
+                        elif edit_transaction(data, index, new_date, new_amount, new_category):
                             st.success("Transaction updated successfully!")
                             st.rerun()
                     
                     if st.button(f"Delete {index}"):
-                        data = data.drop(index)
-                        data.to_csv("expenses.csv", index=False)
-                        st.session_state.force_refresh = True
-                        update_financial_metrics()
-                        st.success("Transaction deleted!")
-                        st.rerun()
+                        if batch_mode:
+                            stage_change(f"Delete transaction {index + 1}", delete_op(index, expect=seen))
+                            st.rerun()
+                        try:
+                            get_store(st.session_state.username).apply([delete_op(index, expect=seen)])
+                        except ConflictError as e:
+                            load_data.clear(st.session_state.username)
+                            st.error(f"{str(e)}. Reload the page to see the latest version.")
+                        else:
+                            load_data.clear(st.session_state.username)
+                            st.session_state.force_refresh = True
+                            update_financial_metrics()
+                            st.success("Transaction deleted!")
+                            st.rerun()
                 
                 with col2:
-                    if 'Receipt' in row and row['Receipt'] and row['Receipt'] != 'None':
-                        try:
-                            receipt_image = Image.open(row['Receipt'])
-                            st.image(receipt_image, caption="Receipt")
-                        except:
-                            pass
-    else:
-        st.info("No transactions found. Add some transactions to get started!")
-    
+                    if 'Receipt' in row and isinstance(row['Receipt'], str) and row['Receipt'] != 'None':
+                        # A small cached preview; the full image is only read once the user asks for it
+                        preview = thumbnail(row['Receipt'])
+                        if preview:
+                            st.image(preview, caption="Receipt")
+                        else:
+                            st.warning("Receipt image not found")
+                        if st.checkbox("Show Full Receipt", key=f"show_receipt_{index}"):
+                            receipt_bytes = load_receipt(row['Receipt'])
+                            if receipt_bytes:
+                                st.image(receipt_bytes, caption="Receipt")
+                            job = get_ocr_queue().job(row['Receipt'])
+                            if job is not None and job['status'] == 'done':
+                                found = [f"{label} {value}" for label, value in
+                                         [("Amount", job['amount']), ("Date", job['date']), ("Merchant", job['merchant'])]
+                                         if value is not None]
+                                st.caption("Read from receipt: " + (", ".join(found) or "nothing recognised"))
+                            elif job is not None:
+                                st.caption(f"Receipt reading {job['status']}")
+
         col1, col2 = st.columns(2)
         with col1:
-            st.download_button("Export CSV", data.to_csv(), "transactions.csv")
+            st.download_button("Export CSV", transactions_csv(st.session_state.username, filters), "transactions.csv",
+                               "text/csv")
         with col2:
-            pdf = generate_pdf_report(data)
-            st.download_button("Export PDF", pdf, "expense_report.pdf")
+            pdf_report_button(filters)
+    else:
+        st.info("No transactions found. Add some transactions to get started!")
 
 
 # Analytics Page
@@ -982,99 +1293,65 @@ elif selected_page == 'Analytics':
     </style>
 """, unsafe_allow_html=True)
     
-    data = load_data()
-    if not data.empty:
-        # Add progress bar for data loading
-        progress_bar = st.progress(0)
-        for i in range(100):
-            progress_bar.progress(i + 1)
-            time.sleep(0.01)
-        progress_bar.empty()
-        
+    # Read the store in chunks with real progress, showing partial totals as
+    # they arrive; reruns for the same data reuse the finished aggregates
+    store = get_store(st.session_state.username)
+    currency = st.session_state.currency
+    cache = st.session_state.get('analytics')
+    if cache is None or cache['version'] != store.version():
+        cache = {'version': store.version(), 'currencies': {}}
+        st.session_state.analytics = cache
+    # Each display currency keeps its own converted aggregates and figures,
+    # so switching currency and back doesn't read the store again
+    analytics = cache['currencies'].get(currency)
+    if analytics is None:
+        analytics = {'aggregates': stream_spending_aggregates(store, currency)}
+        cache['currencies'][currency] = analytics
+    aggregates = analytics['aggregates']
+    
+    if aggregates['rows']:
         period = st.selectbox("Analysis Period", ["Monthly", "Yearly"])
         
         col1, col2 = st.columns(2)
-        
         with col1:
             st.subheader("Spending by Category")
-            fig1 = px.pie(data, values="Amount", names="Category", template="plotly_dark")
-            fig1.update_layout(
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)',
-                margin=dict(t=30, b=0, l=0, r=0),
-                showlegend=True,
-                legend=dict(
-                    bgcolor='rgba(255,255,255,0.1)',
-                    bordercolor='rgba(255,255,255,0.2)',
-                    borderwidth=1
-                )
-            )
+            fig1 = cached_figure(analytics, ('category', category_file_version()), lambda: category_figure(aggregates['by_category']))
             st.plotly_chart(fig1, use_container_width=True)
-        
         with col2:
             st.subheader("Spending Trend")
-            if period == "Monthly":
-                monthly_data = data.copy()
-                monthly_data['Month'] = pd.to_datetime(monthly_data['Date']).dt.strftime('%Y-%m')
-                monthly_data = monthly_data.groupby(['Month', 'Category'])['Amount'].sum().reset_index()
-                fig2 = px.line(monthly_data, x="Month", y="Amount", color="Category",
-                              title="Monthly Spending Trend",
-                              labels={"Amount": "Amount ($)", "Month": "Month"},
-                              template="plotly_dark")
-            else:
-                yearly_data = data.copy()
-                yearly_data['Year'] = pd.to_datetime(yearly_data['Date']).dt.year
-                yearly_data = yearly_data.groupby(['Year', 'Category'])['Amount'].sum().reset_index()
-                fig2 = px.line(yearly_data, x="Year", y="Amount", color="Category",
-                              title="Yearly Spending Trend",
-                              labels={"Amount": "Amount ($)", "Year": "Year"},
-                              template="plotly_dark")
-            
-            fig2.update_layout(
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)',
-                margin=dict(t=30, b=0, l=0, r=0),
-                showlegend=True,
-                legend=dict(
-                    bgcolor='rgba(255,255,255,0.1)',
-                    bordercolor='rgba(255,255,255,0.2)',
-                    borderwidth=1
-                )
-            )
+            fig2 = cached_figure(analytics, ('trend', period), lambda: trend_figure(aggregates['by_month'], period, currency))
             st.plotly_chart(fig2, use_container_width=True)
         
         st.subheader("Budget vs Actual Spending")
-        current_month = datetime.now().strftime("%Y-%m")
-        monthly_spending = data[pd.to_datetime(data['Date']).dt.strftime("%Y-%m") == current_month].groupby('Category')['Amount'].sum()
-        
-        budget_comparison = pd.DataFrame({
-            'Category': BUDGET_LIMITS.keys(),
-            'Budget': BUDGET_LIMITS.values(),
-            'Actual': [monthly_spending.get(cat, 0) for cat in BUDGET_LIMITS.keys()]
-        })
+        current_month = year_month()
+        budget_key = (current_month, category_file_version(), budgets_version(), tuple(BUDGET_LIMITS.items()))
+        fig3 = cached_figure(analytics, ('budget',) + budget_key, lambda: budget_figure(
+            category_spending(get_store(st.session_state.username), current_month)))
+        st.plotly_chart(fig3, use_container_width=True)
         
-        fig3 = go.Figure(data=[
-            go.Bar(name='Budget', x=budget_comparison['Category'], y=budget_comparison['Budget']),
-            go.Bar(name='Actual', x=budget_comparison['Category'], y=budget_comparison['Actual'])
-        ])
+        st.subheader("Budget vs Actual by Period")
+        # The last twelve months, against the budget active on each day
+        budget_period = st.selectbox("Budget Period", ["Weekly", "Monthly", "Quarterly"], index=1)
+        fig5 = cached_figure(analytics, ('periods', budget_period) + budget_key, lambda: periods_figure(budget_vs_actual(
+            store, (pd.Period(datetime.now(), 'M') - 11).start_time, datetime.now(), budget_period.lower(),
+            limits=BUDGET_LIMITS, tree=CATEGORY_TREE)))
+        st.plotly_chart(fig5, use_container_width=True)
         
-        fig3.update_layout(
-            barmode='group',
-            template="plotly_dark",
-            paper_bgcolor='rgba(0,0,0,0)',
-            plot_bgcolor='rgba(0,0,0,0)',
-            margin=dict(t=30, b=0, l=0, r=0),
-            showlegend=True,
-            legend=dict(
-                bgcolor='rgba(255,255,255,0.1)',
-                bordercolor='rgba(255,255,255,0.2)',
-                borderwidth=1
-            )
-        )
-        st.plotly_chart(fig3, use_container_width=True)
+        st.subheader("Spending Forecast")
+        # Reused until the data, the month or the recurring schedules change
+        forecast_key = (current_month, schedule_version(SCHEDULE_FILE))
+        if analytics.get('forecast_key') != forecast_key:
+            analytics['forecast'] = spending_forecast(store, currency=currency, schedule=SCHEDULE_FILE)
+            analytics['forecast_key'] = forecast_key
+        forecast = analytics['forecast']
+        if forecast.empty:
+            st.info("Not enough history or recurring expenses to forecast yet.")
+        else:
+            fig4 = cached_figure(analytics, ('forecast',) + forecast_key, lambda: forecast_figure(forecast, currency))
+            st.plotly_chart(fig4, use_container_width=True)
         
         st.subheader("Top Expenses")
-        st.dataframe(data.nlargest(5, "Amount").drop('Receipt', axis=1), use_container_width=True)
+        st.dataframe(aggregates['top'].drop('YearMonth', axis=1), use_container_width=True)
 
         
 
@@ -1098,7 +1375,7 @@ elif selected_page == 'History':
                 left: 50%;
                 margin-left: -100px;
                 font-size: 12px;
-            '>Financial history stores your previous transaction records and lets you recall up to 5 past versions of your data.</span>
+            '>Financial history stores your previous transaction records and lets you recall any past version of your data.</span>
         </span>
     </h1>
     <style>
@@ -1109,24 +1386,32 @@ elif selected_page == 'History':
 """, unsafe_allow_html=True)
     
     
-    if st.session_state.financial_history:
-        for idx, history in enumerate(st.session_state.financial_history):
-            history_name = history.get('name', f"History from {history['date_cleared']}")
+    # Only the snapshot index is read here; rows load when asked for
+    snapshots = get_snapshots(st.session_state.username)
+    histories = snapshots.list()
+    if histories:
+        for history in histories:
+            history_name = history['name']
             st.subheader(f"{history_name}")
             col1, col2 = st.columns([3, 1])
             with col1:
-                st.write(f"Cleared on: {history['date_cleared']}")
+                st.write(f"Cleared on: {history['created']}")
+                st.write(f"{history['rows']} transactions totalling {format_money(history['total'])}")
             with col2:
                 # Allow renaming existing histories
-                new_name = st.text_input(f"Rename history {idx}", 
+                new_name = st.text_input(f"Rename history {history['id'][:8]}", 
                                        value=history_name,
-                                       key=f"rename_{idx}")
+                                       key=f"rename_{history['id']}")
                 if new_name != history_name:
-                    st.session_state.financial_history[idx]['name'] = new_name
+                    snapshots.rename(history['id'], new_name)
                     st.rerun()
                     
-            history_df = pd.DataFrame(history['transactions'])
-            st.dataframe(history_df.drop('Receipt', axis=1) if 'Receipt' in history_df.columns else history_df)
+            if st.checkbox("Show transactions", key=f"show_history_{history['id']}"):
+                history_df = recall_financial_history(history['id'])
+                if history_df is not None:
+                    st.dataframe(history_df.drop(['Receipt', 'YearMonth'], axis=1, errors='ignore'))
+                else:
+                    st.error("This history's data is no longer on disk")
             st.divider()
     else:
         st.info("No financial history available yet.")
@@ -1150,7 +1435,7 @@ elif selected_page == 'History':
                 left: 50%;
                 margin-left: -100px;
                 font-size: 12px;
-            '>The recall history feature gives users access to up to 5 previous versions of their financial data. When a historical record is recalled, all financial metrics and transaction data are restored to that point in time.</span>
+            '>The recall history feature gives users access to every previous version of their financial data. When a historical record is recalled, all financial metrics and transaction data are restored to that point in time.</span>
         </span>
     </h3>
     <style>
@@ -1159,43 +1444,40 @@ elif selected_page == 'History':
         }
     </style>
 """, unsafe_allow_html=True)
-    if st.session_state.financial_history:
+    if histories:
+        history_names = {history['id']: history['name'] for history in histories}
         history_index = st.selectbox(
             "Select history to recall",
-            range(len(st.session_state.financial_history)),
-            format_func=lambda x: st.session_state.financial_history[x].get('name', 
-                f"History from {st.session_state.financial_history[x]['date_cleared']}")
+            list(history_names),
+            format_func=lambda x: history_names[x]
         )
         
         col1, col2 = st.columns(2)
         with col1:
             if st.button("View Selected History"):
-                recalled_data = pd.DataFrame(st.session_state.financial_history[history_index]['transactions'])
+                recalled_data = recall_financial_history(history_index)
                 if recalled_data is not None:
                     st.success("Historical data loaded successfully!")
-                    st.dataframe(recalled_data.drop('Receipt', axis=1) if 'Receipt' in recalled_data.columns else recalled_data)
+                    st.dataframe(recalled_data.drop(['Receipt', 'YearMonth'], axis=1, errors='ignore'))
+                else:
+                    st.error("This history's data is no longer on disk")
         
         with col2:
             if st.button("Restore Selected History"):
-                if history_index is not None and st.session_state.financial_history:
-                    recalled_data = pd.DataFrame(st.session_state.financial_history[history_index]['transactions'])
+                recalled_data = recall_financial_history(history_index) if history_index is not None else None
+                if recalled_data is None:
+                    st.error("This history's data is no longer on disk")
+                else:
             
                     # Update all metrics
-                    st.session_state.total_balance = recalled_data["Amount"].sum()
-                    st.session_state.monthly_spend = recalled_data[
-                        pd.to_datetime(recalled_data["Date"]).dt.strftime("%Y-%m") == datetime.now().strftime("%Y-%m")
-                    ]["Amount"].sum()
-                    budget = sum(BUDGET_LIMITS.values())
-                    st.session_state.budget_used = (st.session_state.monthly_spend / budget) * 100 if budget > 0 else 0
-                    st.session_state.recent_activities = recalled_data.tail(5).to_dict('records')
+                    set_financial_metrics(frame_metrics(recalled_data, limits=BUDGET_LIMITS))
             
                     # Save and update current data
-                    recalled_data.to_csv("expenses.csv", index=False)
+                    get_store(st.session_state.username).replace_all(recalled_data, keep_ids=True)
                     st.session_state.current_data = recalled_data
             
                     #Clear caches and refresh
-                    load_data.clear()
-                    st.cache_data.clear()
+                    load_data.clear(st.session_state.username)
                     st.rerun()
 
 
@@ -1258,11 +1540,12 @@ elif selected_page == 'Settings':
 """, unsafe_allow_html=True)
     new_budgets = {}
     for category, limit in BUDGET_LIMITS.items():
-        new_budgets[category] = st.number_input(f"{category} Budget", value=limit, min_value=0)
+        new_budgets[category] = st.number_input(f"{category} Budget", value=float(limit), min_value=0.0)
     
     if st.button("Save Budget Settings"):
-        with open('budget_limits.json', 'w') as f:
-            json.dump(new_budgets, f)
+        save_limits(new_budgets, limits_file(st.session_state.username))
+        BUDGET_LIMITS.update(new_budgets)
+        update_financial_metrics()
         st.success("Budget settings saved!")
     
     st.markdown("""
@@ -1325,18 +1608,16 @@ elif selected_page == 'Settings':
         }
     </style>
 """, unsafe_allow_html=True)
-    currency_options = {
-        'USD': '$',
-        'EUR': '€',
-        'GBP': '£',
-        'JPY': '¥'
-    }
+    # Amounts are shown in this currency; expenses keep the one they were paid in
     selected_currency = st.selectbox(
         "Select Currency",
-        options=list(currency_options.keys()),
-        format_func=lambda x: f"{x} ({currency_options[x]})"
+        options=CURRENCIES,
+        index=CURRENCIES.index(st.session_state.currency) if st.session_state.currency in CURRENCIES else 0,
+        format_func=lambda x: f"{x} ({CURRENCY_SYMBOLS[x]})" if x in CURRENCY_SYMBOLS else x
     )
-    st.session_state.currency = selected_currency
+    if selected_currency != st.session_state.currency:
+        st.session_state.currency = selected_currency
+        update_financial_metrics()
     
     st.markdown("""
     <h3 style='display: inline-block;'>Data Management
@@ -1367,13 +1648,84 @@ elif selected_page == 'Settings':
 """, unsafe_allow_html=True)
     if st.button("Clear All Data"):
         if st.checkbox("I understand this will delete all my data"):
-            try:
-                os.remove("expenses.csv")
-                load_data.clear()
-                st.success("All data cleared!")
-                st.rerun()
-            except FileNotFoundError:
-                st.warning("No data file found to clear.")
+            get_store(st.session_state.username).clear()
+            load_data.clear(st.session_state.username)
+            st.success("All data cleared!")
+            st.rerun()
+
+    backup_upload = st.file_uploader("Restore Backup", type=["gz", "zst"])
+    if backup_upload is not None and st.button("Restore From Backup"):
+        try:
+            # Checked end to end before anything is written
+            header = restore_backup(get_store(st.session_state.username), backup_upload)
+        except BackupError as e:
+            st.error(f"Backup not restored: {e}")
+        else:
+            load_data.clear(st.session_state.username)
+            update_financial_metrics()
+            st.success(f"Restored {header['kind']} backup from {header['created']}")
+
+    # Receipts already saved are read by the same background queue as new ones
+    ocr_queue = get_ocr_queue()
+    if st.button("Read Existing Receipts"):
+        queued = backfill_receipts(get_store(st.session_state.username), ocr_queue)
+        st.success(f"Queued {queued} receipts for reading")
+    ocr_counts = ocr_queue.counts()
+    if ocr_counts:
+        st.caption(", ".join(f"{count} {status}" for status, count in sorted(ocr_counts.items())) +
+                   ("" if ocr_queue.available() else " (tesseract is not installed, so nothing is read yet)"))
+
+    # Previews are made again from the full images when next shown
+    if st.button("Clear Receipt Previews"):
+        st.success(f"Removed {clear_thumbnails()} receipt previews")
+    st.caption(f"Receipt previews use {thumbnail_cache_size() / 1024 / 1024:.1f} MB of "
+               f"{THUMB_CACHE_BYTES / 1024 / 1024:.0f} MB")
+
+# Admin Page (all users)
+elif selected_page == 'Admin':
+    st.title("All Users")
+    # Expenses from before per-user partitions are never handed to a login
+    # automatically; an operator picks whose they are
+    if any(os.path.exists(path) for path in SHARED_FILES):
+        shared_count = get_store().count()
+        if shared_count:
+            st.info(f"The shared store from before per-user accounts still holds {shared_count} expenses. "
+                    "Move them to their owner with `python expense_store.py adopt-shared --user NAME`.")
+    users = list_users()
+    if not users:
+        st.info("No user has recorded any expenses yet.")
+    else:
+        # One partition at a time, reading only each user's rollup
+        progress = st.progress(0.0, text="Reading user partitions...")
+        current_month = year_month()
+        summaries = []
+        category_totals = {}
+        for done, (username, rollup) in enumerate(user_rollups(), start=1):
+            rollup = convert_rollup(rollup)
+            summaries.append({
+                'User': username,
+                'Transactions': int(rollup['Count'].sum()),
+                'Total Spent': rollup['Total'].sum(),
+                'This Month': rollup.loc[rollup['YearMonth'] == current_month, 'Total'].sum(),
+            })
+            for category, total in rollup.groupby('Category')['Total'].sum().items():
+                category_totals[category] = category_totals.get(category, 0) + total
+            progress.progress(done / len(users), text=f"Read {done} of {len(users)} users")
+        progress.empty()
+
+        summary = pd.DataFrame(summaries)
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Users", len(summary))
+        col2.metric("Transactions", int(summary['Transactions'].sum()))
+        col3.metric("Total Spent", format_money(summary['Total Spent'].sum()))
+        st.dataframe(summary, use_container_width=True, hide_index=True)
+
+        if category_totals:
+            by_category = pd.Series(category_totals).sort_values(ascending=False)
+            fig = px.bar(x=by_category.index, y=by_category.values,
+                         labels={'x': 'Category', 'y': 'Total Spent'},
+                         title='Spending by Category, All Users')
+            st.plotly_chart(fig, use_container_width=True)
 
 # Creators Page
 elif selected_page == 'Creators':
@@ -1486,4 +1838,28 @@ if selected_page == 'Creators':
     # Add this at the bottom of the creators page section
         st.image("images/Picture_3.png", caption="ORIGINALLY MADE BY JUJU THIS WASNT A ROBOT", use_container_width=True)
      
-            
\ No newline at end of file
+            
+
+
+# Debug panel
+section("debug panel")
+if DEBUG_PANEL or st.query_params.get("debug") == "1":
+    with st.sidebar.expander("Performance"):
+        traces = st.session_state.traces[::-1]
+        if traces:
+            choice = st.selectbox("Rerun", range(len(traces)),
+                                  format_func=lambda i: f"{traces[i].label} ({traces[i].total * 1000:,.0f} ms)")
+            spans = pd.DataFrame(traces[choice].record()['spans'])
+            spans['Span'] = spans['depth'].map(lambda depth: ' ' * depth) + spans['name']
+            spans['ms'] = (spans['duration'] * 1000).round(1)
+            st.dataframe(spans[['Span', 'ms']], hide_index=True, use_container_width=True)
+        else:
+            st.caption("Timings appear after the next rerun.")
+        if background_spans:
+            st.caption("Background work")
+            background = pd.DataFrame(list(background_spans)[-10:])
+            background['ms'] = (background['duration'] * 1000).round(1)
+            st.dataframe(background[['name', 'thread', 'ms']], hide_index=True, use_container_width=True)
+        if st.button("Export Timings", disabled=not traces):
+            st.success(f"Wrote {len(traces)} reruns to {export_traces(st.session_state.traces)}")
+st.session_state.trace.finish()
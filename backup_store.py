@@ -0,0 +1,317 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import uuid
+from datetime import date, datetime
+
+try:
+    import zstandard
+except ImportError:  # zstd backups are optional
+    zstandard = None
+
+from expense_store import EXPENSE_COLUMNS, ConflictError, clean_row, expense_filter, get_store, partition_dir
+from file_utils import temp_path, write_atomic
+from profiling import timed
+
+# Backups are NDJSON: a header line, one line per expense, and a trailer with
+# the row count and a SHA-256 of the row lines. Files are written, checked
+# and restored a chunk at a time; a restore goes to the store through
+# apply_chunks(), so it lands whole or not at all without the backup ever
+# being held in memory.
+#
+# An incremental backup holds only the id blocks that changed since the last
+# checkpoint. Each block is fingerprinted by summing the hashes of its rows,
+# which doesn't depend on the order rows are streamed in, so a checkpoint is
+# one number per block rather than a copy of the data.
+
+BACKUP_DIR = "backups"
+BACKUP_FORMAT = "expense-backup"
+BACKUP_VERSION = 1
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Expense ids per block; an incremental backup re-sends whole blocks
+BLOCK_ROWS = 1000
+
+# Rows read from a backup before they are handed to the store
+RESTORE_CHUNK_ROWS = 5000
+
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+class BackupError(ValueError):
+    pass
+
+
+def backup_dir(username=None):
+    if username is None:
+        return BACKUP_DIR
+    return os.path.join(partition_dir(username), BACKUP_DIR)
+
+
+def _open(source, mode, compression=None):
+    # source is a path or a binary file object such as an upload; when
+    # reading, gzip and zstd are told apart by their magic bytes
+    if compression is None:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                magic = f.read(4)
+        else:
+            source.seek(0)
+            magic = source.read(4)
+            source.seek(0)
+        compression = "zst" if magic == ZSTD_MAGIC else "gz"
+    if compression == "zst":
+        if zstandard is None:
+            raise BackupError("Install zstandard to read or write .zst backups")
+        return zstandard.open(source, mode)
+    return gzip.open(source, mode)
+
+
+def _row_line(expense_id, row):
+    record = {"id": int(expense_id)}
+    record.update(clean_row(row))
+    return json.dumps(record, separators=(",", ":"), sort_keys=True)
+
+
+def _row_hash(line):
+    return int.from_bytes(hashlib.sha256(line.encode("utf-8")).digest()[:8], "big")
+
+
+def _lines(store):
+    # (block, line) for every expense, in whatever order the store streams them
+    for progress in store.stream():
+        for expense_id, row in progress.chunk[EXPENSE_COLUMNS].to_dict("index").items():
+            yield int(expense_id) // BLOCK_ROWS, _row_line(expense_id, row)
+
+
+def _checkpoint_path(folder):
+    return os.path.join(folder, "checkpoint.json")
+
+
+def _read_checkpoint(folder):
+    try:
+        with open(_checkpoint_path(folder), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _fingerprints(store):
+    fingerprints = {}
+    for block, line in _lines(store):
+        fingerprints[block] = (fingerprints.get(block, 0) + _row_hash(line)) % 2 ** 64
+    return fingerprints
+
+
+@timed("backup")
+def write_backup(store, folder=BACKUP_DIR, incremental=False, compression="gz"):
+    """Streams the store into a new backup file in folder and returns its path.
+
+    With incremental=True only blocks changed since the last checkpoint are
+    written; without a checkpoint the backup is full. Either way the backup
+    becomes the new checkpoint once the file is complete. Raises BackupError
+    if the expenses change while an incremental backup is being written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    parent = _read_checkpoint(folder) if incremental else None
+    created = datetime.now()
+    header = {
+        "format": BACKUP_FORMAT,
+        "version": BACKUP_VERSION,
+        "kind": "incremental" if parent else "full",
+        "checkpoint": uuid.uuid4().hex,
+        "parent": parent["checkpoint"] if parent else None,
+        "created": f"{created:%Y-%m-%d %H:%M:%S}",
+        "block_rows": BLOCK_ROWS,
+    }
+    if parent:
+        # An incremental backup reads the store twice: once to find the blocks
+        # that changed and once to write them. An edit between the two would
+        # reach the checkpoint without reaching any backup, so the version
+        # must be the same at the end as at the start.
+        version = store.version()
+        fingerprints = _fingerprints(store)
+        previous = {int(block): value for block, value in parent["blocks"].items()}
+        changed = {block for block in fingerprints.keys() | previous.keys()
+                   if fingerprints.get(block) != previous.get(block)}
+        header["blocks"] = sorted(changed)
+        # What the store must hold before this backup can be restored on top of it
+        header["parent_blocks"] = parent["blocks"]
+    else:
+        version = None
+        changed = None
+
+    name = f"{created:%Y%m%d-%H%M%S}-{header['kind']}-{header['checkpoint'][:8]}.ndjson.{compression}"
+    path = os.path.join(folder, name)
+    tmp = temp_path(path)
+    digest = hashlib.sha256()
+    rows = 0
+    fingerprints = {}
+    with _open(tmp, "wt", compression) as f:
+        f.write(json.dumps(header) + "\n")
+        for block, line in _lines(store):
+            fingerprints[block] = (fingerprints.get(block, 0) + _row_hash(line)) % 2 ** 64
+            if changed is not None and block not in changed:
+                continue
+            f.write(line + "\n")
+            digest.update(line.encode("utf-8") + b"\n")
+            rows += 1
+        f.write(json.dumps({"rows": rows, "sha256": digest.hexdigest()}) + "\n")
+    if version is not None and store.version() != version:
+        os.remove(tmp)
+        raise BackupError("The expenses changed during the backup; try again")
+    os.replace(tmp, path)
+    write_atomic(_checkpoint_path(folder), json.dumps({
+        "checkpoint": header["checkpoint"],
+        "created": header["created"],
+        "blocks": {str(block): value for block, value in fingerprints.items()},
+    }).encode("utf-8"))
+    return path
+
+
+def _valid_row(record):
+    if not isinstance(record.get("id"), int) or record["id"] < 0:
+        return False
+    if not isinstance(record.get("Amount"), (int, float)) or isinstance(record["Amount"], bool):
+        return False
+    when = record.get("Date")
+    if when is not None:
+        # fromisoformat is far quicker than strptime, but also takes other layouts
+        if not isinstance(when, str) or not _DATE.fullmatch(when):
+            return False
+        try:
+            date.fromisoformat(when)
+        except ValueError:
+            return False
+    return all(record.get(column) is None or isinstance(record[column], str)
+               for column in ("Category", "Receipt", "Currency"))
+
+
+def _read(source):
+    # Yields the header, then each row record, checking every line on the way
+    with _open(source, "rt") as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            raise BackupError("Not an expense backup")
+        if not isinstance(header, dict) or header.get("format") != BACKUP_FORMAT:
+            raise BackupError("Not an expense backup")
+        if header.get("version", 0) > BACKUP_VERSION:
+            raise BackupError(f"Backup format {header['version']} is newer than this app")
+        yield header
+        blocks = set(header.get("blocks", []))
+        digest = hashlib.sha256()
+        rows = 0
+        trailer = None
+        for number, line in enumerate(f, start=2):
+            if trailer is not None:
+                raise BackupError(f"Line {number}: data after the end of the backup")
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise BackupError(f"Line {number}: not valid JSON")
+            if "sha256" in record:
+                trailer = record
+                continue
+            if not _valid_row(record):
+                raise BackupError(f"Line {number}: not a valid expense")
+            if header["kind"] == "incremental" and record["id"] // header["block_rows"] not in blocks:
+                raise BackupError(f"Line {number}: expense {record['id']} is outside the backed-up blocks")
+            digest.update(line.encode("utf-8"))
+            rows += 1
+            yield record
+        if trailer is None:
+            raise BackupError("The backup is truncated")
+        if trailer["rows"] != rows or trailer["sha256"] != digest.hexdigest():
+            raise BackupError("The backup does not match its checksum")
+
+
+def verify_backup(source):
+    """Reads a backup end to end without applying it and returns its header."""
+    try:
+        reader = _read(source)
+        header = next(reader)
+        for _ in reader:
+            pass
+    except (OSError, EOFError) as e:
+        raise BackupError(f"The backup file is damaged: {e}")
+    return header
+
+
+def _restore_chunks(ops, records):
+    # ops first, then the records as inserts, RESTORE_CHUNK_ROWS at a time
+    chunk = list(ops)
+    for record in records:
+        chunk.append({"op": "insert", "id": record.pop("id"), "row": record})
+        if len(chunk) >= RESTORE_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@timed("restore backup")
+def restore_backup(store, source):
+    """Applies a backup to the store and returns its header.
+
+    The whole file is verified first and then applied a chunk of rows at a
+    time within one store batch, so a damaged backup, a crash or another
+    writer partway through changes nothing. A full backup replaces
+    everything; an incremental one replaces the blocks it carries, and is
+    refused unless every other block still matches the checkpoint it was
+    taken after.
+    """
+    verify_backup(source)
+    version = store.version()
+    reader = _read(source)
+    header = next(reader)
+    if header["kind"] == "full":
+        ops = [{"op": "clear"}]
+    else:
+        size = header["block_rows"]
+        carried = set(header["blocks"])
+        parent = {int(block): value for block, value in header.get("parent_blocks", {}).items()}
+        current = _fingerprints(store)
+        if "parent_blocks" not in header or any(current.get(block) != parent.get(block)
+                                                for block in current.keys() | parent.keys()
+                                                if block not in carried):
+            raise BackupError("The expenses no longer match the backup this one was taken after; "
+                              "restore that backup first")
+        ops = [{"op": "delete_where", "where": expense_filter(ids=range(block * size, (block + 1) * size))}
+               for block in header["blocks"]]
+    try:
+        store.apply_chunks(_restore_chunks(ops, reader), expected_version=version)
+    except ConflictError:
+        raise BackupError("The expenses changed while restoring; nothing was restored")
+    except (OSError, EOFError) as e:
+        raise BackupError(f"The backup file is damaged: {e}")
+    return header
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Back up or restore expenses")
+    parser.add_argument("command", choices=["backup", "verify", "restore"])
+    parser.add_argument("path", nargs="?", help="backup file to verify or restore")
+    parser.add_argument("--user", help="partition to work on; the shared store if omitted")
+    parser.add_argument("--incremental", action="store_true", help="only blocks changed since the last backup")
+    parser.add_argument("--zstd", action="store_true", help="compress with zstd instead of gzip")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "backup":
+            print(write_backup(get_store(args.user), backup_dir(args.user), args.incremental,
+                               "zst" if args.zstd else "gz"))
+        elif not args.path:
+            parser.error(f"{args.command} needs a backup file")
+        elif args.command == "verify":
+            header = verify_backup(args.path)
+            print(f"{header['kind'].capitalize()} backup from {header['created']} is intact")
+        else:
+            header = restore_backup(get_store(args.user), args.path)
+            print(f"Restored {header['kind']} backup from {header['created']}")
+    except BackupError as e:
+        raise SystemExit(str(e))
@@ -0,0 +1,164 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime
+
+import pandas as pd
+
+from budgets import load_limits
+from engine import BUDGET_LIMITS, budget_alert, category_tree, financial_metrics, spending_aggregates
+from expense_store import SUMMARY_COLUMNS, JournalStore, SQLiteStore, delete_op, update_op, year_month
+from receipt_store import RECEIPT_DIR, migrate_inline_receipts
+from recurring import SCHEDULE_NAME
+from report_engine import build_report
+from synthetic_data import load_synthetic
+
+# Times the operations behind each page against synthetic data, one fresh
+# store per backend and size, and saves the medians as JSON so later runs
+# can be compared with --compare. Each case makes the same calls, with the
+# same arguments, as the Main.py function it is named after.
+
+RESULTS_DIR = "benchmarks"
+
+# Larger stores skip the PDF report, which is paged per month and slow by design
+PDF_MAX_ROWS = 100_000
+
+
+def _timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def open_store(backend, folder):
+    # Opened by path rather than through get_store(), which caches stores by
+    # partition and reads the backend from the environment
+    if backend == "journal":
+        return JournalStore(os.path.join(folder, "expenses.csv"), os.path.join(folder, "expenses.journal"))
+    return SQLiteStore(os.path.join(folder, "expenses.db"))
+
+
+def _cases(store, rows, folder):
+    # Name -> callable, the engine and store calls behind each page
+    key = year_month(date(2025, 6, 1))
+    ids = iter(store.query(columns=["Amount"], sort="Amount", descending=True, limit=1000).index)
+    limits = load_limits(BUDGET_LIMITS, os.path.join(folder, "budget_limits.json"))
+    tree = category_tree(limits)
+    schedule = os.path.join(folder, SCHEDULE_NAME)
+
+    def load_data():
+        migrate_inline_receipts(store)
+        return store.load(columns=SUMMARY_COLUMNS)
+
+    def update_financial_metrics():
+        financial_metrics(store, load_data(), key=key, limits=limits, schedule=schedule)
+
+    def check_budget_alerts():
+        budget_alert(store, 25.0, "Food", key, limits=limits, schedule=schedule, tree=tree)
+
+    def transactions_filter():
+        filters = {"start": date(2024, 1, 1), "end": date(2024, 12, 31),
+                   "categories": tree.expand(["Food", "Travel"])}
+        store.count(**filters)
+        store.query(**filters, sort="Amount", descending=True, limit=25, offset=50)
+
+    def analytics_aggregation():
+        spending_aggregates(store, lambda step, aggregates: None)
+
+    def edit():
+        expense_id = int(next(ids))
+        row = store.get(expense_id)
+        store.apply([update_op(expense_id, {"Amount": row["Amount"] + 1}, expect={"Amount": row["Amount"]})])
+
+    def delete():
+        expense_id = int(next(ids))
+        store.apply([delete_op(expense_id, expect={"Amount": store.get(expense_id)["Amount"]})])
+
+    cases = {
+        "load_data": load_data,
+        "update_financial_metrics": update_financial_metrics,
+        "check_budget_alerts": check_budget_alerts,
+        "transactions_filter": transactions_filter,
+        "analytics_aggregation": analytics_aggregation,
+        "edit": edit,
+        "delete": delete,
+    }
+    if rows <= PDF_MAX_ROWS:
+        cases["pdf_report"] = lambda: build_report(store)
+    return cases
+
+
+def run(sizes, backends, repeat=3, seed=0):
+    results = []
+    for backend in backends:
+        for rows in sizes:
+            # Every combination gets an empty folder of its own, holding the
+            # reference tables and receipt images as well as the store
+            folder = tempfile.mkdtemp(prefix=f"bench-{backend}-{rows}-")
+            store = open_store(backend, folder)
+            started = time.perf_counter()
+            load_synthetic(store, rows, seed, tables=folder, receipt_dir=os.path.join(folder, RECEIPT_DIR))
+            result = {"backend": backend, "rows": rows, "generate": time.perf_counter() - started}
+            if backend == "journal":
+                store.compact()
+            # A store opened from disk, as after a server restart
+            store = open_store(backend, folder)
+            started = time.perf_counter()
+            store.load(columns=SUMMARY_COLUMNS)
+            result["cold_load"] = time.perf_counter() - started
+            for name, case in _cases(store, rows, folder).items():
+                result[name] = _timed(case, repeat)
+            results.append(result)
+            print(_format([result]))
+    return results
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "python": platform.python_version(), "pandas": pd.__version__,
+            "machine": platform.machine(), "created": f"{datetime.now():%Y-%m-%d %H:%M:%S}"}
+
+
+def _format(results):
+    frame = pd.DataFrame(results).set_index(["backend", "rows"])
+    return (frame * 1000).round(1).to_string()
+
+
+def compare(old_path, new_results):
+    # Ratio of new to old median time per operation; below 1 is faster
+    with open(old_path, encoding="utf-8") as f:
+        old = pd.DataFrame(json.load(f)["results"]).set_index(["backend", "rows"])
+    new = pd.DataFrame(new_results).set_index(["backend", "rows"])
+    return (new / old).round(2).dropna(how="all").to_string()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the expense pipeline on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--backend", nargs="+", default=["sqlite", "journal"], choices=["sqlite", "journal"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.backend, args.repeat, args.seed)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"environment": _environment(), "results": results}, f, indent=1)
+    print(f"\nMedian milliseconds\n{_format(results)}\n\nSaved to {path}")
+    if args.compare:
+        print(f"\nNew / old\n{compare(args.compare, results)}")
@@ -0,0 +1,253 @@
+import functools
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from categories import load_category_tree
+from currency import RATES_FILE, base_rates, currencies, rates_version
+from expense_store import partition_dir
+from file_utils import file_version, write_atomic
+
+# Budgets that depend on the date. csv_collection/budgets.csv lists budgets
+# for explicit periods (start_date to end_date, both inclusive), either for
+# all spending or, with a category column, for one category. Days no period
+# covers fall back to the monthly limits: the app's defaults overlaid with
+# what Settings saved to the user's budget_limits.json.
+#
+# Every period becomes an interval in one IntervalIndex, keyed by scope
+# (all spending or a category) and day, so the budget for any set of
+# (scope, day) pairs is a single lookup. A range's budget is the sum of its
+# days' shares of the budgets covering them, which lets weeks, quarters or
+# custom periods be compared with spending in one grouped pass.
+
+BUDGETS_FILE = os.environ.get("EXPENSE_BUDGETS_FILE", os.path.join("csv_collection", "budgets.csv"))
+LIMITS_FILE = os.environ.get("EXPENSE_BUDGET_LIMITS_FILE", "budget_limits.json")
+
+# Each user's saved limits, in their partition beside their expenses
+LIMITS_NAME = "budget_limits.json"
+
+# Scope of budgets over every category
+ALL = ""
+
+# Period names for budget_vs_actual, as pandas period frequencies
+FREQUENCIES = {"weekly": "W", "monthly": "M", "quarterly": "Q", "yearly": "Y"}
+
+PERIOD_COLUMNS = ["Period", "Start", "End", "Category", "Budget"]
+
+# Days are numbered from here, and each scope gets its own run of numbers
+_FIRST_DAY = np.datetime64("1900-01-01", "D")
+_SCOPE_DAYS = 1 << 20
+
+
+def limits_file(username=None):
+    # LIMITS_FILE belongs to the shared store from before per-user partitions
+    if username is None:
+        return LIMITS_FILE
+    return os.path.join(partition_dir(username), LIMITS_NAME)
+
+
+def budgets_version(path=BUDGETS_FILE):
+    return file_version(path)
+
+
+@functools.lru_cache(maxsize=8)
+def _saved_limits(path, version):
+    if version is None:
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(saved, dict):
+        return {}
+    return {str(name): float(limit) for name, limit in saved.items()
+            if isinstance(limit, (int, float)) and not isinstance(limit, bool) and limit >= 0}
+
+
+def load_limits(defaults, path=LIMITS_FILE):
+    # Monthly limits per top-level category, with saved values over defaults
+    limits = dict(defaults)
+    limits.update(_saved_limits(path, budgets_version(path)))
+    return limits
+
+
+def save_limits(limits, path=LIMITS_FILE):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    write_atomic(path, json.dumps({name: float(limit) for name, limit in limits.items()}, indent=1).encode("utf-8"))
+
+
+def _days(values):
+    return pd.DatetimeIndex(values).to_numpy(dtype="datetime64[D]")
+
+
+def _month_days(days):
+    months = days.astype("datetime64[M]")
+    return ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype("int64")
+
+
+@functools.lru_cache(maxsize=8)
+def _periods(path, version, rates):
+    # rates is the rate table's version, so new rates mean new amounts
+    columns = ["BudgetId", "Name", "Scope", "Start", "End", "Amount"]
+    if version is None:
+        return pd.DataFrame(columns=columns)
+    # Lines with the wrong number of fields are skipped with a warning too
+    frame = pd.read_csv(path, dtype=str, skipinitialspace=True, on_bad_lines="warn")
+    frame.columns = [column.strip().lower() for column in frame.columns]
+    blank = pd.Series(None, index=frame.index, dtype=object)
+    start = pd.to_datetime(frame["start_date"], errors="coerce")
+    end = pd.to_datetime(frame["end_date"], errors="coerce")
+    amount = pd.to_numeric(frame["total_amount"], errors="coerce")
+    currency = frame.get("currency", blank).str.strip().str.upper()
+    periods = pd.DataFrame({
+        "BudgetId": frame.get("budget_id", blank),
+        "Name": frame.get("period", blank),
+        "Scope": frame.get("category", blank).fillna(ALL).str.strip(),
+        "Start": start,
+        "End": end,
+        "Amount": amount,
+        "Currency": currency.where(currency.notna() & (currency != ""), None),
+    })
+    # Periods that can't be placed are left out rather than guessed at
+    periods = periods[start.notna() & end.notna() & (end >= start) & amount.notna()].copy()
+    # and so are periods in a currency with no rate, so one bad row in the
+    # file doesn't stop every page from working out its budget
+    unpriced = periods["Currency"].notna() & ~periods["Currency"].isin(currencies())
+    if unpriced.any():
+        warnings.warn(f"{path}: left out budgets in currencies with no exchange rate: "
+                      f"{', '.join(sorted(periods.loc[unpriced, 'Currency'].unique()))}")
+        periods = periods[~unpriced]
+    # Amounts in the base currency at the rate on the day a period starts
+    periods["Amount"] = periods["Amount"] * base_rates(periods["Start"], periods["Currency"])
+    # Overlapping periods for one scope: the one starting later takes over
+    periods = periods.sort_values(["Scope", "Start"], kind="stable").reset_index(drop=True)
+    following = periods.groupby("Scope")["Start"].shift(-1)
+    clipped = periods["End"].where(following.isna() | (following > periods["End"]),
+                                   following - pd.Timedelta(days=1))
+    periods["Amount"] = periods["Amount"] * (((clipped - periods["Start"]).dt.days + 1)
+                                             / ((periods["End"] - periods["Start"]).dt.days + 1))
+    periods["End"] = clipped
+    return periods[periods["End"] >= periods["Start"]][columns].reset_index(drop=True)
+
+
+class BudgetIndex:
+    def __init__(self, periods, limits, total):
+        # periods from budgets.csv; limits are monthly per category, total
+        # the monthly budget for all spending
+        self.periods = periods
+        self.limits = dict(limits)
+        self.total = float(total)
+        self.scopes = list(dict.fromkeys([ALL] + sorted(self.limits) + sorted(periods["Scope"].unique())))
+        self._codes = pd.Index(self.scopes)
+        self._monthly = np.array([self.total] + [self.limits.get(scope, np.nan) for scope in self.scopes[1:]])
+        starts = self._keys(periods["Scope"], _days(periods["Start"]))
+        ends = self._keys(periods["Scope"], _days(periods["End"]))
+        self._index = pd.IntervalIndex.from_arrays(starts, ends, closed="both")
+        self._daily = (periods["Amount"] / (ends - starts + 1)).to_numpy(dtype="float64")
+
+    def _scope_codes(self, scopes):
+        # -1 for scopes with no budget anywhere
+        return self._codes.get_indexer(pd.Index(scopes, dtype=object)).astype("int64")
+
+    def _keys(self, scopes, days):
+        return self._scope_codes(scopes) * _SCOPE_DAYS + (days - _FIRST_DAY).astype("int64")
+
+    def daily(self, scopes, days):
+        """Each (scope, day) pair's share of the budget covering it, as an array.
+
+        A budgets.csv period shares its amount evenly over its days; other
+        days get the monthly limit over the days in their month, and scopes
+        with no budget at all get NaN.
+        """
+        days = _days(days)
+        codes = self._scope_codes(scopes)
+        found = self._index.get_indexer(codes * _SCOPE_DAYS + (days - _FIRST_DAY).astype("int64"))
+        monthly = np.where(codes >= 0, self._monthly[np.maximum(codes, 0)], np.nan)
+        fallback = monthly / _month_days(days)
+        return np.where((found >= 0) & (codes >= 0), self._daily[np.maximum(found, 0)] if len(self._daily) else 0,
+                        fallback)
+
+    def active(self, when, category=ALL):
+        """The budget covering date when for category (ALL for all spending):
+        a dict of Name, Start, End and Amount, or None if it has none.
+        """
+        day = _days([when])
+        found = self._index.get_indexer(self._keys([category], day))[0]
+        if found >= 0 and category in self._codes:
+            row = self.periods.iloc[found]
+            return {"Name": row["Name"], "Start": row["Start"], "End": row["End"], "Amount": float(row["Amount"])}
+        monthly = self.total if category == ALL else self.limits.get(category)
+        if monthly is None:
+            return None
+        month = pd.Period(pd.Timestamp(when), "M")
+        return {"Name": month.strftime("%B %Y"), "Start": month.start_time, "End": month.end_time.normalize(),
+                "Amount": float(monthly)}
+
+    def allowance(self, start, end, freq="M", categories=None):
+        """Budget per period from start to end (both inclusive) for all
+        spending, or for each of categories, in PERIOD_COLUMNS.
+
+        freq is a pandas period frequency such as "W", "M" or "Q", or a list
+        of (start, end) pairs for custom periods. Periods are cut to the
+        range, so a partial first or last period gets a partial budget.
+        """
+        days = np.arange(np.datetime64(pd.Timestamp(start).date(), "D"),
+                         np.datetime64(pd.Timestamp(end).date(), "D") + 1)
+        scopes = [ALL] if not categories else list(categories)
+        all_days = np.tile(days, len(scopes))
+        all_scopes = np.repeat(np.array(scopes, dtype=object), len(days))
+        frame = pd.DataFrame({
+            "Period": period_labels(all_days, freq),
+            "Category": all_scopes,
+            "Date": all_days,
+            "Budget": self.daily(all_scopes, all_days),
+        })
+        frame = frame[frame["Period"].notna()]
+        grouped = frame.groupby(["Period", "Category"], sort=False).agg(
+            Start=("Date", "min"), End=("Date", "max"), Budget=("Budget", "sum"), Days=("Budget", "count"))
+        grouped["Budget"] = grouped["Budget"].where(grouped["Days"] > 0)
+        return grouped.reset_index()[PERIOD_COLUMNS]
+
+    def month_budgets(self, key):
+        # Every scope's budget for month key (YYYYMM), with ALL for all spending
+        first = pd.Timestamp(year=key // 100, month=key % 100, day=1)
+        budgets = self.allowance(first, first + pd.offsets.MonthEnd(0), "M", self.scopes)
+        return dict(zip(budgets["Category"], budgets["Budget"].where(budgets["Budget"].notna(), None)))
+
+
+def period_labels(days, freq):
+    # A label per day: its pandas period, or its custom period as "start to
+    # end"; days outside every custom period get None
+    if isinstance(freq, str):
+        return pd.PeriodIndex(days, freq=FREQUENCIES.get(freq, freq)).astype(str)
+    periods = pd.IntervalIndex.from_arrays(
+        [np.datetime64(pd.Timestamp(first).date(), "D") for first, _ in freq],
+        [np.datetime64(pd.Timestamp(last).date(), "D") for _, last in freq], closed="both")
+    found = periods.get_indexer(days)
+    labels = np.array([f"{pd.Timestamp(first):%Y-%m-%d} to {pd.Timestamp(last):%Y-%m-%d}" for first, last in freq],
+                      dtype=object)
+    return np.where(found >= 0, labels[np.maximum(found, 0)] if len(labels) else None, None)
+
+
+@functools.lru_cache(maxsize=16)
+def _budget_index(path, version, rates, root_limits, tree_limits):
+    return BudgetIndex(_periods(path, version, rates), dict(tree_limits), sum(limit for _, limit in root_limits))
+
+
+def load_budgets(root_limits, path=BUDGETS_FILE, tree=None):
+    """The BudgetIndex for the app's monthly top-level limits, with
+    subcategory limits from the category tree and periods from budgets.csv.
+
+    Built once per file version and set of limits, so pages can call this
+    on every rerun. tree is load_category_tree(root_limits), if the caller
+    already has it.
+    """
+    tree = tree or load_category_tree(root_limits)
+    return _budget_index(path, budgets_version(path), rates_version(RATES_FILE), tuple(root_limits.items()),
+                         tuple(tree.limits.items()))
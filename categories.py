@@ -0,0 +1,130 @@
+import functools
+import os
+
+import pandas as pd
+
+from file_utils import file_version
+
+# The category tree from csv_collection/categories.csv, where parent_category
+# holds the category_id of the parent (Groceries and Dining Out under Food).
+# A closure index lists every (ancestor, category) pair once, so totals for
+# every subtree come from one merge and groupby over per-category sums
+# instead of re-filtering expenses once per node.
+
+CATEGORIES_FILE = os.environ.get("EXPENSE_CATEGORIES_FILE", os.path.join("csv_collection", "categories.csv"))
+
+CLOSURE_COLUMNS = ["Ancestor", "Category", "Depth"]
+
+
+class CategoryTree:
+    def __init__(self, parents, limits=None):
+        # parents maps every category to its parent's name, or None for a root
+        self.parents = dict(parents)
+        self.limits = dict(limits or {})
+        self._ancestors = {name: self._walk_up(name) for name in self.parents}
+        self._children = {name: [] for name in self.parents}
+        for name, parent in self.parents.items():
+            if parent is not None:
+                self._children[parent].append(name)
+        self.closure = pd.DataFrame(
+            [(ancestor, name, depth) for name, chain in self._ancestors.items()
+             for depth, ancestor in enumerate(chain)],
+            columns=CLOSURE_COLUMNS)
+        self._descendants = self.closure.groupby("Ancestor")["Category"].agg(list).to_dict()
+
+    def _walk_up(self, name):
+        # The category and its ancestors, nearest first; a cycle in the file
+        # is cut where it closes
+        chain = [name]
+        parent = self.parents.get(name)
+        while parent is not None and parent not in chain:
+            chain.append(parent)
+            parent = self.parents.get(parent)
+        return chain
+
+    def names(self):
+        # Depth-first, each parent followed by its children
+        ordered = []
+
+        def visit(name):
+            ordered.append(name)
+            for child in self._children[name]:
+                visit(child)
+        for root in self.roots():
+            visit(root)
+        return ordered
+
+    def roots(self):
+        return [name for name, parent in self.parents.items() if parent is None]
+
+    def children(self, name):
+        return list(self._children.get(name, []))
+
+    def ancestors(self, name):
+        # Categories outside the tree are their own root
+        return list(self._ancestors.get(name, [name]))
+
+    def descendants(self, name):
+        return list(self._descendants.get(name, [name]))
+
+    def depth(self, name):
+        return len(self.ancestors(name)) - 1
+
+    def expand(self, names):
+        # The given categories plus everything under them, for filters
+        return list(dict.fromkeys(category for name in names for category in self.descendants(name)))
+
+    def subtree_totals(self, totals):
+        """Per-category sums (a Series by Category, or a frame with a Category
+        column and other keys such as YearMonth) added up for every ancestor.
+
+        Categories missing from the tree count only towards themselves.
+        """
+        if isinstance(totals, pd.Series):
+            frame = totals.rename("Total").rename_axis("Category").reset_index()
+        else:
+            frame = totals
+        merged = frame.merge(self.closure[["Ancestor", "Category"]], on="Category", how="left")
+        merged["Ancestor"] = merged["Ancestor"].fillna(merged["Category"])
+        keys = [column for column in frame.columns if column not in ("Category", "Total", "Amount", "Count")]
+        values = [column for column in ("Total", "Amount", "Count") if column in frame.columns]
+        grouped = merged.groupby(keys + ["Ancestor"], sort=False)[values].sum()
+        grouped = grouped.rename_axis(index={"Ancestor": "Category"})
+        return grouped["Total"] if isinstance(totals, pd.Series) else grouped.reset_index()
+
+
+def category_file_version(path=CATEGORIES_FILE):
+    return file_version(path)
+
+
+@functools.lru_cache(maxsize=16)
+def _tree(path, version, root_limits):
+    parents = {name: None for name, _ in root_limits}
+    limits = dict(root_limits)
+    if version is not None:
+        rows = pd.read_csv(path, dtype=str, skipinitialspace=True)
+        rows.columns = [column.strip().lower() for column in rows.columns]
+        rows["name"] = rows["name"].str.strip()
+        by_id = dict(zip(rows["category_id"].str.strip(), rows["name"]))
+        blank = pd.Series(None, index=rows.index, dtype=object)
+        parent_ids = rows.get("parent_category", blank)
+        file_limits = pd.to_numeric(rows.get("budget_limit", blank), errors="coerce")
+        for name, parent_id, limit in zip(rows["name"], parent_ids, file_limits):
+            parent = by_id.get(str(parent_id).strip()) if pd.notna(parent_id) else None
+            parents[name] = parent if parent != name else None
+            # The app's own budgets win for top-level categories it already has
+            if pd.notna(limit) and not (parent is None and name in limits):
+                limits[name] = float(limit)
+    # A parent that isn't defined anywhere becomes a root of its own
+    for parent in [parent for parent in parents.values() if parent is not None and parent not in parents]:
+        parents[parent] = None
+    return CategoryTree(parents, limits)
+
+
+def load_category_tree(root_limits, path=CATEGORIES_FILE):
+    """The category tree with the app's top-level budgets as roots.
+
+    Built once per file version and set of budgets, so pages can call this
+    on every rerun.
+    """
+    return _tree(path, category_file_version(path), tuple(root_limits.items()))
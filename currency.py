@@ -0,0 +1,148 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+from expense_store import BASE_CURRENCY
+from file_utils import file_version
+from profiling import timed
+
+# Expenses carry the currency they were paid in and are converted only when
+# shown, through a dated rate table kept in csv_collection/fx_rates.csv so
+# nothing is fetched over the network. A rate is the value of one unit in
+# BASE_CURRENCY from its date until the next rate for that currency. Each
+# conversion looks up every row's rate at once with a binary search per
+# currency instead of per row.
+#
+# The table ships with only its header. Rates are added as date, currency
+# and rate rows from a source the user trusts, such as their bank or a
+# central bank's published reference rates, and a currency is offered once
+# it has at least one rate.
+
+RATES_FILE = os.environ.get("EXPENSE_RATES_FILE", os.path.join("csv_collection", "fx_rates.csv"))
+
+CURRENCY_SYMBOLS = {"USD": "$", "EUR": "€", "GBP": "£", "JPY": "¥"}
+
+# Currencies shown without cents
+WHOLE_UNITS = {"JPY"}
+
+
+def rates_version(path=RATES_FILE):
+    return file_version(path)
+
+
+@functools.lru_cache(maxsize=8)
+def _rates(path, version):
+    # currency -> (dates, rates), both sorted by date
+    if version is None:
+        return {}
+    frame = pd.read_csv(path, dtype=str, skipinitialspace=True)
+    frame.columns = [column.strip().lower() for column in frame.columns]
+    frame["date"] = pd.to_datetime(frame["date"], errors="coerce").values.astype("datetime64[D]")
+    frame["currency"] = frame["currency"].str.strip().str.upper()
+    frame["rate"] = pd.to_numeric(frame["rate"], errors="coerce")
+    frame = frame[frame["date"].notna() & (frame["rate"] > 0) & (frame["currency"] != BASE_CURRENCY)]
+    frame = frame.sort_values("date", kind="stable").drop_duplicates(["currency", "date"], keep="last")
+    return {code: (group["date"].to_numpy(dtype="datetime64[D]"), group["rate"].to_numpy(dtype="float64"))
+            for code, group in frame.groupby("currency")}
+
+
+def load_rates(path=RATES_FILE):
+    # The rate table as Date, Currency and Rate columns
+    table = _rates(path, rates_version(path))
+    return pd.DataFrame([(date, code, rate) for code, (dates, rates) in table.items()
+                         for date, rate in zip(dates, rates)], columns=["Date", "Currency", "Rate"])
+
+
+def currencies(path=RATES_FILE):
+    # The base currency first, then every currency with a rate
+    return [BASE_CURRENCY] + sorted(_rates(path, rates_version(path)))
+
+
+def base_rates(dates, codes, path=RATES_FILE):
+    """The BASE_CURRENCY value of one unit of codes[i] on dates[i], as an array.
+
+    Each row takes the latest rate dated on or before it; rows dated before
+    a currency's first rate take that first rate. Missing or blank codes
+    are BASE_CURRENCY. Raises ValueError for a currency with no rates.
+    """
+    table = _rates(path, rates_version(path))
+    days = pd.DatetimeIndex(dates).to_numpy(dtype="datetime64[D]")
+    # Categorical codes, so each currency's rows are found with one comparison
+    codes = pd.Categorical(codes)
+    result = np.ones(len(days))
+    used = {number: codes.categories[number] for number in np.unique(codes.codes[codes.codes >= 0])}
+    used = {number: code for number, code in used.items() if code not in ("", BASE_CURRENCY)}
+    missing = [code for code in used.values() if code not in table]
+    if missing:
+        raise ValueError(f"No exchange rate for {', '.join(sorted(missing))}")
+    for number, code in used.items():
+        rows = np.flatnonzero(codes.codes == number)
+        rate_dates, rates = table[code]
+        found = np.searchsorted(rate_dates, days[rows], side="right") - 1
+        result[rows] = rates[np.maximum(found, 0)]
+    return result
+
+
+def _repeat(code, count):
+    return pd.Categorical.from_codes(np.zeros(count, dtype="int8"), [code])
+
+
+def convert_amount(amount, source, target, when=None, path=RATES_FILE):
+    # One amount from currency source to target at the rates on when (today if omitted)
+    if source == target:
+        return float(amount)
+    when = [pd.Timestamp(when if when is not None else pd.Timestamp.now()).normalize()]
+    return float(amount * base_rates(when, [source], path)[0] / base_rates(when, [target], path)[0])
+
+
+@timed("convert currency")
+def convert(frame, target=BASE_CURRENCY, path=RATES_FILE):
+    """frame (with Date, Amount and optionally Currency columns) with every
+    Amount in target at the rate on its Date, and Currency set to target.
+
+    Frames already wholly in target are returned as they are.
+    """
+    if frame.empty:
+        return frame
+    codes = pd.Categorical(frame["Currency"] if "Currency" in frame else [None] * len(frame))
+    present = {code or BASE_CURRENCY for code in codes.categories[np.unique(codes.codes[codes.codes >= 0])]}
+    if (codes.codes < 0).any():
+        present.add(BASE_CURRENCY)
+    if present == {target}:
+        return frame
+    factors = base_rates(frame["Date"], codes, path)
+    if target != BASE_CURRENCY:
+        factors = factors / base_rates(frame["Date"], _repeat(target, len(frame)), path)
+    converted = frame.copy()
+    converted["Amount"] = frame["Amount"].to_numpy(dtype="float64") * factors
+    converted["Currency"] = _repeat(target, len(frame))
+    return converted
+
+
+def convert_rollup(rollup, target=BASE_CURRENCY, path=RATES_FILE):
+    """A store rollup with every currency's totals converted to target and
+    merged, still in the same columns.
+
+    Totals are converted at each month's closing rate (today's for the
+    current month), so they can differ by cents from converting each expense.
+    """
+    codes = rollup["Currency"].replace("", BASE_CURRENCY)
+    totals = rollup["Total"]
+    if not (codes == target).all():
+        months = pd.to_datetime(rollup["YearMonth"].clip(lower=101).astype(str), format="%Y%m", errors="coerce")
+        closing = (months + pd.offsets.MonthEnd(0)).clip(upper=pd.Timestamp.now().normalize())
+        totals = convert(pd.DataFrame({"Date": closing, "Amount": totals, "Currency": codes}), target, path)["Amount"]
+    converted = rollup.assign(Currency=target, Total=totals.to_numpy())
+    # Other key columns, such as all_users_rollup's User, are kept
+    keys = [column for column in rollup.columns if column not in ("Total", "Count")]
+    return converted.groupby(keys, as_index=False, sort=False)[["Total", "Count"]].sum()
+
+
+def format_money(amount, currency=BASE_CURRENCY):
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    digits = 0 if currency in WHOLE_UNITS else 2
+    text = f"{abs(amount):,.{digits}f}"
+    sign = "-" if amount < 0 else ""
+    return f"{sign}{symbol}{text}" if symbol else f"{sign}{text} {currency}"
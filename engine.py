@@ -0,0 +1,333 @@
+from datetime import datetime
+
+import pandas as pd
+
+from expense_store import (BASE_CURRENCY, SUMMARY_COLUMNS, add_to_spending_aggregates, format_year_month,
+                           get_store, new_spending_aggregates, year_month)
+from budgets import ALL, FREQUENCIES, load_budgets, period_labels
+from categories import load_category_tree
+from currency import convert, convert_amount, convert_rollup, format_money
+from profiling import timed
+from recurring import OCCURRENCE_COLUMNS, RECURRING_FILE, month_bounds, month_occurrences, occurrences, schedule_file
+
+# The app's calculations as plain functions over a store or a frame, with no
+# Streamlit involved. Main.py renders what they return; the CLI at the bottom
+# runs the same functions for scheduled jobs and scripts.
+#
+# Recurring charges come from recurring.py as occurrences expanded on demand.
+# Ones already due are expected to be in the store like any other expense, so
+# only those still to come this month are added on top. Functions taking a
+# schedule read it from that file, normally the store's own partition's, or
+# the shared one until it has its own (recurring.schedule_file); None means no
+# recurring charges at all.
+#
+# Budgets and recurring schedules are in BASE_CURRENCY. Functions taking a
+# currency return amounts converted to it through currency.py; budget checks
+# always compare in BASE_CURRENCY.
+
+BUDGET_LIMITS = {
+    "Food": 500,
+    "Transport": 200,
+    "Utilities": 300,
+    "Entertainment": 150,
+    "Shopping": 300,
+    "Healthcare": 200,
+    "Education": 250,
+    "Housing": 1000,
+    "Savings": 400,
+    "Insurance": 200,
+    "Subscriptions": 100,
+    "Personal Care": 150,
+    "Gifts": 100,
+    "Travel": 300,
+    "Other": 200
+}
+
+
+def monthly_budget(limits=BUDGET_LIMITS, key=None):
+    # The budget for all spending in month key, from budgets.csv where a
+    # period covers it and the sum of the monthly limits elsewhere
+    return float(load_budgets(limits).month_budgets(key or year_month())[ALL] or 0)
+
+
+def validate_expense(when, amount):
+    # The message to show for an expense that can't be saved, or None
+    try:
+        if float(amount) <= 0:
+            return "Amount must be positive"
+        if datetime.strptime(str(when), "%Y-%m-%d") > datetime.now():
+            return "Date cannot be in the future"
+    except ValueError:
+        return "Invalid amount format"
+    return None
+
+
+def upcoming_recurring(key=None, schedule=RECURRING_FILE):
+    # Charges scheduled in month key that haven't come due yet
+    if schedule is None:
+        return pd.DataFrame(columns=OCCURRENCE_COLUMNS)
+    return month_occurrences(key or year_month(), after=datetime.now(), path=schedule)
+
+
+def _metrics(total_balance, monthly_spend, recent, limits, key, currency=BASE_CURRENCY, schedule=RECURRING_FILE):
+    # The budget is converted at the month's closing rate, the same one the
+    # month's rollup totals use, so budget_used doesn't depend on currency
+    closing = min(month_bounds(key)[1], pd.Timestamp.now().normalize())
+    budget = convert_amount(monthly_budget(limits, key), BASE_CURRENCY, currency, closing)
+    upcoming = float(convert(upcoming_recurring(key, schedule), currency)["Amount"].sum())
+    return {
+        "total_balance": float(total_balance),
+        "monthly_spend": float(monthly_spend),
+        "budget_used": (monthly_spend / budget) * 100 if budget > 0 else 0,
+        "recent_activities": convert(recent.tail(5), currency).to_dict("records"),
+        "upcoming_recurring": upcoming,
+        "projected_spend": float(monthly_spend) + upcoming,
+        "currency": currency,
+    }
+
+
+@timed()
+def financial_metrics(store, data=None, key=None, limits=BUDGET_LIMITS, currency=BASE_CURRENCY,
+                      schedule=RECURRING_FILE):
+    """Dashboard figures in currency: total spent, spent in month key, budget
+    used, the five latest expenses and the recurring charges still to come in
+    the month.
+
+    Sums come from the month x category rollup instead of a table scan; data
+    is an already loaded frame to take the latest expenses from.
+    """
+    if data is None:
+        data = store.load(columns=SUMMARY_COLUMNS)
+    key = key or year_month()
+    rollup = convert_rollup(store.rollup(), currency)
+    monthly_spend = float(rollup.loc[rollup["YearMonth"] == key, "Total"].sum())
+    return _metrics(rollup["Total"].sum(), monthly_spend, data, limits, key, currency, schedule)
+
+
+def frame_metrics(frame, key=None, limits=BUDGET_LIMITS, currency=BASE_CURRENCY, schedule=None):
+    # The same figures for a frame that isn't in a store, such as a snapshot.
+    # A snapshot is history, so no recurring charges are added unless a
+    # schedule is passed.
+    key = key or year_month()
+    frame = convert(frame, currency)
+    monthly_spend = frame.loc[frame["YearMonth"] == key, "Amount"].sum()
+    return _metrics(frame["Amount"].sum(), monthly_spend, frame, limits, key, currency, schedule)
+
+
+def category_tree(limits=BUDGET_LIMITS):
+    # Subcategories from categories.csv under the top-level budget categories
+    return load_category_tree(limits)
+
+
+def budget_alert(store, amount, category, key=None, limits=BUDGET_LIMITS, currency=BASE_CURRENCY,
+                 schedule=RECURRING_FILE, tree=None):
+    """(name, limit) for the nearest of category and its parents whose
+    budget adding amount (in currency) would exceed, or None.
+
+    Each node is compared on its whole subtree for month key, counting the
+    recurring charges still to come, against its budget for that month.
+    tree is category_tree(limits), if the caller already has it.
+    """
+    tree = tree or category_tree(limits)
+    key = key or year_month()
+    budgets = load_budgets(limits, tree=tree).month_budgets(key)
+    checked = [name for name in tree.ancestors(category) if budgets.get(name) is not None]
+    if not checked:
+        return None
+    amount = convert_amount(amount, currency, BASE_CURRENCY)
+    spent = tree.subtree_totals(category_spending(store, key))
+    scheduled = tree.subtree_totals(upcoming_recurring(key, schedule).groupby("Category")["Amount"].sum())
+    for name in checked:
+        if spent.get(name, 0) + scheduled.get(name, 0) + amount > budgets[name]:
+            return name, budgets[name]
+    return None
+
+
+def category_spending(store, key=None, currency=BASE_CURRENCY):
+    rollup = convert_rollup(store.rollup(key or year_month()), currency)
+    return rollup.groupby("Category")["Total"].sum()
+
+
+def budget_comparison(spending, limits=BUDGET_LIMITS, scheduled=None, key=None, tree=None):
+    # Every category budgeted in month key, in tree order; parents count
+    # their whole subtree
+    tree = tree or category_tree(limits)
+    budgets = load_budgets(limits, tree=tree).month_budgets(key or year_month())
+    names = [name for name in tree.names() if budgets.get(name) is not None]
+    spending = tree.subtree_totals(spending)
+    comparison = pd.DataFrame({
+        "Category": names,
+        "Parent": [tree.parents.get(name) for name in names],
+        "Budget": [budgets[name] for name in names],
+        "Actual": [float(spending.get(name, 0)) for name in names],
+    })
+    if scheduled is not None:
+        scheduled = tree.subtree_totals(scheduled)
+        comparison["Scheduled"] = [float(scheduled.get(name, 0)) for name in names]
+    return comparison
+
+
+def budget_alerts(store, key=None, limits=BUDGET_LIMITS, schedule=RECURRING_FILE, tree=None):
+    # Categories over their limit in month key once the rest of the month's
+    # recurring charges come in
+    scheduled = upcoming_recurring(key, schedule).groupby("Category")["Amount"].sum()
+    comparison = budget_comparison(category_spending(store, key), limits, scheduled, key, tree)
+    comparison["Over"] = comparison["Actual"] + comparison["Scheduled"] - comparison["Budget"]
+    return comparison[comparison["Over"] > 0].reset_index(drop=True)
+
+
+@timed()
+def budget_vs_actual(store, start, end, freq="monthly", categories=None, limits=BUDGET_LIMITS, tree=None):
+    """Budget and spending per period from start to end, for all spending or
+    for each of categories (counting their subcategories), in BASE_CURRENCY.
+
+    freq is weekly, monthly, quarterly, yearly or another pandas period
+    frequency, or a list of (start, end) pairs for custom periods. Budgets
+    come from the BudgetIndex and spending from one query over the range,
+    both grouped by period in a single pass.
+    """
+    tree = tree or category_tree(limits)
+    budgets = load_budgets(limits, tree=tree).allowance(start, end, freq, categories)
+    expenses = convert(store.query(start=pd.Timestamp(start).date(), end=pd.Timestamp(end).date(),
+                                   categories=tree.expand(categories) if categories else None,
+                                   columns=SUMMARY_COLUMNS))
+    days = expenses["Date"].to_numpy(dtype="datetime64[D]")
+    if categories:
+        daily = expenses.groupby([days, expenses["Category"].astype(str)])["Amount"].sum()
+        daily = tree.subtree_totals(daily.rename_axis(["Date", "Category"]).reset_index())
+        daily = daily[daily["Category"].isin(list(categories))]
+    else:
+        daily = expenses.groupby(days)["Amount"].sum().rename_axis("Date").reset_index().assign(Category=ALL)
+    daily["Period"] = period_labels(daily["Date"].to_numpy(dtype="datetime64[D]"), freq)
+    actual = daily.groupby(["Period", "Category"])["Amount"].sum().rename("Actual")
+    comparison = budgets.join(actual, on=["Period", "Category"])
+    comparison["Actual"] = comparison["Actual"].fillna(0.0)
+    comparison["Remaining"] = comparison["Budget"] - comparison["Actual"]
+    return comparison
+
+
+@timed()
+def spending_forecast(store, months=3, history=3, currency=BASE_CURRENCY, schedule=RECURRING_FILE):
+    """Expected spending per category for each of the next months.
+
+    Scheduled is what the recurring schedules charge in that month; Other is
+    the average over the last history full months of everything else, taken
+    from the rollup with those months' recurring charges subtracted. Both are
+    worked out in BASE_CURRENCY and converted to currency at today's rate.
+    """
+    current = pd.Period(datetime.now(), "M")
+    past_start, past_end = (current - history).start_time, (current - 1).end_time
+    past_keys = [period.year * 100 + period.month for period in pd.period_range(current - history, current - 1)]
+    rollup = store.rollup()
+    rollup = convert_rollup(rollup[rollup["YearMonth"].isin(past_keys)])
+    actual = rollup.groupby("Category")["Total"].sum()
+    if schedule is not None:
+        recurring_past = occurrences(past_start, past_end, schedule).groupby("Category")["Amount"].sum()
+        ahead = occurrences((current + 1).start_time, (current + months).end_time, schedule)
+    else:
+        recurring_past = pd.Series(dtype="float64")
+        ahead = pd.DataFrame(columns=OCCURRENCE_COLUMNS)
+    other = (actual.sub(recurring_past, fill_value=0).clip(lower=0) / history).rename("Other")
+
+    scheduled = ahead.groupby(["YearMonth", "Category"])["Amount"].sum().rename("Scheduled")
+    keys = [period.year * 100 + period.month for period in pd.period_range(current + 1, current + months)]
+    categories = other.index.union(scheduled.index.get_level_values("Category").unique())
+    grid = pd.MultiIndex.from_product([keys, categories], names=["YearMonth", "Category"])
+    forecast = pd.DataFrame({
+        "Scheduled": scheduled.reindex(grid, fill_value=0.0),
+        "Other": other.reindex(grid.get_level_values("Category"), fill_value=0.0).to_numpy(),
+    }, index=grid)
+    forecast["Total"] = forecast["Scheduled"] + forecast["Other"]
+    forecast = forecast[forecast["Total"] > 0] * convert_amount(1.0, BASE_CURRENCY, currency)
+    return forecast.round(2).reset_index()
+
+
+@timed()
+def spending_aggregates(store, on_progress=None, currency=BASE_CURRENCY):
+    """Totals by category and by month x category plus the top five expenses,
+    added up over the store's chunks with each chunk converted to currency.
+
+    on_progress(step, aggregates) is called after each chunk with the
+    LoadProgress and the partial aggregates.
+    """
+    aggregates = new_spending_aggregates()
+    for step in store.stream(columns=SUMMARY_COLUMNS):
+        add_to_spending_aggregates(aggregates, convert(step.chunk, currency))
+        if on_progress is not None:
+            on_progress(step, aggregates)
+    return aggregates
+
+
+def _parse_month(text):
+    return year_month(datetime.strptime(text, "%Y-%m")) if text else None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from report_engine import build_report
+    from statement_import import import_statement, imported_ids_file
+
+    parser = argparse.ArgumentParser(description="Run the expense calculations without the app")
+    parser.add_argument("command", choices=["metrics", "alerts", "budget", "forecast", "aggregates", "report",
+                                            "ingest"])
+    parser.add_argument("path", nargs="?", help="CSV, OFX or QFX statement to ingest, or where to write the report or aggregates")
+    parser.add_argument("--user", help="partition to work on; the shared store if omitted")
+    parser.add_argument("--month", help="YYYY-MM for metrics and alerts; this month if omitted")
+    parser.add_argument("--currency", default=BASE_CURRENCY, help="currency to show amounts in")
+    parser.add_argument("--start", help="YYYY-MM-DD budget comparisons start on; January 1st if omitted")
+    parser.add_argument("--end", help="YYYY-MM-DD budget comparisons end on; today if omitted")
+    parser.add_argument("--freq", default="monthly", help="budget period: " + ", ".join(FREQUENCIES))
+    parser.add_argument("--category", action="append", help="compare this category's budget; repeatable")
+    args = parser.parse_args()
+
+    store = get_store(args.user)
+    schedule = schedule_file(args.user)
+    month = _parse_month(args.month)
+    if args.command == "metrics":
+        metrics = financial_metrics(store, key=month, currency=args.currency, schedule=schedule)
+        print(f"Total expenses  {format_money(metrics['total_balance'], args.currency)}")
+        print(f"Monthly spend   {format_money(metrics['monthly_spend'], args.currency)}")
+        print(f"Budget used     {metrics['budget_used']:.1f}%")
+        print(f"Recurring due   {format_money(metrics['upcoming_recurring'], args.currency)}")
+    elif args.command == "budget":
+        today = datetime.now()
+        comparison = budget_vs_actual(store, args.start or f"{today:%Y}-01-01", args.end or f"{today:%Y-%m-%d}",
+                                      args.freq, args.category)
+        comparison["Category"] = comparison["Category"].replace(ALL, "All")
+        print(comparison.drop(columns=["Start", "End"]).round(2).to_string(index=False))
+    elif args.command == "forecast":
+        forecast = spending_forecast(store, currency=args.currency, schedule=schedule)
+        if forecast.empty:
+            print("Nothing to forecast")
+        else:
+            forecast["Month"] = forecast["YearMonth"].map(format_year_month)
+            print(forecast.pivot(index="Category", columns="Month", values="Total").fillna(0).to_string())
+    elif args.command == "alerts":
+        alerts = budget_alerts(store, month, schedule=schedule)
+        label = format_year_month(month or year_month())
+        print(alerts.to_string(index=False) if not alerts.empty else f"No category is over budget in {label}")
+        raise SystemExit(1 if not alerts.empty else 0)
+    elif args.command == "aggregates":
+        aggregates = spending_aggregates(store, currency=args.currency)
+        if not aggregates["rows"]:
+            print("No expenses")
+        elif args.path:
+            aggregates["by_month"].round(2).rename("Amount").reset_index().to_csv(args.path, index=False)
+            print(f"Wrote monthly totals by category to {args.path}")
+        else:
+            print(aggregates["by_category"].sort_values(ascending=False).to_string())
+    elif not args.path:
+        parser.error(f"{args.command} needs a path")
+    elif args.command == "report":
+        with open(args.path, "wb") as f:
+            f.write(build_report(store))
+        print(f"Wrote {args.path}")
+    else:
+        try:
+            result = import_statement(store, args.path, ids_file=imported_ids_file(args.user))
+        except ValueError as e:
+            raise SystemExit(f"Could not read the statement: {e}")
+        print(f"Inserted {result.inserted:,} expenses")
+        if not result.errors.empty:
+            print(f"Rejected {len(result.errors):,} rows\n{result.errors.to_string(index=False)}")
@@ -0,0 +1,1310 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # the journal's base file stays CSV
+    pa = None
+
+from file_utils import file_version, temp_path
+
+# Streamlit re-executes Main.py on every interaction, so anything that has to
+# outlive a rerun (open files, locks, the background compactor) lives here.
+
+EXPENSE_COLUMNS = ["Date", "Amount", "Category", "Receipt", "Currency"]
+
+# What an expense with no Currency is in; budgets are set in it too
+BASE_CURRENCY = os.environ.get("EXPENSE_BASE_CURRENCY", "USD")
+
+# "sqlite" keeps expenses in expenses.db; "journal" keeps the CSV plus journal
+EXPENSE_BACKEND = os.environ.get("EXPENSE_BACKEND", "sqlite")
+
+# Fold the journal back into the base file once it holds this many batches
+COMPACT_EVERY = 500
+
+# Rows per chunk handed out by store.stream()
+STREAM_CHUNK_ROWS = 50_000
+
+# What the dashboards read; leaves out the Receipt column
+SUMMARY_COLUMNS = ["Date", "Amount", "Category", "Currency"]
+
+
+class ConflictError(Exception):
+    # A row changed after the caller read it, so its edit was not applied
+    pass
+
+
+class FileLock:
+    """Lock shared by every thread and process using the same path.
+
+    `with lock:` takes it exclusively, for writers; `with lock.shared():`
+    lets readers in other processes hold it at the same time. Within a
+    process, threads still take turns, since they share in-memory state.
+    Re-entrant within a thread, so store methods can call each other while
+    holding it; a nested hold keeps the outermost mode.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._exclusive = False
+        self._file = None
+
+    def _acquire(self, exclusive):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, "a+b")
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                else:
+                    # msvcrt only has exclusive locks, so readers take turns on Windows
+                    self._file.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                self._thread_lock.release()
+                raise
+            self._exclusive = exclusive
+        elif exclusive and not self._exclusive:
+            self._thread_lock.release()
+            raise RuntimeError(f"{self.path} is held shared and can't be taken exclusively")
+        self._depth += 1
+        return self
+
+    def _release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        return self._acquire(exclusive=True)
+
+    def __exit__(self, *exc):
+        self._release()
+
+    @contextmanager
+    def shared(self):
+        self._acquire(exclusive=False)
+        try:
+            yield self
+        finally:
+            self._release()
+
+
+def _same_value(column, current, expected):
+    if current is None or expected is None:
+        return current is None and expected is None
+    if column == "Amount":
+        return abs(float(current) - float(expected)) < 1e-9
+    if column == "Date":
+        return pd.Timestamp(current) == pd.Timestamp(expected)
+    return str(current) == str(expected)
+
+
+def _check_expected(expense_id, row, expect):
+    # Optimistic check: the row must still hold the values the caller saw
+    if row is None:
+        raise ConflictError(f"Transaction {expense_id} no longer exists")
+    for column, value in expect.items():
+        if not _same_value(column, row.get(column), value):
+            raise ConflictError(f"Transaction {expense_id} was changed by someone else")
+
+
+def empty_frame():
+    frame = pd.DataFrame(columns=EXPENSE_COLUMNS)
+    frame.index.name = "id"
+    return frame
+
+
+def year_month(when=None):
+    # Months are compared as integers like 202504 rather than "2025-04" strings
+    when = when or datetime.now()
+    return when.year * 100 + when.month
+
+
+def format_year_month(key):
+    return f"{key // 100}-{key % 100:02d}"
+
+
+def _row_year_month(date):
+    try:
+        return int(date[:4]) * 100 + int(date[5:7])
+    except (TypeError, ValueError):
+        return 0
+
+
+def typed_frame(frame):
+    # Parse once at load time so pages never re-run pd.to_datetime on Date.
+    # Frames read with a column projection only convert what they have.
+    frame = frame.copy()
+    if "Date" in frame:
+        dates = pd.to_datetime(frame["Date"], errors="coerce")
+        frame["Date"] = dates
+        frame["YearMonth"] = (dates.dt.year * 100 + dates.dt.month).fillna(0).astype("int64")
+    if "Amount" in frame:
+        frame["Amount"] = pd.to_numeric(frame["Amount"], errors="coerce").fillna(0.0).astype("float64")
+    if "Category" in frame:
+        frame["Category"] = frame["Category"].astype("category")
+    if "Currency" in frame:
+        frame["Currency"] = frame["Currency"].fillna(BASE_CURRENCY).astype("category")
+    return frame
+
+
+def _projection(columns):
+    # Expense columns to keep, in table order, plus the derived YearMonth
+    if columns is None:
+        return None
+    kept = [column for column in EXPENSE_COLUMNS if column in columns]
+    return kept + ["YearMonth"] if "Date" in kept else kept
+
+
+def _clean_value(value):
+    # Journal records are JSON, so dates and numpy scalars become plain values
+    if value is None:
+        return None
+    if not isinstance(value, (str, bytes)) and pd.isna(value):
+        return None
+    if hasattr(value, "strftime"):
+        return value.strftime("%Y-%m-%d")
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def clean_row(row):
+    return {column: _clean_value(row[column]) for column in EXPENSE_COLUMNS if column in row}
+
+
+def expense_filter(start=None, end=None, categories=None, ids=None):
+    # Plain-JSON description of a set of rows, used by the bulk ops
+    # update_where, delete_where and shift_dates
+    return {
+        "start": _clean_value(start),
+        "end": _clean_value(end),
+        "categories": list(categories) if categories else None,
+        "ids": [int(expense_id) for expense_id in ids] if ids is not None else None,
+    }
+
+
+def _row_matches(expense_id, row, where):
+    date = row.get("Date") or ""
+    if where.get("start") is not None and date < where["start"]:
+        return False
+    if where.get("end") is not None and date > where["end"]:
+        return False
+    if where.get("categories") and row.get("Category") not in where["categories"]:
+        return False
+    if where.get("ids") is not None and expense_id not in where["ids"]:
+        return False
+    return True
+
+
+def _shift_date(date, days):
+    return (datetime.strptime(date[:10], "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def _filter_mask(frame, start=None, end=None, categories=None):
+    mask = pd.Series(True, index=frame.index)
+    if start is not None:
+        mask &= frame["Date"] >= pd.Timestamp(_clean_value(start))
+    if end is not None:
+        mask &= frame["Date"] <= pd.Timestamp(_clean_value(end))
+    if categories:
+        mask &= frame["Category"].isin(list(categories))
+    return mask
+
+
+class LoadProgress(namedtuple("LoadProgress", "chunk rows total_rows bytes_read total_bytes")):
+    # One step of store.stream(): a typed chunk plus how far the read has got.
+    # Byte counts are only known when reading a file, row totals when the
+    # store can count up front.
+
+    @property
+    def fraction(self):
+        if self.total_bytes:
+            return min(self.bytes_read / self.total_bytes, 1.0)
+        if self.total_rows:
+            return min(self.rows / self.total_rows, 1.0)
+        return 0.0
+
+
+def _records_frame(records):
+    if not records:
+        return typed_frame(empty_frame())
+    frame = pd.DataFrame.from_dict(records, orient="index", columns=EXPENSE_COLUMNS)
+    frame.index.name = "id"
+    return typed_frame(frame)
+
+
+def _write_arrow(frame, path):
+    # Uncompressed Arrow IPC, cut into STREAM_CHUNK_ROWS batches, so readers
+    # can memory-map it and take one batch at a time without decoding
+    dates = frame["Date"].dt.strftime("%Y-%m-%d")
+    table = pa.table({
+        "id": pa.array(frame.index.to_numpy(dtype="int64")),
+        "Date": pa.array(dates.where(dates.notna(), None).tolist(), pa.string()),
+        "Amount": pa.array(frame["Amount"].to_numpy(dtype="float64")),
+        "Category": pa.array(frame["Category"].astype(object).where(frame["Category"].notna(), None).tolist(),
+                             pa.string()).dictionary_encode(),
+        "Receipt": pa.array(frame["Receipt"].astype(object).where(frame["Receipt"].notna(), None).tolist(),
+                            pa.string()),
+        "Currency": pa.array(frame["Currency"].astype(object).where(frame["Currency"].notna(), None).tolist(),
+                             pa.string()).dictionary_encode(),
+    })
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=STREAM_CHUNK_ROWS)
+
+
+def _chunk_frame(frame, chunk_rows):
+    total = len(frame)
+    for start in range(0, total, chunk_rows):
+        chunk = frame.iloc[start:start + chunk_rows]
+        yield LoadProgress(chunk, start + len(chunk), total, None, None)
+
+
+# Totals are per currency; converting them is left to the reader (currency.py)
+ROLLUP_COLUMNS = ["YearMonth", "Category", "Currency", "Total", "Count"]
+
+
+def _rollup_frame(records):
+    return pd.DataFrame(records, columns=ROLLUP_COLUMNS)
+
+
+def _rollup_diff(stored, fresh):
+    # Rows where the maintained rollup disagrees with a full recount
+    merged = stored.merge(fresh, on=["YearMonth", "Category", "Currency"], how="outer",
+                          suffixes=("Stored", "Actual")).fillna(0)
+    bad = ((merged["TotalStored"] - merged["TotalActual"]).abs() > 0.005) | \
+        (merged["CountStored"] != merged["CountActual"])
+    return merged[bad].reset_index(drop=True)
+
+
+def new_spending_aggregates():
+    return {"rows": 0, "by_category": None, "by_month": None, "top": None}
+
+
+def _add_spending_sums(current, new):
+    return new if current is None else current.add(new, fill_value=0)
+
+
+def add_to_spending_aggregates(aggregates, chunk):
+    # Sums over streamed chunks add up to the totals over the whole table
+    if chunk.empty:
+        return
+    categories = chunk["Category"].astype(str)
+    aggregates["rows"] += len(chunk)
+    aggregates["by_category"] = _add_spending_sums(
+        aggregates["by_category"], chunk.groupby(categories)["Amount"].sum())
+    aggregates["by_month"] = _add_spending_sums(
+        aggregates["by_month"], chunk.groupby([chunk["YearMonth"], categories])["Amount"].sum())
+    top = chunk.nlargest(5, "Amount")
+    aggregates["top"] = top if aggregates["top"] is None else pd.concat([aggregates["top"], top]).nlargest(5, "Amount")
+
+
+def update_op(expense_id, changes, expect=None):
+    # expect holds the values the caller last saw; the store refuses the
+    # change with ConflictError if the row no longer matches them
+    op = {"op": "update", "id": int(expense_id), "row": clean_row(changes)}
+    if expect is not None:
+        op["expect"] = clean_row(expect)
+    return op
+
+
+def delete_op(expense_id, expect=None):
+    op = {"op": "delete", "id": int(expense_id)}
+    if expect is not None:
+        op["expect"] = clean_row(expect)
+    return op
+
+
+class ExpenseStore:
+    # Single-row helpers; every backend funnels them through apply()
+
+    def loaded(self):
+        # False while a first read still has the whole store to parse
+        return True
+
+    def month_total(self, key, categories=None):
+        rollup = self.rollup(key, categories)
+        return float(rollup["Total"].sum())
+
+    def verify_rollup(self):
+        return _rollup_diff(self.rollup(), self._count_rollup())
+
+    def insert(self, row):
+        return self.apply([{"op": "insert", "row": clean_row(row)}])[0]
+
+    def update(self, expense_id, changes):
+        self.apply([update_op(expense_id, changes)])
+
+    def delete(self, expense_id):
+        self.apply([delete_op(expense_id)])
+
+    def clear(self):
+        self.apply([{"op": "clear"}])
+
+    def replace_all(self, frame, keep_ids=False):
+        ops = [{"op": "clear"}]
+        if keep_ids:
+            ops.extend({"op": "insert", "id": int(expense_id), "row": clean_row(row)}
+                       for expense_id, row in frame.to_dict("index").items())
+        else:
+            ops.extend({"op": "insert", "row": clean_row(row)} for row in frame.to_dict("records"))
+        self.apply(ops)
+
+
+class JournalStore(ExpenseStore):
+    """Expenses kept as a base CSV plus an append-only journal of change batches.
+
+    Every write appends one JSON line to the journal, so adding, editing or
+    deleting an expense costs the same no matter how much history exists. A
+    background thread periodically folds the journal into the base file.
+    """
+
+    def __init__(self, base_path="expenses.csv", journal_path="expenses.journal"):
+        self.base_path = base_path
+        # Compaction writes the base as Arrow IPC when pyarrow is installed
+        self.arrow_path = os.path.splitext(base_path)[0] + ".arrow"
+        self.journal_path = journal_path
+        # Guards the journal across threads and server processes alike
+        self._lock = FileLock(journal_path + ".lock")
+        self._journal_id = None
+        self._rows = None
+        self._frame = None
+        self._rollup = {}
+        self._offset = 0
+        self._batches = 0
+        self._next_id = 0
+        self._compactor = None
+
+    # Reading
+
+    def _base_file(self):
+        if os.path.exists(self.arrow_path):
+            if pa is None:
+                # Compaction removed the CSV this replaced, so reading on
+                # without pyarrow would show an empty store
+                raise RuntimeError(f"{self.arrow_path} holds the expenses; install pyarrow to read it")
+            return self.arrow_path
+        return self.base_path
+
+    def _base_chunks(self, chunk_rows=STREAM_CHUNK_ROWS):
+        # Yields (rows by id, bytes parsed so far, file size)
+        if self._base_file() == self.arrow_path:
+            yield from self._arrow_chunks()
+        else:
+            yield from self._csv_chunks(chunk_rows)
+
+    def _arrow_chunks(self):
+        # The file is memory-mapped, so record batches are views onto the
+        # page cache and nothing is parsed; batches were cut at write time
+        with pa.memory_map(self.arrow_path) as source:
+            reader = pa.ipc.open_file(source)
+            total_bytes = source.size()
+            batches = reader.num_record_batches
+            for number in range(batches):
+                columns = reader.get_batch(number).to_pydict()
+                # Files written before a column existed read it as empty
+                blank = [None] * len(columns["id"])
+                rows = {expense_id: dict(zip(EXPENSE_COLUMNS, values))
+                        for expense_id, *values in zip(columns["id"], *(columns.get(c, blank) for c in EXPENSE_COLUMNS))}
+                yield rows, total_bytes * (number + 1) // batches, total_bytes
+
+    def _csv_chunks(self, chunk_rows):
+        try:
+            f = open(self.base_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            total_bytes = os.fstat(f.fileno()).st_size
+            try:
+                for frame in pd.read_csv(f, chunksize=chunk_rows):
+                    if "id" in frame.columns:
+                        frame = frame.set_index("id")
+                    for column in EXPENSE_COLUMNS:
+                        if column not in frame.columns:
+                            frame[column] = None
+                    frame = frame[EXPENSE_COLUMNS].astype(object)
+                    frame = frame.where(frame.notna(), None)
+                    rows = {int(index): row for index, row in frame.to_dict("index").items()}
+                    yield rows, f.tell(), total_bytes
+            except pd.errors.EmptyDataError:
+                return
+
+    def _read_base(self):
+        rows = {}
+        for chunk, _, _ in self._base_chunks():
+            rows.update(chunk)
+        return rows
+
+    def _scan_journal(self):
+        # Parsed batches, bytes they span, ids they touch and whether one clears
+        try:
+            with open(self.journal_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        end = data.rfind(b"\n") + 1
+        batches = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+        batches = [batch for batch in batches if "ops" in batch]
+        touched = set()
+        cleared = False
+        for batch in batches:
+            for op in batch["ops"]:
+                if op["op"] == "clear":
+                    cleared = True
+                elif "id" in op:
+                    touched.add(op["id"])
+        return batches, end, touched, cleared
+
+    def _read_journal(self):
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(self._offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return
+        # A line without its newline is a batch still being written; leave it
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            if line.strip():
+                batch = json.loads(line)
+                if "ops" in batch:
+                    self._replay(batch)
+                    self._batches += 1
+        self._offset += end
+
+    def _install(self, rows):
+        self._rows = rows
+        self._frame = None
+        self._offset = 0
+        self._batches = 0
+        self._next_id = max(self._rows, default=-1) + 1
+        self._rollup = self._count_rollup_dict()
+
+    def _journal_identity(self):
+        # Compaction starts each journal with a fresh generation line; appends
+        # never touch it, so a new generation means someone else compacted
+        try:
+            with open(self.journal_path, "rb") as f:
+                first = f.readline()
+        except FileNotFoundError:
+            return None
+        if first.startswith(b'{"generation"') and first.endswith(b"\n"):
+            return json.loads(first)["generation"]
+        return None
+
+    def _refresh(self):
+        identity = self._journal_identity()
+        if self._rows is not None and identity != self._journal_id:
+            # Another process compacted: our offset means nothing in the new journal
+            self._rows = None
+        if self._rows is None:
+            self._install(self._read_base())
+        self._journal_id = identity
+        self._read_journal()
+
+    def version(self):
+        # Changes whenever the data can have: every append grows the journal
+        # and every compaction rewrites the base. Worked out from file stats
+        # alone, so asking doesn't read a cold store ahead of stream().
+        versions = [file_version(path) for path in (self._base_file(), self.journal_path)]
+        return "-".join(f"{version[0]}-{version[1]}" if version else "0" for version in versions)
+
+    def loaded(self):
+        with self._lock.shared():
+            return self._rows is not None
+
+    def stream(self, chunk_rows=STREAM_CHUNK_ROWS, columns=None):
+        if columns is not None:
+            keep = _projection(columns)
+            for progress in self.stream(chunk_rows):
+                yield progress._replace(chunk=progress.chunk[keep])
+            return
+        if self.loaded():
+            yield from _chunk_frame(self.load(), chunk_rows)
+            return
+        # Cold start: hand out base rows the journal never touches as soon as
+        # they are parsed, and the touched ones once the journal is replayed
+        identity = self._journal_identity()
+        batches, end, touched, cleared = self._scan_journal()
+        rows = {}
+        total_bytes = 0
+        if not cleared:
+            for records, bytes_read, total_bytes in self._base_chunks(chunk_rows):
+                rows.update(records)
+                untouched = {i: row for i, row in records.items() if i not in touched}
+                yield LoadProgress(_records_frame(untouched), len(rows), None, bytes_read, total_bytes)
+        scratch = JournalStore(self.base_path, self.journal_path)
+        scratch._install(rows)
+        for batch in batches:
+            scratch._replay(batch)
+            scratch._batches += 1
+        scratch._offset = end
+        with self._lock.shared():
+            if self._rows is None:
+                self._rows, self._rollup = scratch._rows, scratch._rollup
+                self._offset, self._batches, self._next_id = scratch._offset, scratch._batches, scratch._next_id
+                self._frame = None
+                self._journal_id = identity
+        if cleared:
+            changed = scratch._rows
+        else:
+            changed = {i: scratch._rows[i] for i in touched if i in scratch._rows}
+        total = len(scratch._rows)
+        yield LoadProgress(_records_frame(changed), total, total, total_bytes, total_bytes)
+
+    # The month x category x currency rollup is kept in memory and moved row by row as
+    # batches are replayed, so spending sums never rescan the expenses
+
+    def _count_rollup_dict(self):
+        rollup = {}
+        for row in self._rows.values():
+            self._roll(rollup, row, 1)
+        return rollup
+
+    def _roll(self, rollup, row, sign):
+        key = (_row_year_month(row.get("Date")), row.get("Category") or "", row.get("Currency") or "")
+        total, count = rollup.get(key, (0.0, 0))
+        total += sign * float(row.get("Amount") or 0)
+        count += sign
+        if count > 0:
+            rollup[key] = (total, count)
+        else:
+            rollup.pop(key, None)
+
+    def _replay(self, batch):
+        # Replaying a batch twice leaves the same rows behind, which is what
+        # makes a crash in the middle of compaction harmless
+        for op in batch["ops"]:
+            kind = op["op"]
+            old = self._rows.get(op.get("id"))
+            if old is not None and kind != "clear":
+                self._roll(self._rollup, old, -1)
+            if kind == "insert":
+                row = {column: op["row"].get(column) for column in EXPENSE_COLUMNS}
+                self._rows[op["id"]] = row
+                self._roll(self._rollup, row, 1)
+                self._next_id = max(self._next_id, op["id"] + 1)
+            elif kind == "update":
+                if old is not None:
+                    old.update(op["row"])
+                    self._roll(self._rollup, old, 1)
+            elif kind == "delete":
+                self._rows.pop(op["id"], None)
+            elif kind == "clear":
+                self._rows.clear()
+                self._rollup.clear()
+        self._frame = None
+
+    def load(self, columns=None):
+        with self._lock.shared():
+            self._refresh()
+            if self._frame is None:
+                self._frame = _records_frame(self._rows)
+            if columns is not None:
+                # Selecting first means unused columns are never copied
+                return self._frame[_projection(columns)].copy()
+            return self._frame.copy()
+
+    def query(self, start=None, end=None, categories=None, sort=None, descending=False, limit=None, offset=0,
+              columns=None):
+        frame = self.load()
+        frame = frame[_filter_mask(frame, start, end, categories)]
+        if columns is not None:
+            frame = frame[_projection(columns)]
+        if sort is not None:
+            frame = frame.sort_values(sort, ascending=not descending, kind="stable")
+        if limit is not None or offset:
+            frame = frame.iloc[offset:None if limit is None else offset + limit]
+        return frame
+
+    def count(self, start=None, end=None, categories=None):
+        frame = self.load()
+        return int(_filter_mask(frame, start, end, categories).sum())
+
+    def total(self, start=None, end=None, categories=None):
+        return float(self.query(start, end, categories)["Amount"].sum())
+
+    def get(self, expense_id):
+        with self._lock.shared():
+            self._refresh()
+            row = self._rows.get(int(expense_id))
+            return dict(row) if row is not None else None
+
+    def rollup(self, key=None, categories=None):
+        with self._lock.shared():
+            self._refresh()
+            records = [(month, category, currency, total, count)
+                       for (month, category, currency), (total, count) in self._rollup.items()
+                       if (key is None or month == key) and (not categories or category in categories)]
+        return _rollup_frame(records)
+
+    def _count_rollup(self):
+        with self._lock.shared():
+            self._refresh()
+            rollup = self._count_rollup_dict()
+        return _rollup_frame([(month, category, currency, total, count)
+                              for (month, category, currency), (total, count) in rollup.items()])
+
+    def rebuild_rollup(self):
+        with self._lock.shared():
+            self._refresh()
+            self._rollup = self._count_rollup_dict()
+
+    # Writing
+
+    def _expand(self, op):
+        # Bulk ops are written out as the per-row changes they resolve to, so
+        # replaying a batch stays idempotent (a date shift must not apply twice)
+        kind = op["op"]
+        if kind == "insert" and op.get("id") is None:
+            return [dict(op, id=self._next_id)]
+        if kind not in ("update_where", "delete_where", "shift_dates"):
+            return [op]
+        expanded = []
+        ids = op["where"].get("ids")
+        if ids is not None:
+            # An id list picks rows out directly instead of testing every row
+            candidates = [(expense_id, self._rows[expense_id]) for expense_id in ids if expense_id in self._rows]
+        else:
+            candidates = self._rows.items()
+        for expense_id, row in candidates:
+            if not _row_matches(expense_id, row, op["where"]):
+                continue
+            if kind == "update_where":
+                expanded.append({"op": "update", "id": expense_id, "row": op["row"]})
+            elif kind == "delete_where":
+                expanded.append({"op": "delete", "id": expense_id})
+            elif row.get("Date"):
+                new_date = _shift_date(row["Date"], op["days"])
+                expanded.append({"op": "update", "id": expense_id, "row": {"Date": new_date}})
+        return expanded
+
+    def _stage(self, ops):
+        # Checks ops against the rows in memory and applies them there;
+        # returns the per-row changes to journal and the ids inserted
+        for op in ops:
+            if op.get("expect"):
+                _check_expected(op["id"], self._rows.get(op["id"]), op["expect"])
+        written = []
+        ids = []
+        # Each op sees the effect of the ones before it, as in SQLite
+        for op in ops:
+            op = {key: value for key, value in op.items() if key != "expect"}
+            for change in self._expand(op):
+                self._replay({"ops": [change]})
+                written.append(change)
+                if change["op"] == "insert":
+                    ids.append(change["id"])
+        return written, ids
+
+    def apply(self, ops, expected_version=None):
+        # All ops go out as a single journal line, so a batch lands whole or not at all
+        with self._lock:
+            self._refresh()
+            if expected_version is not None and self.version() != expected_version:
+                raise ConflictError("The expenses were changed by someone else")
+            try:
+                written, ids = self._stage(ops)
+                line = (json.dumps({"ops": written}) + "\n").encode("utf-8")
+                with open(self.journal_path, "ab") as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception:
+                # Forget the half-applied batch; the next read starts from disk
+                self._rows = None
+                self._frame = None
+                raise
+            self._offset += len(line)
+            self._batches += 1
+            if self._batches >= COMPACT_EVERY:
+                self._start_compaction()
+            return ids
+
+    def apply_chunks(self, chunks, expected_version=None):
+        """Applies each list of ops in chunks in turn, all or nothing.
+
+        For batches too large for one journal line, such as a restore: every
+        chunk becomes its own line in a copy of the journal, and the copy
+        replaces the journal only once the last chunk is written.
+        """
+        with self._lock:
+            self._refresh()
+            if expected_version is not None and self.version() != expected_version:
+                raise ConflictError("The expenses were changed by someone else")
+            tmp = temp_path(self.journal_path)
+            ids = []
+            batches = 0
+            try:
+                try:
+                    shutil.copyfile(self.journal_path, tmp)
+                except FileNotFoundError:
+                    pass
+                with open(tmp, "ab") as f:
+                    # Anything past the offset is a line a crashed writer left unfinished
+                    f.truncate(self._offset)
+                    for ops in chunks:
+                        written, chunk_ids = self._stage(ops)
+                        f.write((json.dumps({"ops": written}) + "\n").encode("utf-8"))
+                        ids.extend(chunk_ids)
+                        batches += 1
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = f.tell()
+                os.replace(tmp, self.journal_path)
+            except BaseException:
+                self._rows = None
+                self._frame = None
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            # Other processes read on from their offsets: everything before
+            # ours is unchanged, so the new lines simply follow
+            self._offset = size
+            self._batches += batches
+            if self._batches >= COMPACT_EVERY:
+                self._start_compaction()
+            return ids
+
+    # Compaction
+
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name="expense-compactor", daemon=True)
+        self._compactor.start()
+
+    def compact(self):
+        with self._lock:
+            frame = self.load()
+            offset = self._offset
+            identity = self._journal_id
+        # Writing the base is the slow part, so appends keep going meanwhile
+        base = self.arrow_path if pa is not None else self.base_path
+        base_tmp = temp_path(base)
+        if pa is not None:
+            _write_arrow(frame, base_tmp)
+            # Read back before anything is replaced, since the CSV goes once it is in place
+            with pa.memory_map(base_tmp) as source:
+                written = pa.ipc.open_file(source).read_all().num_rows
+            if written != len(frame):
+                os.remove(base_tmp)
+                raise OSError(f"{base_tmp} did not read back whole")
+        else:
+            frame.to_csv(base_tmp, index_label="id")
+        with self._lock:
+            self._refresh()
+            if self._journal_id != identity:
+                # Another process compacted first
+                os.remove(base_tmp)
+                return
+            # Batches appended while the base was written carry over
+            try:
+                with open(self.journal_path, "rb") as f:
+                    f.seek(offset)
+                    tail = f.read(self._offset - offset)
+            except FileNotFoundError:
+                tail = b""
+            header = (json.dumps({"generation": uuid.uuid4().hex}) + "\n").encode("utf-8")
+            journal_tmp = temp_path(self.journal_path)
+            with open(journal_tmp, "wb") as f:
+                f.write(header + tail)
+                f.flush()
+                os.fsync(f.fileno())
+            # Base first: if we die between the two renames the old journal
+            # is simply replayed on top of the new base
+            os.replace(base_tmp, base)
+            os.replace(journal_tmp, self.journal_path)
+            if base != self.base_path and os.path.exists(self.base_path):
+                # The CSV base this Arrow file replaces
+                os.remove(self.base_path)
+            self._journal_id = self._journal_identity()
+            self._offset = len(header) + len(tail)
+            self._batches = tail.count(b"\n")
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY,
+    date TEXT,
+    amount REAL,
+    category TEXT,
+    receipt TEXT,
+    currency TEXT
+);
+CREATE INDEX IF NOT EXISTS expenses_date ON expenses(date);
+CREATE INDEX IF NOT EXISTS expenses_category_date ON expenses(category, date);
+CREATE INDEX IF NOT EXISTS expenses_amount ON expenses(amount);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+
+CREATE TABLE IF NOT EXISTS expense_rollup (
+    year_month INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    total REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (year_month, category, currency)
+);
+
+CREATE TRIGGER IF NOT EXISTS expenses_rollup_insert AFTER INSERT ON expenses BEGIN
+    INSERT INTO expense_rollup (year_month, category, currency, total, count)
+    VALUES ({new_month}, IFNULL(NEW.category, ''), IFNULL(NEW.currency, ''), IFNULL(NEW.amount, 0), 1)
+    ON CONFLICT (year_month, category, currency) DO UPDATE
+    SET total = total + excluded.total, count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS expenses_rollup_delete AFTER DELETE ON expenses BEGIN
+    UPDATE expense_rollup SET total = total - IFNULL(OLD.amount, 0), count = count - 1
+    WHERE year_month = {old_month} AND category = IFNULL(OLD.category, '') AND currency = IFNULL(OLD.currency, '');
+    DELETE FROM expense_rollup
+    WHERE year_month = {old_month} AND category = IFNULL(OLD.category, '') AND currency = IFNULL(OLD.currency, '')
+    AND count <= 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS expenses_rollup_update AFTER UPDATE OF date, amount, category, currency ON expenses BEGIN
+    UPDATE expense_rollup SET total = total - IFNULL(OLD.amount, 0), count = count - 1
+    WHERE year_month = {old_month} AND category = IFNULL(OLD.category, '') AND currency = IFNULL(OLD.currency, '');
+    DELETE FROM expense_rollup
+    WHERE year_month = {old_month} AND category = IFNULL(OLD.category, '') AND currency = IFNULL(OLD.currency, '')
+    AND count <= 0;
+    INSERT INTO expense_rollup (year_month, category, currency, total, count)
+    VALUES ({new_month}, IFNULL(NEW.category, ''), IFNULL(NEW.currency, ''), IFNULL(NEW.amount, 0), 1)
+    ON CONFLICT (year_month, category, currency) DO UPDATE
+    SET total = total + excluded.total, count = count + 1;
+END;
+"""
+
+# Same integer key as year_month(), computed from the stored YYYY-MM-DD text
+_SQL_MONTH = "IFNULL(CAST(substr({0}, 1, 4) AS INTEGER) * 100 + CAST(substr({0}, 6, 2) AS INTEGER), 0)"
+SCHEMA = SCHEMA.format(new_month=_SQL_MONTH.format("NEW.date"), old_month=_SQL_MONTH.format("OLD.date"))
+
+SELECT_ROLLUP = ("SELECT year_month AS YearMonth, category AS Category, currency AS Currency, "
+                 "total AS Total, count AS Count FROM expense_rollup")
+COUNT_ROLLUP = (f"SELECT {_SQL_MONTH.format('date')} AS YearMonth, IFNULL(category, '') AS Category, "
+                "IFNULL(currency, '') AS Currency, IFNULL(SUM(amount), 0) AS Total, COUNT(*) AS Count "
+                "FROM expenses GROUP BY 1, 2, 3")
+
+SELECT_EXPENSES = ("SELECT id, date AS Date, amount AS Amount, category AS Category, receipt AS Receipt, "
+                   "currency AS Currency FROM expenses")
+INSERT_EXPENSE = "INSERT INTO expenses (id, date, amount, category, receipt, currency) VALUES (?, ?, ?, ?, ?, ?)"
+DELETE_EXPENSE = "DELETE FROM expenses WHERE id = ?"
+
+_SQL_COLUMNS = {"Date": "date", "Amount": "amount", "Category": "category", "Receipt": "receipt",
+                "Currency": "currency"}
+
+
+def _select_expenses(columns=None):
+    # SELECT_EXPENSES narrowed to a column projection, so receipt values are
+    # neither decoded by SQLite nor copied into pandas unless asked for
+    if columns is None:
+        return SELECT_EXPENSES
+    kept = [column for column in EXPENSE_COLUMNS if column in columns]
+    return "SELECT id" + "".join(f", {_SQL_COLUMNS[c]} AS {c}" for c in kept) + " FROM expenses"
+
+
+class SQLiteStore(ExpenseStore):
+    """Expenses kept in an SQLite database in WAL mode.
+
+    Date and category are indexed, so filtered reads and budget sums only
+    touch the rows they return. Statements are fixed parameterised strings,
+    which sqlite3 compiles once per connection and then reuses.
+    """
+
+    def __init__(self, path="expenses.db"):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        self._migrate(conn)
+        conn.executescript(SCHEMA)
+        # Databases created before the rollup existed need one full count
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'rollup_built'").fetchone() is None:
+            self.rebuild_rollup()
+
+    @staticmethod
+    def _migrate(conn):
+        # Databases from before expenses had a currency: add the column, and
+        # drop the rollup (and its triggers) so SCHEMA recreates it per
+        # currency and the count below refills it
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(expenses)")]
+        if columns and "currency" not in columns:
+            conn.execute("ALTER TABLE expenses ADD COLUMN currency TEXT")
+        rollup_columns = [row[1] for row in conn.execute("PRAGMA table_info(expense_rollup)")]
+        if rollup_columns and "currency" not in rollup_columns:
+            for trigger in ("insert", "delete", "update"):
+                conn.execute(f"DROP TRIGGER IF EXISTS expenses_rollup_{trigger}")
+            conn.execute("DROP TABLE expense_rollup")
+            conn.execute("DELETE FROM meta WHERE key = 'rollup_built'")
+        conn.commit()
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, and every
+        # Streamlit session runs on its own thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self):
+        # BEGIN IMMEDIATE takes SQLite's write lock up front, so concurrent
+        # writers queue on busy_timeout instead of failing mid-transaction
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _where(self, start=None, end=None, categories=None, ids=None):
+        # Dates are stored as YYYY-MM-DD strings, so they compare in date order
+        clauses = []
+        params = []
+        if ids is not None:
+            ids = [int(expense_id) for expense_id in ids]
+            clauses.append(f"id IN ({', '.join('?' * len(ids))})" if ids else "0")
+            params.extend(ids)
+        if start is not None:
+            clauses.append("date >= ?")
+            params.append(_clean_value(start))
+        if end is not None:
+            clauses.append("date <= ?")
+            params.append(_clean_value(end))
+        if categories:
+            categories = list(categories)
+            clauses.append(f"category IN ({', '.join('?' * len(categories))})")
+            params.extend(categories)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def load(self, columns=None):
+        return self.query(columns=columns)
+
+    def query(self, start=None, end=None, categories=None, sort=None, descending=False, limit=None, offset=0,
+              columns=None):
+        # Sorting and paging happen in SQL, so a page costs its own rows plus an index walk
+        where, params = self._where(start, end, categories)
+        order = " ORDER BY id"
+        if sort is not None:
+            direction = "DESC" if descending else "ASC"
+            order = f" ORDER BY {_SQL_COLUMNS[sort]} {direction}, id {direction}"
+        if limit is not None or offset:
+            order += " LIMIT ? OFFSET ?"
+            params = params + [-1 if limit is None else int(limit), int(offset)]
+        frame = pd.read_sql_query(_select_expenses(columns) + where + order, self._connect(),
+                                  params=params, index_col="id")
+        return typed_frame(frame)
+
+    def count(self, start=None, end=None, categories=None):
+        where, params = self._where(start, end, categories)
+        return self._connect().execute("SELECT COUNT(*) FROM expenses" + where, params).fetchone()[0]
+
+    def version(self):
+        # Bumped inside every write transaction
+        return int(self._connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    def stream(self, chunk_rows=STREAM_CHUNK_ROWS, columns=None):
+        # The open cursor reads one consistent WAL snapshot from start to end
+        total = self.count()
+        cursor = self._connect().execute(_select_expenses(columns) + " ORDER BY id")
+        names = [column[0] for column in cursor.description]
+        done = 0
+        while True:
+            records = cursor.fetchmany(chunk_rows)
+            if not records:
+                break
+            done += len(records)
+            frame = pd.DataFrame.from_records(records, columns=names, index="id")
+            yield LoadProgress(typed_frame(frame), done, max(total, done), None, None)
+
+    def total(self, start=None, end=None, categories=None):
+        where, params = self._where(start, end, categories)
+        row = self._connect().execute("SELECT COALESCE(SUM(amount), 0) FROM expenses" + where, params).fetchone()
+        return float(row[0])
+
+    def get(self, expense_id):
+        cursor = self._connect().execute(SELECT_EXPENSES + " WHERE id = ?", (int(expense_id),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(EXPENSE_COLUMNS, row[1:]))
+
+    def rollup(self, key=None, categories=None):
+        clauses = []
+        params = []
+        if key is not None:
+            clauses.append("year_month = ?")
+            params.append(int(key))
+        if categories:
+            categories = list(categories)
+            clauses.append(f"category IN ({', '.join('?' * len(categories))})")
+            params.extend(categories)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return pd.read_sql_query(SELECT_ROLLUP + where, self._connect(), params=params)
+
+    def _count_rollup(self):
+        return pd.read_sql_query(COUNT_ROLLUP, self._connect())
+
+    def rebuild_rollup(self):
+        with self._write() as conn:
+            conn.execute("DELETE FROM expense_rollup")
+            conn.execute("INSERT INTO expense_rollup (year_month, category, currency, total, count) " + COUNT_ROLLUP)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_built', '1')")
+
+    def apply(self, ops, expected_version=None):
+        # One transaction per batch, same all-or-nothing contract as the journal
+        return self.apply_chunks([ops], expected_version)
+
+    def apply_chunks(self, chunks, expected_version=None):
+        """Applies each list of ops in chunks in turn, all or nothing.
+
+        Every chunk goes into the same transaction, so a batch too large to
+        hold at once, such as a restore, can be read and applied a chunk at
+        a time.
+        """
+        ids = []
+        with self._write() as conn:
+            if expected_version is not None and self.version() != expected_version:
+                raise ConflictError("The expenses were changed by someone else")
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            for ops in chunks:
+                self._apply_ops(conn, ops, ids)
+        return ids
+
+    def _apply_ops(self, conn, ops, ids):
+        for op in ops:
+            if op.get("expect"):
+                row = conn.execute(SELECT_EXPENSES + " WHERE id = ?", (op["id"],)).fetchone()
+                row = dict(zip(EXPENSE_COLUMNS, row[1:])) if row is not None else None
+                _check_expected(op["id"], row, op["expect"])
+        for op in ops:
+            kind = op["op"]
+            if kind == "insert":
+                row = op["row"]
+                cursor = conn.execute(INSERT_EXPENSE, (op.get("id"), *(row.get(c) for c in EXPENSE_COLUMNS)))
+                ids.append(cursor.lastrowid)
+            elif kind == "update":
+                columns = [column for column in EXPENSE_COLUMNS if column in op["row"]]
+                if columns:
+                    assignments = ", ".join(f"{_SQL_COLUMNS[column]} = ?" for column in columns)
+                    conn.execute(f"UPDATE expenses SET {assignments} WHERE id = ?",
+                                 [op["row"][column] for column in columns] + [op["id"]])
+            elif kind == "delete":
+                conn.execute(DELETE_EXPENSE, (op["id"],))
+            elif kind == "update_where":
+                columns = [column for column in EXPENSE_COLUMNS if column in op["row"]]
+                where, params = self._where(**op["where"])
+                assignments = ", ".join(f"{_SQL_COLUMNS[column]} = ?" for column in columns)
+                conn.execute(f"UPDATE expenses SET {assignments}" + where,
+                             [op["row"][column] for column in columns] + params)
+            elif kind == "delete_where":
+                where, params = self._where(**op["where"])
+                conn.execute("DELETE FROM expenses" + where, params)
+            elif kind == "shift_dates":
+                where, params = self._where(**op["where"])
+                conn.execute("UPDATE expenses SET date = date(date, ?)" + where,
+                             [f"{int(op['days']):+d} days"] + params)
+            elif kind == "clear":
+                conn.execute("DELETE FROM expense_rollup")
+                conn.execute("DELETE FROM expenses")
+
+
+def _open_sqlite(path="expenses.db"):
+    fresh = not os.path.exists(path)
+    store = SQLiteStore(path)
+    # Carry over expenses written by the CSV journal before the switch to
+    # SQLite; the version check stops a second process importing them again
+    if fresh and any(os.path.exists(path) for path in ("expenses.csv", "expenses.arrow", "expenses.journal")):
+        legacy = JournalStore().load()
+        try:
+            store.apply([{"op": "insert", "id": int(expense_id), "row": clean_row(row)}
+                         for expense_id, row in legacy.to_dict("index").items()], expected_version=0)
+        except ConflictError:
+            pass
+    return store
+
+
+# Each user's expenses live in their own directory under here, so a session
+# only ever reads, caches and locks its own user's rows
+USER_DATA_DIR = os.environ.get("EXPENSE_USER_DIR", "users")
+
+
+def user_partition(username):
+    # Directory name for a login: readable when the name is already a safe
+    # slug, otherwise suffixed with a hash so "a b" and "a_b" don't collide
+    name = username.strip().lower()
+    slug = re.sub(r"[^a-z0-9_.-]", "_", name).strip(".") or "_"
+    if slug != name:
+        slug += "-" + hashlib.sha256(name.encode("utf-8")).hexdigest()[:8]
+    return slug
+
+
+def partition_dir(username):
+    return os.path.join(USER_DATA_DIR, user_partition(username))
+
+
+# Files of the shared store from before per-user partitions, on either backend
+SHARED_FILES = ["expenses.db", "expenses.csv", "expenses.arrow", "expenses.journal"]
+
+
+def _open_store(username=None):
+    if username is None:
+        # The shared store from before per-user partitions
+        if EXPENSE_BACKEND == "journal":
+            return JournalStore()
+        return _open_sqlite()
+    folder = partition_dir(username)
+    os.makedirs(folder, exist_ok=True)
+    owner = os.path.join(folder, "owner")
+    if not os.path.exists(owner):
+        with open(owner, "w", encoding="utf-8") as f:
+            f.write(username.strip())
+    if EXPENSE_BACKEND == "journal":
+        store = JournalStore(os.path.join(folder, "expenses.csv"), os.path.join(folder, "expenses.journal"))
+    else:
+        store = SQLiteStore(os.path.join(folder, "expenses.db"))
+    # The shared store's expenses stay where they are until an operator moves
+    # them with adopt-shared; any name logs in, so no login may claim them
+    return store
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(username=None):
+    # One store per user for the whole server process, shared by that
+    # user's sessions; without a username, the shared pre-partition store
+    key = (EXPENSE_BACKEND, None if username is None else user_partition(username))
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = _open_store(username)
+        return _stores[key]
+
+
+def list_users():
+    # Owners of every partition on disk, in partition order
+    users = []
+    if os.path.isdir(USER_DATA_DIR):
+        for entry in sorted(os.listdir(USER_DATA_DIR)):
+            try:
+                with open(os.path.join(USER_DATA_DIR, entry, "owner"), encoding="utf-8") as f:
+                    users.append(f.read().strip())
+            except OSError:
+                continue
+    return users
+
+
+def user_rollups(key=None, categories=None):
+    """Yields (username, rollup) for every partition, one at a time.
+
+    Only one user's rollup is in memory at once, so admin reports cost the
+    number of users times the size of a rollup rather than every expense.
+    """
+    for username in list_users():
+        yield username, get_store(username).rollup(key, categories)
+
+
+def all_users_rollup(key=None, categories=None):
+    # Month x category totals per user, with a User column in front
+    frames = [frame.assign(User=username) for username, frame in user_rollups(key, categories) if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=["User"] + ROLLUP_COLUMNS)
+    return pd.concat(frames, ignore_index=True)[["User"] + ROLLUP_COLUMNS]
+
+
+def adopt_shared(username, store=None):
+    # Move expenses from the shared pre-partition store into a user's
+    # partition; only done into an empty partition so it can't run twice,
+    # and under a lock so two runs can't both take the same rows
+    os.makedirs(USER_DATA_DIR, exist_ok=True)
+    with FileLock(os.path.join(USER_DATA_DIR, "adopt.lock")):
+        shared = _open_store() if store is not None else get_store()
+        store = store if store is not None else get_store(username)
+        version = store.version()
+        if store.count():
+            raise ConflictError(f"{username} already has expenses")
+        rows = shared.load()
+        if rows.empty:
+            return 0
+        store.apply([{"op": "insert", "id": int(expense_id), "row": clean_row(row)}
+                     for expense_id, row in rows[EXPENSE_COLUMNS].to_dict("index").items()],
+                    expected_version=version)
+        shared.clear()
+        return len(rows)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the expense store")
+    parser.add_argument("command", choices=["verify-rollup", "rebuild-rollup", "adopt-shared", "user-totals"])
+    parser.add_argument("--user", help="partition to work on; the shared store if omitted")
+    args = parser.parse_args()
+
+    if args.command == "user-totals":
+        from currency import convert_rollup
+
+        totals = convert_rollup(all_users_rollup()).groupby("User")[["Total", "Count"]].sum()
+        print(totals.to_string() if not totals.empty else "No user partitions")
+        raise SystemExit(0)
+    if args.command == "adopt-shared":
+        if not args.user:
+            parser.error("adopt-shared needs --user")
+        print(f"Moved {adopt_shared(args.user)} expenses to {partition_dir(args.user)}")
+        raise SystemExit(0)
+
+    store = get_store(args.user)
+    if args.command == "rebuild-rollup":
+        store.rebuild_rollup()
+        print("Rollup rebuilt")
+    else:
+        mismatches = store.verify_rollup()
+        if mismatches.empty:
+            print("Rollup matches the expense table")
+        else:
+            print(mismatches.to_string(index=False))
+            raise SystemExit(1)
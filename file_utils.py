@@ -0,0 +1,29 @@
+import os
+import threading
+
+# File helpers shared by the stores and the caches built from files. Whole
+# files are replaced through a temporary file beside them, so a reader sees
+# the old contents or the new ones and never part of either; caches key on
+# file_version, so they reload when the file changes and not before.
+
+
+def temp_path(path):
+    # One per process and thread, so concurrent writers never share it
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def write_atomic(path, data):
+    # data is bytes; the folder must already exist
+    tmp = temp_path(path)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def file_version(path):
+    # Changes whenever the file is rewritten; None while there is no file
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
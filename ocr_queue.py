@@ -0,0 +1,355 @@
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime
+
+from profiling import span
+from receipt_store import RECEIPT_DIR, is_receipt_ref, receipt_path
+
+# Receipt OCR off the request path. Saving an expense only records a job;
+# a dispatcher thread hands queued jobs to a process pool that runs the
+# local tesseract binary, and writes the text and the amount, date and
+# merchant read from it back to the job. Jobs live in SQLite, keyed by the
+# receipt reference, so they survive restarts and a photo uploaded twice is
+# read once. A running job carries the dispatcher that claimed it and a
+# lease that dispatcher keeps renewing; a job whose lease runs out belonged
+# to a process that is gone and is queued again.
+
+JOBS_DB = os.environ.get("EXPENSE_OCR_DB", os.path.join(RECEIPT_DIR, "ocr_jobs.db"))
+TESSERACT = os.environ.get("EXPENSE_TESSERACT", "tesseract")
+OCR_WORKERS = int(os.environ.get("EXPENSE_OCR_WORKERS", "2"))
+
+# Seconds tesseract may take on one image, and how often a job is tried
+OCR_TIMEOUT = 120
+MAX_ATTEMPTS = 3
+
+# How long an idle dispatcher sleeps before looking for queued jobs again
+IDLE_SECONDS = 5
+
+# Seconds a running job stays claimed without its dispatcher renewing it
+LEASE_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_jobs (
+    ref TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    queued TEXT NOT NULL,
+    finished TEXT,
+    error TEXT,
+    text TEXT,
+    amount REAL,
+    date TEXT,
+    merchant TEXT,
+    owner TEXT,
+    lease REAL
+);
+CREATE INDEX IF NOT EXISTS ocr_jobs_status ON ocr_jobs(status, queued);
+"""
+
+JOB_COLUMNS = ["ref", "status", "attempts", "queued", "finished", "error", "text", "amount", "date", "merchant"]
+
+_AMOUNT = re.compile(r"(?<![\d.,])(\d{1,3}(?:,\d{3})+|\d+)[.,](\d{2})(?!\d)")
+_DATE = re.compile(r"\b(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}/\d{1,2}/\d{2,4}|\d{1,2}\.\d{1,2}\.\d{4})\b")
+_DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d.%m.%Y"]
+
+
+def _amounts(line):
+    return [float(whole.replace(",", "") + "." + cents) for whole, cents in _AMOUNT.findall(line)]
+
+
+def parse_receipt(text):
+    """Amount, date and merchant suggestions read from OCR text; any of
+    them may be None.
+
+    The amount is the last one on a TOTAL line (not SUBTOTAL), else the
+    largest on the receipt; the merchant is the first line with letters.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    totals = [_amounts(line) for line in lines
+              if re.search(r"\btotal\b", line, re.I) and not re.search(r"sub\s*-?\s*total", line, re.I)]
+    totals = [found[-1] for found in totals if found]
+    every = [amount for line in lines for amount in _amounts(line)]
+    amount = totals[-1] if totals else (max(every) if every else None)
+    when = None
+    for match in _DATE.findall(text):
+        for layout in _DATE_FORMATS:
+            try:
+                when = datetime.strptime(match, layout).strftime("%Y-%m-%d")
+                break
+            except ValueError:
+                continue
+        if when:
+            break
+    merchant = next((line[:60] for line in lines if re.search(r"[A-Za-z]{2}", line)), None)
+    return {"amount": amount, "date": when, "merchant": merchant}
+
+
+def _image_path(ref):
+    # Blob references live in the receipt store; older rows hold a file path
+    return receipt_path(ref) if is_receipt_ref(ref) else ref
+
+
+def _run_ocr(path, tesseract=TESSERACT, timeout=OCR_TIMEOUT):
+    # Runs in a pool process: tesseract prints the text to stdout
+    result = subprocess.run([tesseract, path, "stdout"], capture_output=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8", "replace").strip() or f"tesseract exited {result.returncode}")
+    text = result.stdout.decode("utf-8", "replace")
+    return dict(parse_receipt(text), text=text)
+
+
+def _now():
+    return f"{datetime.now():%Y-%m-%d %H:%M:%S}"
+
+
+class OCRQueue:
+    """Receipt OCR jobs in an SQLite table, worked through by a pool of
+    `workers` processes.
+
+    start() launches the dispatcher thread; it only runs when the tesseract
+    binary is installed, and jobs queued without it wait for a later start.
+    """
+
+    def __init__(self, path=JOBS_DB, workers=OCR_WORKERS, tesseract=TESSERACT):
+        self.path = path
+        self.workers = max(1, int(workers))
+        self.tesseract = tesseract
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Marks the jobs this queue's dispatcher has claimed
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        conn = self._connect()
+        self._migrate(conn)
+        conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _migrate(conn):
+        # Job tables from before running jobs had an owner and a lease
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(ocr_jobs)")]
+        if columns and "lease" not in columns:
+            conn.execute("ALTER TABLE ocr_jobs ADD COLUMN owner TEXT")
+            conn.execute("ALTER TABLE ocr_jobs ADD COLUMN lease REAL")
+        conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self):
+        # BEGIN IMMEDIATE takes SQLite's write lock before anything is read,
+        # so two dispatchers can't both see a job as queued and claim it
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def available(self):
+        return shutil.which(self.tesseract) is not None
+
+    def enqueue(self, refs):
+        # Queues receipts not seen before and returns how many that was
+        refs = [ref for ref in dict.fromkeys(refs) if isinstance(ref, str) and ref]
+        conn = self._connect()
+        with conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO ocr_jobs (ref, status, queued) VALUES (?, 'queued', ?)",
+                             [(ref, _now()) for ref in refs])
+            added = conn.total_changes - before
+        if added:
+            self.start()
+            self._wake.set()
+        return added
+
+    def retry_failed(self):
+        conn = self._connect()
+        with conn:
+            count = conn.execute("UPDATE ocr_jobs SET status = 'queued', attempts = 0, error = NULL "
+                                 "WHERE status = 'failed'").rowcount
+        if count:
+            self.start()
+            self._wake.set()
+        return count
+
+    def job(self, ref):
+        row = self._connect().execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM ocr_jobs WHERE ref = ?",
+                                      (ref,)).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row is not None else None
+
+    def counts(self):
+        # Number of jobs per status
+        return dict(self._connect().execute("SELECT status, COUNT(*) FROM ocr_jobs GROUP BY status").fetchall())
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return True
+            if not self.available():
+                return False
+            self._thread = threading.Thread(target=self._dispatch, name="receipt-ocr", daemon=True)
+            self._thread.start()
+            return True
+
+    def _claim(self, limit):
+        now = time.time()
+        with self._write() as conn:
+            # Jobs whose dispatcher stopped renewing them count that as a failed attempt
+            conn.execute("UPDATE ocr_jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                         "owner = NULL, lease = NULL, finished = ?, error = 'The process reading it stopped' "
+                         "WHERE status = 'running' AND (lease IS NULL OR lease < ?)", (MAX_ATTEMPTS, _now(), now))
+            refs = [row[0] for row in conn.execute(
+                "SELECT ref FROM ocr_jobs WHERE status = 'queued' ORDER BY queued LIMIT ?", (limit,))]
+            conn.executemany("UPDATE ocr_jobs SET status = 'running', attempts = attempts + 1, owner = ?, lease = ? "
+                             "WHERE ref = ?", [(self._owner, now + LEASE_SECONDS, ref) for ref in refs])
+        return refs
+
+    def _renew(self, refs):
+        # Keeps this dispatcher's claim on the jobs it still has in the pool
+        refs = [ref for ref in refs if ref is not None]
+        if not refs:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute(f"UPDATE ocr_jobs SET lease = ? WHERE status = 'running' AND owner = ? "
+                         f"AND ref IN ({', '.join('?' * len(refs))})",
+                         (time.time() + LEASE_SECONDS, self._owner, *refs))
+
+    def _finish(self, ref, result=None, error=None, retry=True):
+        conn = self._connect()
+        with conn:
+            if error is None:
+                conn.execute("UPDATE ocr_jobs SET status = 'done', finished = ?, error = NULL, text = ?, "
+                             "amount = ?, date = ?, merchant = ?, owner = NULL, lease = NULL WHERE ref = ?",
+                             (_now(), result["text"], result["amount"], result["date"], result["merchant"], ref))
+            else:
+                # Tried again later unless it has already had its attempts
+                conn.execute("UPDATE ocr_jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                             "finished = ?, error = ?, owner = NULL, lease = NULL WHERE ref = ?",
+                             (MAX_ATTEMPTS if retry else 0, _now(), str(error), ref))
+
+    def _dispatch(self):
+        # Pool processes are spawned, not forked, since the server process is
+        # running other threads. A pool broken by a crashed worker is replaced,
+        # and its jobs count the crash as a failed attempt. Any other error,
+        # such as the database staying locked, is logged and the dispatcher
+        # carries on; jobs it was running are picked up again once their
+        # leases run out.
+        context = multiprocessing.get_context("spawn")
+        while True:
+            running = {}
+            try:
+                with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+                    self._work(pool, running)
+            except BrokenProcessPool as e:
+                try:
+                    for ref in running.values():
+                        self._finish(ref, error=e)
+                except Exception:
+                    logger.exception("Could not record the receipt OCR pool crashing")
+            except Exception:
+                logger.exception("Receipt OCR dispatcher failed; retrying in %s seconds", IDLE_SECONDS)
+                time.sleep(IDLE_SECONDS)
+
+    def _work(self, pool, running):
+        # Keeps up to workers jobs in the pool until the pool breaks
+        while True:
+            for ref in self._claim(self.workers - len(running)):
+                path = _image_path(ref)
+                if not os.path.exists(path):
+                    self._finish(ref, error="Receipt image not found", retry=False)
+                    continue
+                try:
+                    running[pool.submit(_run_ocr, path, self.tesseract)] = ref
+                except BrokenProcessPool:
+                    running[None] = ref
+                    raise
+            if not running:
+                self._wake.wait(IDLE_SECONDS)
+                self._wake.clear()
+                continue
+            done, _ = wait(running, timeout=IDLE_SECONDS, return_when=FIRST_COMPLETED)
+            self._renew([ref for future, ref in running.items() if future not in done])
+            for future in done:
+                ref = running.pop(future)
+                with span("receipt ocr"):
+                    try:
+                        self._finish(ref, result=future.result())
+                    except BrokenProcessPool:
+                        running[future] = ref
+                        raise
+                    except Exception as e:
+                        self._finish(ref, error=e)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_ocr_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = OCRQueue()
+        return _queue
+
+
+def backfill(store, queue=None):
+    """Queues every receipt the store's expenses reference and returns how
+    many were new to the queue."""
+    receipts = store.load(columns=["Receipt"])["Receipt"].dropna()
+    refs = [ref for ref in receipts.unique()
+            if isinstance(ref, str) and (is_receipt_ref(ref) or os.path.exists(ref))]
+    return (queue or get_ocr_queue()).enqueue(refs)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from expense_store import get_store
+
+    parser = argparse.ArgumentParser(description="Read receipts with tesseract in the background queue")
+    parser.add_argument("command", choices=["backfill", "retry", "status", "run"])
+    parser.add_argument("--user", help="partition whose receipts to backfill; the shared store if omitted")
+    args = parser.parse_args()
+
+    queue = get_ocr_queue()
+    if args.command == "backfill":
+        print(f"Queued {backfill(get_store(args.user), queue)} receipts")
+    elif args.command == "retry":
+        print(f"Queued {queue.retry_failed()} failed receipts again")
+    elif args.command == "status":
+        print(queue.counts() or "No receipts queued")
+    else:
+        # Works through the queue in the foreground until nothing is left
+        if not queue.start():
+            raise SystemExit(f"{TESSERACT} was not found")
+        while queue.counts().get("queued", 0) or queue.counts().get("running", 0):
+            time.sleep(1)
+        print(queue.counts())
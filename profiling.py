@@ -0,0 +1,118 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Timing spans for one Streamlit rerun. Main.py starts a trace at the top of
+# the script and marks each section as it goes; functions wrapped in timed()
+# or code inside span() nest under whatever section is running. Spans on
+# threads with no trace (report builds and other background work) are kept
+# in a short process-wide list instead.
+
+# Where export_traces() appends when no path is given
+PROFILE_FILE = os.environ.get("EXPENSE_PROFILE_FILE", "profile_spans.ndjson")
+
+_local = threading.local()
+background_spans = deque(maxlen=200)
+
+
+class Trace:
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.spans = []
+        self.total = None
+        self._origin = time.perf_counter()
+        self._depth = 0
+        self._section = None
+
+    def now(self):
+        return time.perf_counter() - self._origin
+
+    def add(self, name, start, end, depth):
+        self.spans.append({"name": name, "start": start, "duration": end - start, "depth": depth})
+
+    def close_section(self):
+        if self._section is not None:
+            name, start = self._section
+            self.add(name, start, self.now(), 0)
+            self._section = None
+
+    def finish(self):
+        # Reruns cut short by st.rerun() or st.stop() never reach the end of
+        # the script; they are finished when the next one starts
+        if self.total is None:
+            self.close_section()
+            self.total = max((span["start"] + span["duration"] for span in self.spans), default=0.0)
+        return self
+
+    def record(self):
+        return {
+            "label": self.label,
+            "started": self.started,
+            "total": self.total,
+            "spans": sorted(self.spans, key=lambda span: (span["start"], span["depth"])),
+        }
+
+
+def start_trace(label):
+    trace = Trace(label)
+    _local.trace = trace
+    return trace
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def section(name):
+    """Ends the running top-level section of this rerun and starts another."""
+    trace = current_trace()
+    if trace is not None and trace.total is None:
+        trace.close_section()
+        trace._section = (name, trace.now())
+
+
+@contextmanager
+def span(name):
+    trace = current_trace()
+    if trace is None or trace.total is not None:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            background_spans.append({"name": name, "started": time.time(),
+                                     "duration": time.perf_counter() - started,
+                                     "thread": threading.current_thread().name})
+        return
+    start = trace.now()
+    trace._depth += 1
+    try:
+        yield
+    finally:
+        trace._depth -= 1
+        trace.add(name, start, trace.now(), trace._depth + 1)
+
+
+def timed(name=None):
+    """Decorator that runs the function inside a span named after it."""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def export_traces(traces, path=PROFILE_FILE):
+    # One JSON line per rerun, appended so exports from many sessions pile up
+    with open(path, "a", encoding="utf-8") as f:
+        for trace in traces:
+            f.write(json.dumps(trace.record()) + "\n")
+    return path
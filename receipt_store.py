@@ -0,0 +1,77 @@
+import base64
+import binascii
+import hashlib
+import os
+import threading
+
+from file_utils import write_atomic
+from profiling import timed
+
+# Receipt images live on disk under their SHA-256, and expense rows only keep
+# the short "sha256:<hex>" reference. Uploading the same photo twice stores it once.
+
+RECEIPT_DIR = "receipts"
+REF_PREFIX = "sha256:"
+
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+def is_receipt_ref(value):
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+def receipt_path(ref, root=RECEIPT_DIR):
+    digest = ref[len(REF_PREFIX):]
+    return os.path.join(root, digest[:2], digest)
+
+
+@timed("save receipt")
+def save_receipt(data, root=RECEIPT_DIR):
+    # root is only ever changed by tools writing a store of their own elsewhere
+    digest = hashlib.sha256(data).hexdigest()
+    ref = REF_PREFIX + digest
+    path = receipt_path(ref, root)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+    return ref
+
+
+@timed("load receipt")
+def load_receipt(value):
+    # Older rows hold a file path or the whole image as base64 text
+    if not isinstance(value, str) or not value or value == "None":
+        return None
+    if is_receipt_ref(value):
+        try:
+            with open(receipt_path(value), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    if os.path.exists(value):
+        with open(value, "rb") as f:
+            return f.read()
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def migrate_inline_receipts(store):
+    # Move base64 receipts left in the Receipt column into the blob store, once per store
+    with _migrate_lock:
+        if id(store) in _migrated:
+            return 0
+        receipts = store.load()["Receipt"].dropna()
+        ops = []
+        for expense_id, value in receipts.items():
+            if is_receipt_ref(value):
+                continue
+            data = load_receipt(value)
+            if data is not None:
+                ops.append({"op": "update", "id": int(expense_id), "row": {"Receipt": save_receipt(data)}})
+        if ops:
+            store.apply(ops)
+        _migrated.add(id(store))
+        return len(ops)
@@ -0,0 +1,165 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+from expense_store import partition_dir
+from file_utils import file_version
+from profiling import timed
+
+# Recurring expenses (subscriptions, rent, passes) stay as schedules and are
+# expanded into dated occurrences only for the window a page asks about, so
+# projections never become rows in the expense store. Expansion is numpy date
+# arithmetic over every schedule at once, and each expanded window is cached
+# until the schedule file changes.
+
+RECURRING_FILE = os.environ.get("EXPENSE_RECURRING_FILE",
+                                os.path.join("csv_collection", "recurring_expenses.csv"))
+
+# Each user's schedules, in their partition beside their expenses
+SCHEDULE_NAME = "recurring_expenses.csv"
+
+# frequency -> (unit, step): day-based schedules step in days, calendar ones
+# in months and keep their day of the month (clipped to short months)
+FREQUENCIES = {
+    "daily": ("D", 1),
+    "weekly": ("D", 7),
+    "biweekly": ("D", 14),
+    "monthly": ("M", 1),
+    "quarterly": ("M", 3),
+    "yearly": ("M", 12),
+    "annually": ("M", 12),
+}
+
+OCCURRENCE_COLUMNS = ["Date", "YearMonth", "Amount", "Category", "Description", "RecurringId"]
+
+_NO_END = np.datetime64("9999-12-31")
+
+
+def schedule_file(username=None):
+    # A user's own schedules once their partition has a file of them; until
+    # then the shared RECURRING_FILE, so its schedules still apply
+    if username is not None:
+        path = os.path.join(partition_dir(username), SCHEDULE_NAME)
+        if os.path.exists(path):
+            return path
+    return RECURRING_FILE
+
+
+def schedule_version(path=RECURRING_FILE):
+    return file_version(path)
+
+
+def _active(values):
+    return values.fillna("true").astype(str).str.strip().str.lower().isin(["true", "1", "yes", "y"])
+
+
+@functools.lru_cache(maxsize=8)
+def _schedules(path, version):
+    if version is None:
+        return pd.DataFrame(columns=["recurring_id", "description", "amount", "category", "frequency",
+                                     "start", "end", "unit", "step"])
+    frame = pd.read_csv(path, dtype=str, skipinitialspace=True)
+    frame.columns = [column.strip().lower() for column in frame.columns]
+    frame["frequency"] = frame["frequency"].str.strip().str.lower()
+    frame["amount"] = pd.to_numeric(frame["amount"], errors="coerce")
+    frame["start"] = pd.to_datetime(frame["start_date"], errors="coerce").values.astype("datetime64[D]")
+    blank = pd.Series(None, index=frame.index, dtype=object)
+    frame["end"] = pd.to_datetime(frame.get("end_date", blank), errors="coerce").values.astype("datetime64[D]")
+    # Schedules that can't be expanded are left out rather than guessed at
+    frame = frame[_active(frame.get("active", blank))
+                  & frame["frequency"].isin(list(FREQUENCIES)) & frame["amount"].notna()
+                  & frame["start"].notna()].copy()
+    frame["unit"] = frame["frequency"].map(lambda name: FREQUENCIES[name][0])
+    frame["step"] = frame["frequency"].map(lambda name: FREQUENCIES[name][1]).astype("int64")
+    return frame.reset_index(drop=True)
+
+
+def load_schedules(path=RECURRING_FILE):
+    return _schedules(path, schedule_version(path)).copy()
+
+
+def _steps(first, last):
+    # For per-schedule step ranges [first, last], the schedule index and step
+    # number of every occurrence, without looping over schedules
+    counts = np.maximum(last - first + 1, 0)
+    owners = np.repeat(np.arange(len(counts)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, first[owners] + np.arange(counts.sum()) - starts
+
+
+def _day_dates(schedules, start, end):
+    begin = schedules["start"].to_numpy().astype("datetime64[D]")
+    step = schedules["step"].to_numpy()
+    first = np.maximum((start - begin).astype("int64") // step, 0)
+    last = (end - begin).astype("int64") // step
+    owners, k = _steps(first, last)
+    return owners, begin[owners] + (k * step[owners]).astype("timedelta64[D]")
+
+
+def _month_dates(schedules, start, end):
+    begin = schedules["start"].to_numpy().astype("datetime64[D]")
+    step = schedules["step"].to_numpy()
+    begin_month = begin.astype("datetime64[M]")
+    day = (begin - begin_month.astype("datetime64[D]")).astype("int64")
+    first = np.maximum((start.astype("datetime64[M]") - begin_month).astype("int64") // step, 0)
+    last = (end.astype("datetime64[M]") - begin_month).astype("int64") // step
+    owners, k = _steps(first, last)
+    months = begin_month[owners] + (k * step[owners]).astype("timedelta64[M]")
+    month_days = ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype("int64")
+    return owners, months.astype("datetime64[D]") + np.minimum(day[owners], month_days - 1).astype("timedelta64[D]")
+
+
+@functools.lru_cache(maxsize=64)
+def _expand(path, version, start, end):
+    schedules = _schedules(path, version)
+    owners, dates = [], []
+    for unit, dates_for in (("D", _day_dates), ("M", _month_dates)):
+        positions = np.flatnonzero((schedules["unit"] == unit).to_numpy())
+        if len(positions):
+            group_owners, group_dates = dates_for(schedules.iloc[positions], start, end)
+            owners.append(positions[group_owners])
+            dates.append(group_dates)
+    if not owners:
+        return pd.DataFrame(columns=OCCURRENCE_COLUMNS)
+    owners, dates = np.concatenate(owners), np.concatenate(dates)
+    # Only the columns an occurrence needs are gathered, never whole schedule rows
+    ends = schedules["end"].to_numpy().astype("datetime64[D]")[owners]
+    stop = np.minimum(np.where(np.isnat(ends), _NO_END, ends), end)
+    keep = (dates >= start) & (dates >= schedules["start"].to_numpy().astype("datetime64[D]")[owners]) & (dates <= stop)
+    order = np.argsort(dates[keep], kind="stable")
+    owners, dates = owners[keep][order], pd.DatetimeIndex(dates[keep][order])
+    return pd.DataFrame({
+        "Date": dates,
+        "YearMonth": (dates.year * 100 + dates.month).astype("int64"),
+        "Amount": schedules["amount"].to_numpy()[owners],
+        "Category": schedules["category"].to_numpy()[owners],
+        "Description": schedules["description"].to_numpy()[owners],
+        "RecurringId": schedules["recurring_id"].to_numpy()[owners],
+    })
+
+
+@timed("expand recurring")
+def occurrences(start, end, path=RECURRING_FILE):
+    """Every scheduled charge dated from start to end, both inclusive.
+
+    Returns a frame of OCCURRENCE_COLUMNS; nothing is written anywhere.
+    """
+    start, end = np.datetime64(pd.Timestamp(start).date(), "D"), np.datetime64(pd.Timestamp(end).date(), "D")
+    return _expand(path, schedule_version(path), start, end).copy()
+
+
+def month_bounds(key):
+    first = pd.Timestamp(year=key // 100, month=key % 100, day=1)
+    return first, first + pd.offsets.MonthEnd(0)
+
+
+def month_occurrences(key, after=None, path=RECURRING_FILE):
+    # Charges scheduled in month key, only those dated after `after` if given
+    start, end = month_bounds(key)
+    if after is not None:
+        start = max(start, pd.Timestamp(after).normalize() + pd.Timedelta(days=1))
+    if start > end:
+        return pd.DataFrame(columns=OCCURRENCE_COLUMNS)
+    return occurrences(start, end, path)
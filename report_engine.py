@@ -0,0 +1,239 @@
+import calendar
+import io
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from datetime import date, datetime
+
+from reportlab.graphics.charts.barcharts import VerticalBarChart
+from reportlab.graphics.shapes import Drawing
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import Flowable, PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from currency import convert_rollup, format_money
+from expense_store import BASE_CURRENCY, SUMMARY_COLUMNS, format_year_month, get_store, user_partition
+from profiling import timed
+
+# PDF expense reports. The story holds the summary and one placeholder per
+# month; platypus splits a placeholder when it reaches it, and only then are
+# that month's expenses queried, so only the month being written is ever
+# held in memory.
+
+# Transactions per detail table; platypus splits tables across pages itself
+REPORT_TABLE_ROWS = 200
+
+_styles = getSampleStyleSheet()
+
+_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2E4053")),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("FONTSIZE", (0, 0), (-1, -1), 9),
+    ("ALIGN", (-1, 0), (-1, -1), "RIGHT"),
+    ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#F2F3F4")]),
+    ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+])
+
+_TOTAL_STYLE = TableStyle([
+    ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+    ("LINEABOVE", (0, -1), (-1, -1), 0.75, colors.black),
+])
+
+
+class _MonthPages(Flowable):
+    # Stands in for a month's pages. It never fits, so platypus calls split(),
+    # which builds the real flowables; they start with a PageBreak, which
+    # platypus puts back on the story whole instead of drawing here. A build
+    # that is no longer wanted stops at the next month it reaches.
+
+    def __init__(self, build, cancelled=None):
+        super().__init__()
+        self._build = build
+        self._cancelled = cancelled
+
+    def wrap(self, availWidth, availHeight):
+        return availWidth, availHeight + 1
+
+    def split(self, availWidth, availHeight):
+        if self._cancelled is not None and self._cancelled.is_set():
+            raise CancelledError("report no longer wanted")
+        return list(self._build())
+
+    def draw(self):
+        pass
+
+
+def _money(amount, currency=BASE_CURRENCY):
+    return format_money(amount, currency)
+
+
+def _table(rows, widths):
+    table = Table(rows, colWidths=widths, repeatRows=1)
+    table.setStyle(_TABLE_STYLE)
+    return table
+
+
+def _category_chart(totals):
+    drawing = Drawing(6.5 * inch, 2.6 * inch)
+    chart = VerticalBarChart()
+    chart.x, chart.y = 0.5 * inch, 0.6 * inch
+    chart.width, chart.height = 5.8 * inch, 1.8 * inch
+    chart.data = [list(totals.values)]
+    chart.categoryAxis.categoryNames = [str(category) for category in totals.index]
+    chart.categoryAxis.labels.angle = 30
+    chart.categoryAxis.labels.boxAnchor = "ne"
+    chart.categoryAxis.labels.fontSize = 7
+    chart.valueAxis.valueMin = 0
+    chart.valueAxis.labels.fontSize = 7
+    chart.bars[0].fillColor = colors.HexColor("#5DADE2")
+    drawing.add(chart)
+    return drawing
+
+
+def _month_bounds(key):
+    year, month = divmod(key, 100)
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+
+def _summary(store, filters):
+    # The month x category rollup of the expenses the filters match
+    if filters.get("start") is None and filters.get("end") is None:
+        return convert_rollup(store.rollup(categories=filters.get("categories")))
+    rows = store.query(**filters, columns=SUMMARY_COLUMNS)
+    rows = rows.assign(Category=rows["Category"].astype(object).fillna(""),
+                       Currency=rows["Currency"].astype(object).fillna(""))
+    rollup = (rows.groupby(["YearMonth", "Category", "Currency"], as_index=False, sort=False)["Amount"]
+              .agg(Total="sum", Count="count"))
+    return convert_rollup(rollup)
+
+
+def _month_flowables(store, key, month, filters):
+    yield PageBreak()
+    yield Paragraph(f"{format_year_month(key)}: {_money(month['Total'].sum())} "
+                    f"across {int(month['Count'].sum())} transactions", _styles["Heading2"])
+    rows = [["Category", "Transactions", "Subtotal"]]
+    rows += [[str(row.Category), int(row.Count), _money(row.Total)]
+             for row in month.sort_values("Total", ascending=False).itertuples()]
+    yield _table(rows, [3 * inch, 1.5 * inch, 1.5 * inch])
+    yield Spacer(1, 0.2 * inch)
+
+    start, end = _month_bounds(key)
+    if filters.get("start") is not None:
+        start = max(start, filters["start"])
+    if filters.get("end") is not None:
+        end = min(end, filters["end"])
+    expenses = store.query(start=start, end=end, categories=filters.get("categories"), sort="Date")
+    for offset in range(0, len(expenses), REPORT_TABLE_ROWS):
+        chunk = expenses.iloc[offset:offset + REPORT_TABLE_ROWS]
+        rows = [["Date", "Category", "Amount"]]
+        rows += [[f"{when:%Y-%m-%d}", str(category), _money(amount, currency)]
+                 for when, category, amount, currency in zip(chunk["Date"], chunk["Category"], chunk["Amount"],
+                                                             chunk["Currency"])]
+        yield _table(rows, [1.5 * inch, 3 * inch, 1.5 * inch])
+
+
+def report_flowables(store, title="Expense Report", filters=None, cancelled=None):
+    """The report's story: the summary pages, then one placeholder per month
+    that reads that month's expenses only when platypus reaches it.
+
+    filters takes the store's query arguments (start, end, categories) and
+    limits every page to the expenses they match. The summary comes from the
+    month x category rollup, converted to BASE_CURRENCY; the detail pages
+    list each expense in its own currency. Setting the cancelled event stops
+    the build before the next month's pages.
+    """
+    filters = filters or {}
+    rollup = _summary(store, filters)
+    story = [
+        Paragraph(title, _styles["Title"]),
+        Paragraph(f"Generated {datetime.now():%Y-%m-%d %H:%M}", _styles["Normal"]),
+        Spacer(1, 0.2 * inch),
+    ]
+    if rollup.empty:
+        story.append(Paragraph("No transactions recorded.", _styles["Normal"]))
+        return story
+
+    by_category = rollup.groupby("Category")[["Total", "Count"]].sum().sort_values("Total", ascending=False)
+    rows = [["Category", "Transactions", "Total"]]
+    rows += [[str(category), int(row["Count"]), _money(row["Total"])] for category, row in by_category.iterrows()]
+    rows.append(["All categories", int(by_category["Count"].sum()), _money(by_category["Total"].sum())])
+    table = _table(rows, [3 * inch, 1.5 * inch, 1.5 * inch])
+    table.setStyle(_TOTAL_STYLE)
+    story += [Paragraph("Spending by Category", _styles["Heading2"]), _category_chart(by_category["Total"]), table]
+
+    for key in sorted(key for key in rollup["YearMonth"].unique() if key):
+        month = rollup[rollup["YearMonth"] == key]
+        story.append(_MonthPages(lambda key=key, month=month: _month_flowables(store, key, month, filters),
+                                 cancelled))
+    return story
+
+
+def _page_number(canvas, doc):
+    canvas.saveState()
+    canvas.setFont("Helvetica", 8)
+    canvas.drawRightString(letter[0] - 0.75 * inch, 0.5 * inch, f"Page {doc.page}")
+    canvas.restoreState()
+
+
+@timed("pdf report")
+def build_report(store, title="Expense Report", filters=None, cancelled=None):
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, title=title,
+                            topMargin=0.75 * inch, bottomMargin=0.75 * inch)
+    doc.build(report_flowables(store, title, filters, cancelled), onFirstPage=_page_number,
+              onLaterPages=_page_number)
+    return buffer.getvalue()
+
+
+# Finished reports, one per user, reused until that user's data or filters
+# change; (version, future, cancelled event) per user
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="expense-report")
+_reports = {}
+_reports_lock = threading.Lock()
+
+
+def _filters_key(filters):
+    return tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                        for name, value in (filters or {}).items()))
+
+
+def request_report(username=None, filters=None):
+    """Returns a future for the PDF of the user's expenses as they are now,
+    limited to the query filters given (start, end, categories).
+
+    The report is built on a worker thread the first time a data version and
+    set of filters is asked for; later requests for the same get the same
+    future. A build still running for other filters or older data is
+    cancelled, since nothing will ask for it again.
+    """
+    store = get_store(username)
+    key = None if username is None else user_partition(username)
+    version = (store.version(), _filters_key(filters))
+    with _reports_lock:
+        cached = _reports.get(key)
+        failed = cached is not None and cached[1].done() and cached[1].exception() is not None
+        if cached is None or cached[0] != version or failed:
+            if cached is not None:
+                _cancel(cached)
+            cancelled = threading.Event()
+            cached = (version, _executor.submit(build_report, store, filters=filters, cancelled=cancelled),
+                      cancelled)
+            _reports[key] = cached
+        return cached[1]
+
+
+def _cancel(cached):
+    # A queued build never starts; a running one stops at its next month
+    cached[2].set()
+    cached[1].cancel()
+
+
+def cancel_report(username=None):
+    # Drops the user's report, stopping its build if it hasn't finished
+    key = None if username is None else user_partition(username)
+    with _reports_lock:
+        cached = _reports.pop(key, None)
+        if cached is not None:
+            _cancel(cached)
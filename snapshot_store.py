@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+import pandas as pd
+
+from currency import convert
+from expense_store import EXPENSE_COLUMNS, FileLock, clean_row, empty_frame, partition_dir, typed_frame
+from file_utils import write_atomic
+from profiling import timed
+
+# Snapshots of a user's expenses, kept on disk instead of in session state.
+# Rows are cut into blocks by id range and each block is stored gzipped under
+# the SHA-256 of its contents, so a snapshot only adds the blocks that changed
+# since any earlier one. index.json holds the snapshot list without any rows.
+
+SNAPSHOT_DIR = "snapshots"
+
+# Expense ids per block; an edit rewrites one block, a new expense the last
+BLOCK_ROWS = 1000
+
+
+def snapshot_dir(username=None):
+    if username is None:
+        return SNAPSHOT_DIR
+    return os.path.join(partition_dir(username), SNAPSHOT_DIR)
+
+
+class SnapshotStore:
+    def __init__(self, folder=SNAPSHOT_DIR):
+        self.folder = folder
+        self.index_path = os.path.join(folder, "index.json")
+        os.makedirs(os.path.join(folder, "manifests"), exist_ok=True)
+        self._lock = FileLock(os.path.join(folder, "index.lock"))
+
+    # Metadata
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _write_index(self, entries):
+        write_atomic(self.index_path, json.dumps(entries, indent=1).encode("utf-8"))
+
+    def list(self):
+        # Newest first; reads the index only, never a block
+        with self._lock.shared():
+            return self._read_index()
+
+    def rename(self, snapshot_id, name):
+        with self._lock:
+            entries = self._read_index()
+            for entry in entries:
+                if entry["id"] == snapshot_id:
+                    entry["name"] = name
+            self._write_index(entries)
+
+    # Blocks
+
+    def _block_path(self, digest):
+        return os.path.join(self.folder, "blocks", digest[:2], digest + ".json.gz")
+
+    def _put_block(self, records):
+        data = json.dumps(records, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._block_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # mtime=0 keeps the gzip bytes identical for identical blocks
+            write_atomic(path, gzip.compress(data, mtime=0))
+        return digest
+
+    def _get_block(self, digest):
+        with open(self._block_path(digest), "rb") as f:
+            return json.loads(gzip.decompress(f.read()))
+
+    # Snapshots
+
+    @timed("snapshot save")
+    def save(self, frame, name=None):
+        frame = frame[EXPENSE_COLUMNS]
+        blocks = []
+        for _, block in frame.groupby(frame.index // BLOCK_ROWS, sort=True):
+            records = [[int(expense_id), *clean_row(row).values()]
+                       for expense_id, row in block.to_dict("index").items()]
+            blocks.append(self._put_block(records))
+        created = datetime.now()
+        entry = {
+            "id": uuid.uuid4().hex,
+            "name": name or f"History from {created:%Y-%m-%d %H:%M}",
+            "created": f"{created:%Y-%m-%d %H:%M}",
+            "rows": len(frame),
+            "total": float(convert(frame)["Amount"].sum()),
+        }
+        manifest = os.path.join(self.folder, "manifests", entry["id"] + ".json")
+        write_atomic(manifest, json.dumps({"blocks": blocks}).encode("utf-8"))
+        with self._lock:
+            entries = self._read_index()
+            entries.insert(0, entry)
+            self._write_index(entries)
+        return entry
+
+    @timed("snapshot load")
+    def load(self, snapshot_id):
+        with open(os.path.join(self.folder, "manifests", snapshot_id + ".json"), encoding="utf-8") as f:
+            blocks = json.load(f)["blocks"]
+        records = [record for digest in blocks for record in self._get_block(digest)]
+        if not records:
+            return typed_frame(empty_frame())
+        # Snapshots taken before a column was added have shorter records
+        width = len(EXPENSE_COLUMNS) + 1
+        records = [record + [None] * (width - len(record)) if len(record) < width else record for record in records]
+        frame = pd.DataFrame(records, columns=["id"] + EXPENSE_COLUMNS).set_index("id")
+        return typed_frame(frame)
+
+
+_snapshot_stores = {}
+_snapshot_stores_lock = threading.Lock()
+
+
+def get_snapshots(username=None):
+    folder = snapshot_dir(username)
+    with _snapshot_stores_lock:
+        if folder not in _snapshot_stores:
+            _snapshot_stores[folder] = SnapshotStore(folder)
+        return _snapshot_stores[folder]
@@ -0,0 +1,254 @@
+import io
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from currency import currencies
+from engine import category_tree
+from expense_store import EXPENSE_COLUMNS, FileLock, partition_dir
+from profiling import timed
+
+# Bank and card statements (CSV, OFX or QFX) turned into expenses a whole
+# batch at a time: every check below is a vectorized operation over the
+# statement's columns, never a Python loop over its rows. Valid rows go to the
+# store in a single apply(), so an import lands completely or not at all.
+#
+# OFX transaction ids (FITID, qualified by the account) of every imported
+# row are kept in a text file beside the store, so importing an overlapping
+# or repeated statement skips what is already there.
+
+# Lower-cased CSV headers for each field, first match wins
+CSV_COLUMNS = {
+    "Date": ["date", "transaction date", "trans. date", "posted date", "post date", "posting date"],
+    "Amount": ["amount", "transaction amount"],
+    "Debit": ["debit", "withdrawal", "withdrawals"],
+    "Credit": ["credit", "deposit", "deposits"],
+    "Category": ["category"],
+    "Currency": ["currency", "currency code"],
+}
+
+# Date layouts tried in turn; each fills only the rows earlier ones couldn't read
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d.%m.%Y", "%Y%m%d"]
+
+_OFX_CURRENCY = re.compile(r"<CURDEF>([^<\r\n]*)", re.I)
+_OFX_ACCOUNT = re.compile(r"<ACCTID>([^<\r\n]*)", re.I)
+_OFX_TRANSACTION = re.compile(r"<STMTTRN>(.*?)(?:</STMTTRN>|(?=<STMTTRN>)|(?=</BANKTRANLIST>))", re.I | re.S)
+
+ImportResult = namedtuple("ImportResult", "inserted errors")
+
+IMPORTED_IDS_NAME = "imported_ids.txt"
+
+
+def imported_ids_file(username=None):
+    # IMPORTED_IDS_NAME on its own belongs to the shared store
+    if username is None:
+        return IMPORTED_IDS_NAME
+    return os.path.join(partition_dir(username), IMPORTED_IDS_NAME)
+
+
+def _read_imported_ids(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def _text(source):
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            data = f.read()
+    else:
+        data = source.read()
+    # OFX 1.x files are often declared as CHARSET:1252
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1252")
+
+
+def _is_ofx(text, name):
+    if name and os.path.splitext(name)[1].lower() in (".ofx", ".qfx"):
+        return True
+    head = text.lstrip()[:200].upper()
+    return head.startswith("OFXHEADER") or "<OFX>" in head or head.startswith("<?XML")
+
+
+def _read_ofx(text):
+    # QFX is OFX with an Intuit header, so both parse the same way. Tags may
+    # or may not be closed (SGML vs XML), so a field runs to the next "<".
+    blocks = pd.Series(_OFX_TRANSACTION.findall(text), dtype=object)
+    fields = {name: blocks.str.extract(rf"<{tag}>([^<\r\n]*)", flags=re.I, expand=False).str.strip()
+              for name, tag in [("Date", "DTPOSTED"), ("Amount", "TRNAMT"), ("Id", "FITID")]}
+    frame = pd.DataFrame(fields)
+    # One statement currency for every transaction; FITIDs are only unique
+    # within an account
+    currency = _OFX_CURRENCY.search(text)
+    account = _OFX_ACCOUNT.search(text)
+    ids = frame["Id"].where(frame["Id"].notna() & (frame["Id"] != ""), None)
+    if account:
+        ids = account.group(1).strip() + ":" + ids
+    return pd.DataFrame({
+        # YYYYMMDD, optionally followed by a time and time zone
+        "Date": frame["Date"].str[:8],
+        "Amount": frame["Amount"],
+        "Category": None,
+        "Id": ids,
+        "Currency": currency.group(1).strip() if currency else None,
+    }), True
+
+
+def _read_csv(text):
+    frame = pd.read_csv(io.StringIO(text), dtype=str, skipinitialspace=True)
+    headers = {column.strip().lower(): column for column in frame.columns}
+    picked = {}
+    for field, aliases in CSV_COLUMNS.items():
+        match = next((headers[alias] for alias in aliases if alias in headers), None)
+        if match is not None:
+            picked[field] = frame[match]
+        elif field == "Date":
+            raise ValueError("The statement has no date column")
+        else:
+            picked[field] = pd.Series(None, index=frame.index, dtype=object)
+    debit, credit = picked["Debit"], picked["Credit"]
+    if picked["Amount"].notna().any():
+        amounts = _parse_amounts(picked["Amount"])
+        # Card exports list charges as positive, bank exports as negative;
+        # whichever sign most rows have is taken to be spending
+        charges_negative = (amounts < 0).sum() > (amounts > 0).sum()
+        amount = picked["Amount"]
+    elif debit.notna().any() or credit.notna().any():
+        # Separate debit and credit columns: credits become negative spending
+        amount = debit.where(debit.notna() & (debit.str.strip() != ""), "-" + credit.fillna("").str.strip())
+        charges_negative = False
+    else:
+        raise ValueError("The statement has no amount column")
+    return pd.DataFrame({
+        "Date": picked["Date"],
+        "Amount": amount,
+        "Category": picked["Category"],
+        "Id": None,
+        "Currency": picked["Currency"],
+    }), charges_negative
+
+
+def _parse_amounts(values):
+    # "$1,234.50", "(12.00)" and "12.00-" all read as numbers
+    text = values.astype(str).str.strip()
+    negative = text.str.startswith("(") | text.str.endswith("-") | text.str.startswith("-")
+    digits = text.str.replace(r"[^0-9.]", "", regex=True)
+    amounts = pd.to_numeric(digits.where(digits != "", None), errors="coerce")
+    return amounts.where(~negative, -amounts)
+
+
+def _parse_dates(values):
+    text = values.astype(str).str.strip()
+    # Second resolution holds any four-digit year, so a typo like 2925 is
+    # reported as a future date instead of failing the whole statement
+    dates = pd.Series(pd.NaT, index=values.index, dtype="datetime64[s]")
+    for layout in DATE_FORMATS:
+        missing = dates.isna()
+        if not missing.any():
+            break
+        dates[missing] = pd.to_datetime(text[missing], format=layout, errors="coerce")
+    return dates
+
+
+def _normalize_categories(values, categories):
+    # Known categories whatever their case; anything else files under Other
+    by_lower = {category.lower(): category for category in categories}
+    fallback = "Other" if "Other" in categories else None
+    matched = values.fillna("").str.strip().str.lower().map(by_lower).astype(object)
+    return matched.where(matched.notna(), fallback)
+
+
+def read_statement(source, name=None):
+    """Reads a statement into raw Date, Amount, Category, Id and Currency
+    columns, plus whether charges carry a negative sign in it.
+
+    source is a path or a binary file object such as an upload; name (or the
+    path) picks OFX/QFX over CSV by extension, else the content decides.
+    """
+    if name is None and isinstance(source, str):
+        name = source
+    text = _text(source)
+    return _read_ofx(text) if _is_ofx(text, name) else _read_csv(text)
+
+
+def validate_statement(raw, charges_negative, categories=None, imported_ids=()):
+    """Splits raw statement rows into expenses and per-row errors.
+
+    Returns a frame of EXPENSE_COLUMNS for the rows that pass, a frame of
+    Row (counting transactions from 1) and Error for the rows that don't,
+    and the transaction ids of the rows that pass. Categories are matched
+    against categories, by default every category in the tree. Rows whose
+    id is in imported_ids were imported before. Rows without a currency are
+    in the base currency.
+    """
+    if categories is None:
+        categories = category_tree().names()
+    codes = raw["Currency"].astype(object).str.strip().str.upper()
+    codes = codes.where(codes.notna() & (codes != ""), None)
+    dates = _parse_dates(raw["Date"])
+    amounts = _parse_amounts(raw["Amount"])
+    if charges_negative:
+        amounts = -amounts
+    today = pd.Timestamp.now().normalize()
+    duplicate_ids = raw["Id"].notna() & raw["Id"].duplicated(keep="first")
+
+    # Checked in order; a row is reported for the first check it fails
+    checks = [
+        (dates.isna(), "Unreadable date"),
+        (dates > today, "Date cannot be in the future"),
+        (amounts.isna(), "Unreadable amount"),
+        (amounts == 0, "Amount must not be zero"),
+        (amounts < 0, "Credit or payment, not an expense"),
+        (duplicate_ids, "Duplicate transaction id"),
+        (raw["Id"].isin(list(imported_ids)), "Already imported"),
+        (codes.notna() & ~codes.isin(currencies()), "Unknown currency"),
+    ]
+    conditions = [mask.to_numpy(dtype=bool) for mask, _ in checks]
+    messages = np.select(conditions, [message for _, message in checks], default="")
+    failed = messages != ""
+
+    errors = pd.DataFrame({"Row": np.flatnonzero(failed) + 1, "Error": messages[failed]})
+    valid = ~failed
+    expenses = pd.DataFrame({
+        "Date": dates[valid].dt.strftime("%Y-%m-%d"),
+        "Amount": amounts[valid].round(2).astype("float64"),
+        "Category": _normalize_categories(raw["Category"][valid], list(categories)),
+        "Receipt": None,
+        "Currency": codes[valid],
+    })
+    ids = raw["Id"][valid].dropna().tolist()
+    return expenses[EXPENSE_COLUMNS].reset_index(drop=True), errors, ids
+
+
+@timed("import statement")
+def import_statement(store, source, name=None, categories=None, ids_file=IMPORTED_IDS_NAME):
+    """Imports a statement's valid rows in one store.apply() and returns an
+    ImportResult with the number inserted and the rejected rows.
+
+    Transactions whose id is listed in ids_file are rejected as already
+    imported, and the ids of the rows inserted are added to it.
+    """
+    raw, charges_negative = read_statement(source, name)
+    folder = os.path.dirname(ids_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    # Held until the ids are written, so two imports of one file can't both pass the check
+    with FileLock(ids_file + ".lock"):
+        expenses, errors, ids = validate_statement(raw, charges_negative, categories, _read_imported_ids(ids_file))
+        if expenses.empty:
+            return ImportResult(0, errors)
+        # Building the rows from column lists skips DataFrame.to_dict's per-cell work
+        columns = [expenses[column].tolist() for column in EXPENSE_COLUMNS]
+        inserted = store.apply([{"op": "insert", "row": dict(zip(EXPENSE_COLUMNS, values))}
+                                for values in zip(*columns)])
+        if ids:
+            with open(ids_file, "a", encoding="utf-8") as f:
+                f.write("".join(f"{transaction_id}\n" for transaction_id in ids))
+    return ImportResult(len(inserted), errors)
@@ -0,0 +1,204 @@
+import csv
+import io
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+
+from expense_store import EXPENSE_COLUMNS, STREAM_CHUNK_ROWS, clean_row
+from receipt_store import RECEIPT_DIR, save_receipt
+
+# Deterministic fake expenses for load testing: the same seed and row count
+# always give the same rows, so benchmark runs can be compared. Rows come out
+# in chunks, so 10M rows never sit in memory at once.
+
+# category: (share of random expenses, median amount, spread of log amount)
+CATEGORY_PROFILES = {
+    "Food": (0.22, 18.0, 0.6),
+    "Transport": (0.12, 12.0, 0.7),
+    "Utilities": (0.04, 85.0, 0.4),
+    "Entertainment": (0.08, 25.0, 0.8),
+    "Shopping": (0.14, 40.0, 1.0),
+    "Healthcare": (0.03, 60.0, 0.9),
+    "Education": (0.02, 45.0, 0.9),
+    "Housing": (0.02, 120.0, 0.8),
+    "Savings": (0.02, 100.0, 0.5),
+    "Insurance": (0.02, 90.0, 0.3),
+    "Subscriptions": (0.05, 12.0, 0.4),
+    "Personal Care": (0.06, 22.0, 0.6),
+    "Gifts": (0.04, 35.0, 0.8),
+    "Travel": (0.03, 150.0, 1.1),
+    "Other": (0.09, 20.0, 1.0),
+}
+
+# description, amount, category, day of the month it is charged
+RECURRING_EXPENSES = [
+    ("Rent", 1450.00, "Housing", 1),
+    ("Netflix Subscription", 15.99, "Subscriptions", 3),
+    ("Gym Membership", 50.00, "Personal Care", 5),
+    ("Bus Pass", 100.00, "Transport", 1),
+    ("Phone Bill", 65.00, "Utilities", 12),
+    ("Car Insurance", 118.40, "Insurance", 20),
+]
+
+PAYMENT_METHODS = [
+    ("Chase Credit", "credit", "1234", "2027-12"),
+    ("Bank of America Debit", "debit", "5678", "2026-08"),
+    ("Cash", "cash", "", ""),
+    ("Venmo", "digital", "", ""),
+    ("Amex Gold", "credit", "9012", "2028-03"),
+]
+
+MERCHANTS = ["Whole Foods Market", "Metro Transit", "Power Company", "Cinema City", "Target",
+             "CVS Pharmacy", "Campus Books", "Shell", "Amazon", "Corner Cafe"]
+
+# Distinct receipt images; receipts are content-addressed, so rows share them
+RECEIPT_POOL = 64
+
+
+def _months(start, end):
+    month = date(start.year, start.month, 1)
+    while month <= end:
+        yield month
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _receipt_image(merchant, amount, number):
+    image = Image.new("L", (160, 220), 255)
+    draw = ImageDraw.Draw(image)
+    draw.text((10, 10), merchant, fill=0)
+    draw.text((10, 40), f"Receipt #{number:05d}", fill=0)
+    draw.text((10, 180), f"TOTAL ${amount:,.2f}", fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def receipt_pool(seed=0, size=RECEIPT_POOL, root=RECEIPT_DIR):
+    # Receipt references for size generated images, saved to the receipt store under root
+    rng = np.random.default_rng(seed)
+    return [save_receipt(_receipt_image(MERCHANTS[rng.integers(len(MERCHANTS))],
+                                        float(rng.lognormal(3, 1)), number), root)
+            for number in range(size)]
+
+
+def recurring_rows(start, end):
+    rows = []
+    for month in _months(start, end):
+        for _, amount, category, day in RECURRING_EXPENSES:
+            charged = month.replace(day=day)
+            if start <= charged <= end:
+                rows.append({"Date": charged.isoformat(), "Amount": amount, "Category": category, "Receipt": None})
+    return rows
+
+
+def generate_expenses(rows, seed=0, start=date(2020, 1, 1), end=date(2025, 12, 31), receipt_ratio=0.1,
+                      chunk_rows=STREAM_CHUNK_ROWS, receipts=None):
+    """Yields frames of synthetic expenses, rows in total.
+
+    Monthly recurring charges come first, then random expenses with
+    log-normal amounts per category, dates spread evenly over the range and
+    receipt_ratio of them carrying one of the receipts references.
+    """
+    rng = np.random.default_rng(seed)
+    recurring = recurring_rows(start, end)[:rows]
+    if recurring:
+        yield pd.DataFrame(recurring, columns=EXPENSE_COLUMNS)
+    remaining = rows - len(recurring)
+
+    names = list(CATEGORY_PROFILES)
+    shares = np.array([CATEGORY_PROFILES[name][0] for name in names])
+    shares = shares / shares.sum()
+    medians = np.log([CATEGORY_PROFILES[name][1] for name in names])
+    spreads = np.array([CATEGORY_PROFILES[name][2] for name in names])
+    first, days = np.datetime64(start), (np.datetime64(end) - np.datetime64(start)).astype(int) + 1
+    receipts = receipts or []
+    while remaining > 0:
+        size = min(chunk_rows, remaining)
+        picks = rng.choice(len(names), size=size, p=shares)
+        amounts = np.round(rng.lognormal(medians[picks], spreads[picks]), 2)
+        dates = first + np.sort(rng.integers(0, days, size=size)).astype("timedelta64[D]")
+        chunk = pd.DataFrame({
+            "Date": np.datetime_as_string(dates, unit="D"),
+            "Amount": np.maximum(amounts, 0.01),
+            "Category": np.array(names, dtype=object)[picks],
+            "Receipt": None,
+        })
+        if receipts and receipt_ratio:
+            has_receipt = rng.random(size) < receipt_ratio
+            chunk.loc[has_receipt, "Receipt"] = np.array(receipts, dtype=object)[
+                rng.integers(len(receipts), size=int(has_receipt.sum()))]
+        yield chunk
+        remaining -= size
+
+
+def load_synthetic(store, rows, seed=0, receipt_ratio=0.1, tables=None, receipt_dir=RECEIPT_DIR, **kwargs):
+    """Inserts synthetic expenses into the store a chunk at a time.
+
+    With tables set to a folder, the matching categories, payment methods,
+    recurring expenses and receipts tables are written there too, in the
+    layout of csv_collection/. Receipt images are saved under receipt_dir.
+    Returns the number of rows inserted.
+    """
+    receipts = receipt_pool(seed, root=receipt_dir) if receipt_ratio else []
+    receipt_file = None
+    if tables:
+        write_reference_tables(tables)
+        receipt_file = open(os.path.join(tables, "receipts.csv"), "w", newline="", encoding="utf-8")
+        receipt_writer = csv.writer(receipt_file)
+        receipt_writer.writerow(["receipt_id", "expense_id", "file_path", "upload_date", "processed", "ocr_text"])
+    inserted = 0
+    receipt_count = 0
+    try:
+        for chunk in generate_expenses(rows, seed, receipt_ratio=receipt_ratio, receipts=receipts, **kwargs):
+            records = chunk.to_dict("records")
+            ids = store.apply([{"op": "insert", "row": clean_row(row)} for row in records])
+            inserted += len(ids)
+            if receipt_file is not None:
+                for expense_id, row in zip(ids, records):
+                    if row["Receipt"]:
+                        receipt_count += 1
+                        receipt_writer.writerow([receipt_count, expense_id, row["Receipt"], row["Date"], "false", ""])
+    finally:
+        if receipt_file is not None:
+            receipt_file.close()
+    return inserted
+
+
+def write_reference_tables(folder):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "categories.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["category_id", "name", "color", "icon", "parent_category", "budget_limit"])
+        for number, (name, (_, median, _)) in enumerate(CATEGORY_PROFILES.items(), start=1):
+            writer.writerow([number, name, "", "", "", f"{median * 20:.2f}"])
+    with open(os.path.join(folder, "payment_methods.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["method_id", "name", "type", "last_four", "expiry_date", "active"])
+        for number, method in enumerate(PAYMENT_METHODS, start=1):
+            writer.writerow([number, *method, "true"])
+    with open(os.path.join(folder, "recurring_expenses.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["recurring_id", "description", "amount", "category", "frequency",
+                         "start_date", "end_date", "active"])
+        for number, (description, amount, category, _) in enumerate(RECURRING_EXPENSES, start=1):
+            writer.writerow([number, description, f"{amount:.2f}", category, "monthly", "2020-01-01", "", "true"])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from expense_store import get_store
+
+    parser = argparse.ArgumentParser(description="Fill a user's store with synthetic expenses")
+    parser.add_argument("rows", type=int)
+    parser.add_argument("--user", help="partition to fill; the shared store if omitted")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--receipts", type=float, default=0.1, help="share of expenses with a receipt")
+    parser.add_argument("--tables", help="also write categories, payment methods, recurring and receipts CSVs here")
+    args = parser.parse_args()
+
+    count = load_synthetic(get_store(args.user), args.rows, args.seed, args.receipts, args.tables)
+    print(f"Inserted {count:,} synthetic expenses")
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from expense_store import JournalStore, SQLiteStore  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # Modules resolve their default files against the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(params=["sqlite", "journal"])
+def store(request, tmp_path):
+    if request.param == "journal":
+        return JournalStore(str(tmp_path / "expenses.csv"), str(tmp_path / "expenses.journal"))
+    return SQLiteStore(str(tmp_path / "expenses.db"))
+
+
+def expense(date, amount, category="Food", currency=None):
+    return {"Date": date, "Amount": amount, "Category": category, "Receipt": None, "Currency": currency}
@@ -0,0 +1,141 @@
+import gzip
+
+import pytest
+
+import backup_store
+from backup_store import BackupError, restore_backup, verify_backup, write_backup
+from conftest import expense
+
+
+def _amounts(store):
+    return store.load()["Amount"].tolist()
+
+
+def _fill(store, amounts):
+    # Ids 0, 1, ... so tests know which block each row is in
+    store.apply([{"op": "insert", "id": expense_id, "row": expense(f"2025-01-{expense_id + 1:02d}", amount)}
+                 for expense_id, amount in enumerate(amounts)])
+
+
+def test_full_backup_restores_everything(store, tmp_path):
+    store.insert(expense("2025-01-05", 10.0))
+    euros = store.insert(expense("2025-01-06", 4.0, currency="EUR"))
+    path = write_backup(store, str(tmp_path / "backups"))
+    store.clear()
+    store.insert(expense("2025-03-01", 99.0))
+    header = restore_backup(store, path)
+    assert header["kind"] == "full"
+    assert _amounts(store) == [10.0, 4.0]
+    assert store.get(euros)["Currency"] == "EUR"
+
+
+def test_incremental_backup_carries_only_changed_blocks(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_store, "BLOCK_ROWS", 2)
+    folder = str(tmp_path / "backups")
+    _fill(store, [1.0, 2.0, 3.0, 4.0])
+    write_backup(store, folder)
+    store.update(3, {"Amount": 30.0})
+    path = write_backup(store, folder, incremental=True)
+    header = verify_backup(path)
+    assert header["kind"] == "incremental"
+    assert header["blocks"] == [1]
+
+    store.update(3, {"Amount": 300.0})
+    restore_backup(store, path)
+    assert _amounts(store) == [1.0, 2.0, 3.0, 30.0]
+
+
+def test_incremental_restore_refuses_a_store_that_moved_on(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_store, "BLOCK_ROWS", 2)
+    folder = str(tmp_path / "backups")
+    _fill(store, [1.0, 2.0, 3.0, 4.0])
+    write_backup(store, folder)
+    store.update(3, {"Amount": 30.0})
+    path = write_backup(store, folder, incremental=True)
+    # Block 0 is not in the incremental backup and no longer matches its parent
+    store.update(0, {"Amount": 10.0})
+    with pytest.raises(BackupError, match="no longer match"):
+        restore_backup(store, path)
+    assert _amounts(store) == [10.0, 2.0, 3.0, 30.0]
+
+
+def test_incremental_backup_aborts_when_the_store_changes(store, tmp_path, monkeypatch):
+    folder = str(tmp_path / "backups")
+    store.insert(expense("2025-01-05", 10.0))
+    write_backup(store, folder)
+    store.insert(expense("2025-01-06", 4.0))
+    lines = backup_store._lines
+    calls = []
+
+    def racing_lines(source):
+        calls.append(source)
+        if len(calls) == 2:
+            store.insert(expense("2025-01-07", 1.0))
+        return lines(source)
+
+    monkeypatch.setattr(backup_store, "_lines", racing_lines)
+    with pytest.raises(BackupError, match="changed during the backup"):
+        write_backup(store, folder, incremental=True)
+    assert [name for name in (tmp_path / "backups").iterdir() if name.suffix == ".tmp"] == []
+
+
+def test_damaged_backup_changes_nothing(store, tmp_path):
+    store.insert(expense("2025-01-05", 10.0))
+    store.insert(expense("2025-01-06", 4.0))
+    path = write_backup(store, str(tmp_path / "backups"))
+    with gzip.open(path, "rt") as f:
+        lines = f.readlines()
+    damaged = str(tmp_path / "damaged.ndjson.gz")
+    with gzip.open(damaged, "wt") as f:
+        f.writelines(lines[:-1])
+    store.clear()
+    store.insert(expense("2025-02-01", 1.0))
+    with pytest.raises(BackupError, match="truncated"):
+        restore_backup(store, damaged)
+    assert _amounts(store) == [1.0]
+
+
+def test_not_a_backup_is_rejected(tmp_path):
+    path = str(tmp_path / "other.gz")
+    with gzip.open(path, "wt") as f:
+        f.write('{"hello": 1}\n')
+    with pytest.raises(BackupError, match="Not an expense backup"):
+        verify_backup(path)
+
+
+def test_restore_streams_more_rows_than_one_chunk(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_store, "RESTORE_CHUNK_ROWS", 7)
+    _fill(store, [float(number) for number in range(25)])
+    path = write_backup(store, str(tmp_path / "backups"))
+    store.clear()
+    chunks = []
+    apply_chunks = store.apply_chunks
+
+    def counting(batches, expected_version=None):
+        return apply_chunks((chunks.append(len(batch)) or batch for batch in batches), expected_version)
+
+    monkeypatch.setattr(store, "apply_chunks", counting)
+    restore_backup(store, path)
+    assert chunks == [7, 7, 7, 5]
+    assert _amounts(store) == [float(number) for number in range(25)]
+
+
+def test_restore_failing_partway_changes_nothing(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_store, "RESTORE_CHUNK_ROWS", 5)
+    _fill(store, [float(number) for number in range(20)])
+    path = write_backup(store, str(tmp_path / "backups"))
+    store.clear()
+    store.insert(expense("2025-02-01", 1.0))
+    read = backup_store._read
+
+    def failing_read(source):
+        for number, record in enumerate(read(source)):
+            if number == 12:
+                raise BackupError("The backup file is damaged: gone")
+            yield record
+
+    monkeypatch.setattr(backup_store, "verify_backup", lambda source: None)
+    monkeypatch.setattr(backup_store, "_read", failing_read)
+    with pytest.raises(BackupError, match="gone"):
+        restore_backup(store, path)
+    assert _amounts(store) == [1.0]
@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from budgets import load_budgets, load_limits, limits_file, save_limits
+
+ROOT_LIMITS = {"Food": 310.0, "Travel": 620.0}
+
+BUDGETS = """budget_id,period,category,start_date,end_date,total_amount,currency
+1,Q1,,2025-01-01,2025-03-31,900,
+2,Trip,Travel,2025-02-01,2025-02-28,280,
+3,Late Feb,Travel,2025-02-15,2025-03-14,560,
+4,Euro,Food,2025-05-01,2025-05-31,100,EUR
+5,Backwards,Food,2025-06-30,2025-06-01,50,
+"""
+
+
+@pytest.fixture
+def budgets(tmp_path):
+    path = tmp_path / "budgets.csv"
+    path.write_text(BUDGETS)
+    # No exchange rates in the test folder, so the EUR period can't be priced
+    with pytest.warns(UserWarning, match="EUR"):
+        return load_budgets(ROOT_LIMITS, str(path))
+
+
+def _daily(index, scope, *days):
+    return index.daily([scope] * len(days), pd.to_datetime(list(days))).tolist()
+
+
+def test_period_days_share_its_amount(budgets):
+    assert _daily(budgets, "", "2025-01-01", "2025-03-31") == pytest.approx([10.0, 10.0])
+
+
+def test_later_period_takes_over_an_overlap(budgets):
+    # Trip is cut to Feb 1-14 and keeps 10 a day; Late Feb runs at 20 a day
+    assert _daily(budgets, "Travel", "2025-02-01", "2025-02-14", "2025-02-15", "2025-03-14") == \
+        pytest.approx([10.0, 10.0, 20.0, 20.0])
+
+
+def test_uncovered_days_fall_back_to_the_monthly_limit(budgets):
+    assert _daily(budgets, "Travel", "2025-03-20") == pytest.approx([620.0 / 31])
+    assert _daily(budgets, "", "2025-04-10") == pytest.approx([930.0 / 30])
+    # The EUR period and the one ending before it starts were left out
+    assert _daily(budgets, "Food", "2025-05-10", "2025-06-10") == pytest.approx([310.0 / 31, 310.0 / 30])
+
+
+def test_scope_without_any_budget_is_nan(budgets):
+    assert np.isnan(_daily(budgets, "Pets", "2025-02-10")[0])
+
+
+def test_active_budget(budgets):
+    assert budgets.active("2025-02-20", "Travel")["Name"] == "Late Feb"
+    assert budgets.active("2025-02-20", "Travel")["Amount"] == 560.0
+    fallback = budgets.active("2025-04-10")
+    assert (fallback["Name"], fallback["Amount"]) == ("April 2025", 930.0)
+    assert budgets.active("2025-04-10", "Pets") is None
+
+
+def test_allowance_adds_up_the_days_of_each_period(budgets):
+    monthly = budgets.allowance("2025-02-01", "2025-02-28", "M", ["Travel"])
+    assert monthly["Budget"].tolist() == pytest.approx([14 * 10.0 + 14 * 20.0])
+    custom = budgets.allowance("2025-02-01", "2025-02-28", [("2025-02-10", "2025-02-16")], ["Travel"])
+    assert custom["Budget"].tolist() == pytest.approx([5 * 10.0 + 2 * 20.0])
+
+
+def test_partial_last_period_gets_a_partial_budget(budgets):
+    weekly = budgets.allowance("2025-01-01", "2025-01-03", "W")
+    assert weekly["Budget"].sum() == pytest.approx(30.0)
+
+
+def test_saved_limits_are_kept_per_user():
+    save_limits({"Food": 50}, limits_file("alice"))
+    assert load_limits(ROOT_LIMITS, limits_file("alice")) == {"Food": 50.0, "Travel": 620.0}
+    assert load_limits(ROOT_LIMITS, limits_file("bob")) == ROOT_LIMITS
+
+
+def test_bad_saved_limits_are_ignored(tmp_path):
+    path = tmp_path / "limits.json"
+    path.write_text(json.dumps({"Food": -1, "Travel": "lots", "Rent": 900}))
+    assert load_limits(ROOT_LIMITS, str(path)) == {"Food": 310.0, "Travel": 620.0, "Rent": 900.0}
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from currency import base_rates, convert, convert_amount, convert_rollup, currencies, format_money
+
+
+@pytest.fixture
+def rates(tmp_path):
+    path = tmp_path / "fx_rates.csv"
+    path.write_text("date,currency,rate\n"
+                    "2025-01-01,EUR,1.10\n"
+                    "2025-02-01,EUR,1.20\n"
+                    "2025-01-15,GBP,1.30\n"
+                    "2025-03-01, eur ,1.25\n")
+    return str(path)
+
+
+def test_rate_in_force_on_each_date(rates):
+    dates = pd.to_datetime(["2025-01-01", "2025-01-31", "2025-02-01", "2025-02-28", "2025-06-01"])
+    found = base_rates(dates, ["EUR"] * 5, rates)
+    assert np.allclose(found, [1.10, 1.10, 1.20, 1.20, 1.25])
+
+
+def test_dates_before_the_first_rate_take_the_first(rates):
+    assert base_rates(pd.to_datetime(["2024-12-01"]), ["GBP"], rates)[0] == pytest.approx(1.30)
+
+
+def test_base_and_blank_codes_are_one(rates):
+    dates = pd.to_datetime(["2025-01-01"] * 3)
+    assert base_rates(dates, ["USD", "", None], rates).tolist() == [1.0, 1.0, 1.0]
+
+
+def test_currency_without_rates_raises(rates):
+    with pytest.raises(ValueError, match="JPY"):
+        base_rates(pd.to_datetime(["2025-01-01"]), ["JPY"], rates)
+
+
+def test_currencies_lists_only_those_with_rates(rates, tmp_path):
+    assert currencies(rates) == ["USD", "EUR", "GBP"]
+    empty = tmp_path / "empty.csv"
+    empty.write_text("date,currency,rate\n")
+    assert currencies(str(empty)) == ["USD"]
+
+
+def test_edited_table_is_read_again(rates):
+    assert currencies(rates) == ["USD", "EUR", "GBP"]
+    with open(rates, "a") as f:
+        f.write("2025-01-01,CHF,1.15\n")
+    assert currencies(rates) == ["USD", "CHF", "EUR", "GBP"]
+
+
+def test_convert_mixed_frame(rates):
+    frame = pd.DataFrame({"Date": pd.to_datetime(["2025-01-10", "2025-02-10", "2025-02-10"]),
+                          "Amount": [10.0, 10.0, 5.0], "Currency": ["EUR", "EUR", None]})
+    converted = convert(frame, "USD", rates)
+    assert converted["Amount"].tolist() == pytest.approx([11.0, 12.0, 5.0])
+    assert (converted["Currency"] == "USD").all()
+    assert convert(frame, "EUR", rates)["Amount"].tolist() == pytest.approx([10.0, 10.0, 5.0 / 1.2])
+
+
+def test_convert_leaves_frames_already_in_target(rates):
+    frame = pd.DataFrame({"Date": pd.to_datetime(["2025-01-10"]), "Amount": [3.0], "Currency": ["USD"]})
+    assert convert(frame, "USD", rates) is frame
+
+
+def test_convert_amount_between_two_foreign_currencies(rates):
+    assert convert_amount(13.0, "GBP", "EUR", "2025-02-10", rates) == pytest.approx(13.0 * 1.30 / 1.20)
+
+
+def test_rollup_converts_at_month_close_and_merges(rates):
+    rollup = pd.DataFrame({"YearMonth": [202501, 202501], "Category": ["Food", "Food"],
+                           "Currency": ["", "EUR"], "Total": [5.0, 10.0], "Count": [1, 2]})
+    merged = convert_rollup(rollup, "USD", rates)
+    assert len(merged) == 1
+    assert merged["Total"].iloc[0] == pytest.approx(5.0 + 11.0)
+    assert merged["Count"].iloc[0] == 3
+
+
+def test_format_money():
+    assert format_money(1234.5, "USD") == "$1,234.50"
+    assert format_money(-3, "JPY") == "-¥3"
+    assert format_money(2, "CHF") == "2.00 CHF"
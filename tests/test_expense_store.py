@@ -0,0 +1,119 @@
+import sqlite3
+
+import pytest
+
+from conftest import expense
+from expense_store import (ConflictError, JournalStore, SQLiteStore, _open_store, adopt_shared, delete_op,
+                           expense_filter, update_op)
+
+
+def test_insert_and_query(store):
+    first = store.insert(expense("2025-01-05", 10.0))
+    store.insert(expense("2025-02-05", 20.0, "Travel"))
+    assert store.get(first)["Amount"] == 10.0
+    assert store.count() == 2
+    assert store.count(categories=["Travel"]) == 1
+    frame = store.query(start="2025-02-01", end="2025-02-28")
+    assert frame["Amount"].tolist() == [20.0]
+
+
+def test_update_with_stale_expect_conflicts(store):
+    expense_id = store.insert(expense("2025-01-05", 10.0))
+    store.apply([update_op(expense_id, {"Amount": 11.0}, expect={"Amount": 10.0})])
+    with pytest.raises(ConflictError):
+        store.apply([update_op(expense_id, {"Amount": 12.0}, expect={"Amount": 10.0})])
+    assert store.get(expense_id)["Amount"] == 11.0
+
+
+def test_delete_of_missing_row_conflicts(store):
+    expense_id = store.insert(expense("2025-01-05", 10.0))
+    store.delete(expense_id)
+    with pytest.raises(ConflictError):
+        store.apply([delete_op(expense_id, expect={"Amount": 10.0})])
+
+
+def test_expected_version_conflicts_after_another_write(store):
+    version = store.version()
+    store.insert(expense("2025-01-05", 10.0))
+    with pytest.raises(ConflictError):
+        store.apply([{"op": "clear"}], expected_version=version)
+    assert store.count() == 1
+
+
+def test_failed_batch_changes_nothing(store):
+    kept = store.insert(expense("2025-01-05", 10.0))
+    with pytest.raises(ConflictError):
+        store.apply([{"op": "insert", "row": expense("2025-01-06", 5.0)},
+                     update_op(kept, {"Amount": 1.0}, expect={"Amount": 99.0})])
+    assert store.count() == 1
+
+
+def test_rollup_follows_inserts_updates_and_deletes(store):
+    a = store.insert(expense("2025-01-05", 10.0))
+    store.insert(expense("2025-01-20", 5.0))
+    b = store.insert(expense("2025-02-01", 7.0, "Travel"))
+    store.update(a, {"Amount": 12.0, "Category": "Travel"})
+    store.delete(b)
+    store.apply([{"op": "shift_dates", "where": expense_filter(categories=["Food"]), "days": 31}])
+    rollup = store.rollup().set_index(["YearMonth", "Category"])
+    assert rollup.loc[(202501, "Travel"), "Total"] == 12.0
+    assert rollup.loc[(202502, "Food"), "Total"] == 5.0
+    assert store.verify_rollup().empty
+
+
+def test_rollup_keeps_currencies_apart(store):
+    store.insert(expense("2025-01-05", 10.0))
+    store.insert(expense("2025-01-06", 3.0, currency="EUR"))
+    rollup = store.rollup(202501)
+    assert sorted(zip(rollup["Currency"], rollup["Total"])) == [("", 10.0), ("EUR", 3.0)]
+
+
+def test_reopened_store_reads_the_same_rows(store):
+    store.insert(expense("2025-01-05", 10.0))
+    store.insert(expense("2025-01-06", 4.0))
+    if isinstance(store, JournalStore):
+        store.compact()
+        reopened = JournalStore(store.base_path, store.journal_path)
+    else:
+        reopened = SQLiteStore(store.path)
+    assert reopened.load()["Amount"].tolist() == [10.0, 4.0]
+    assert reopened.verify_rollup().empty
+
+
+def test_journal_replays_appends_made_by_another_process(tmp_path):
+    paths = str(tmp_path / "e.csv"), str(tmp_path / "e.journal")
+    ours, theirs = JournalStore(*paths), JournalStore(*paths)
+    ours.load()
+    theirs.insert(expense("2025-01-05", 10.0))
+    assert ours.count() == 1
+
+
+def test_sqlite_migrates_a_database_from_before_currencies(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE expenses (id INTEGER PRIMARY KEY, date TEXT, amount REAL, category TEXT, "
+                 "receipt TEXT)")
+    conn.execute("INSERT INTO expenses VALUES (0, '2025-01-05', 10.0, 'Food', NULL)")
+    conn.commit()
+    conn.close()
+    store = SQLiteStore(path)
+    assert store.get(0)["Currency"] is None
+    assert store.month_total(202501) == 10.0
+    assert store.verify_rollup().empty
+
+
+def test_new_login_leaves_the_shared_store_alone():
+    _open_store().insert(expense("2025-01-05", 10.0))
+    assert _open_store("typo").count() == 0
+    assert _open_store().count() == 1
+
+
+def test_adopt_shared_moves_rows_into_an_empty_partition_once():
+    _open_store().insert(expense("2025-01-05", 10.0))
+    _open_store().insert(expense("2025-01-06", 20.0))
+    partition = _open_store("alice")
+    assert adopt_shared("alice", partition) == 2
+    assert partition.count() == 2
+    assert _open_store().count() == 0
+    with pytest.raises(ConflictError):
+        adopt_shared("alice", partition)
@@ -0,0 +1,98 @@
+import sqlite3
+
+import pytest
+
+import ocr_queue
+from ocr_queue import OCRQueue, parse_receipt
+
+RECEIPT = """CORNER MARKET
+123 Main St
+01/14/2025 10:32
+Milk            3.49
+Bread           2.99
+SUBTOTAL        6.48
+TAX             0.52
+TOTAL           7.00
+CASH           10.00
+"""
+
+
+def test_total_line_wins_over_larger_amounts():
+    assert parse_receipt(RECEIPT) == {"amount": 7.0, "date": "2025-01-14", "merchant": "CORNER MARKET"}
+
+
+def test_largest_amount_without_a_total_line():
+    parsed = parse_receipt("Shop\n1,234.50\n12.00\n")
+    assert parsed["amount"] == 1234.5
+    assert parsed["date"] is None
+
+
+def test_day_first_dates_with_dots_and_comma_cents():
+    parsed = parse_receipt("Bäckerei\n14.01.2025\nSumme 3,20\nTotal 3,20\n")
+    assert (parsed["amount"], parsed["date"]) == (3.2, "2025-01-14")
+
+
+def test_nothing_recognisable():
+    assert parse_receipt("\n  \n") == {"amount": None, "date": None, "merchant": None}
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    # The tests claim jobs directly rather than running the dispatcher
+    monkeypatch.setattr(OCRQueue, "start", lambda self: True)
+    return OCRQueue(str(tmp_path / "jobs.db"))
+
+
+def test_enqueue_skips_receipts_seen_before(queue):
+    assert queue.enqueue(["a", "b", "a"]) == 2
+    assert queue.enqueue(["b", "c"]) == 1
+    assert queue.counts() == {"queued": 3}
+
+
+def test_two_queues_never_claim_the_same_job(queue):
+    other = OCRQueue(queue.path)
+    queue.enqueue([f"r{number}" for number in range(10)])
+    first, second = queue._claim(6), other._claim(6)
+    assert len(first) == 6 and len(second) == 4
+    assert not set(first) & set(second)
+
+
+def test_opening_the_queue_leaves_live_jobs_running(queue):
+    queue.enqueue(["a"])
+    queue._claim(1)
+    OCRQueue(queue.path)
+    assert queue.job("a")["status"] == "running"
+
+
+def test_expired_lease_is_claimed_again(queue, monkeypatch):
+    other = OCRQueue(queue.path)
+    queue.enqueue(["a"])
+    monkeypatch.setattr(ocr_queue, "LEASE_SECONDS", -1)
+    assert queue._claim(1) == ["a"]
+    monkeypatch.setattr(ocr_queue, "LEASE_SECONDS", 60)
+    assert other._claim(1) == ["a"]
+    assert queue.job("a")["attempts"] == 2
+
+
+def test_failed_jobs_retry_until_their_attempts_run_out(queue):
+    queue.enqueue(["a"])
+    for _ in range(ocr_queue.MAX_ATTEMPTS):
+        assert queue._claim(1) == ["a"]
+        queue._finish("a", error="tesseract crashed")
+    assert queue.job("a")["status"] == "failed"
+    assert queue.retry_failed() == 1
+    assert queue.job("a")["attempts"] == 0
+
+
+def test_job_table_from_before_leases_is_migrated(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE ocr_jobs (ref TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INTEGER NOT NULL "
+                 "DEFAULT 0, queued TEXT NOT NULL, finished TEXT, error TEXT, text TEXT, amount REAL, date TEXT, "
+                 "merchant TEXT)")
+    conn.execute("INSERT INTO ocr_jobs (ref, status, attempts, queued) VALUES ('a', 'running', 1, '2025-01-01')")
+    conn.commit()
+    conn.close()
+    queue = OCRQueue(path)
+    # Left running by a version without leases, so nothing is renewing it
+    assert queue._claim(1) == ["a"]
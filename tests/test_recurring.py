@@ -0,0 +1,92 @@
+import os
+
+import pandas as pd
+import pytest
+
+from expense_store import partition_dir
+from recurring import RECURRING_FILE, SCHEDULE_NAME, month_occurrences, occurrences, schedule_file
+
+HEADER = "recurring_id,description,amount,category,frequency,start_date,end_date,active\n"
+
+
+@pytest.fixture
+def schedule(tmp_path):
+    def write(*rows):
+        path = tmp_path / "recurring_expenses.csv"
+        path.write_text(HEADER + "".join(row + "\n" for row in rows))
+        return str(path)
+    return write
+
+
+def dates(frame):
+    return [day.strftime("%Y-%m-%d") for day in frame["Date"]]
+
+
+def test_monthly_day_is_clipped_to_short_months(schedule):
+    path = schedule("1,Rent,1000,Housing,monthly,2025-01-31,,true")
+    found = occurrences("2025-01-01", "2025-04-30", path)
+    assert dates(found) == ["2025-01-31", "2025-02-28", "2025-03-31", "2025-04-30"]
+    assert list(found["YearMonth"]) == [202501, 202502, 202503, 202504]
+
+
+def test_yearly_leap_day_falls_on_february_28(schedule):
+    path = schedule("1,Membership,90,Health,yearly,2024-02-29,,")
+    assert dates(occurrences("2024-01-01", "2028-12-31", path)) == [
+        "2024-02-29", "2025-02-28", "2026-02-28", "2027-02-28", "2028-02-29"]
+
+
+def test_quarterly_started_before_the_window(schedule):
+    path = schedule("1,Insurance,300,Insurance,quarterly,2024-11-15,,")
+    assert dates(occurrences("2025-01-01", "2025-06-30", path)) == ["2025-02-15", "2025-05-15"]
+
+
+def test_weekly_stops_at_end_date_inclusive(schedule):
+    path = schedule("1,Gym,30,Health,weekly,2025-01-01,2025-01-22,yes")
+    assert dates(occurrences("2025-01-01", "2025-03-31", path)) == [
+        "2025-01-01", "2025-01-08", "2025-01-15", "2025-01-22"]
+
+
+def test_nothing_before_the_start_date(schedule):
+    path = schedule("1,Stream,12,Fun,monthly,2025-03-10,,")
+    assert dates(occurrences("2025-01-01", "2025-04-30", path)) == ["2025-03-10", "2025-04-10"]
+
+
+def test_inactive_and_unreadable_schedules_are_left_out(schedule):
+    path = schedule("1,Old,5,Other,monthly,2025-01-01,,false",
+                    "2,Typo,abc,Other,monthly,2025-01-01,,",
+                    "3,Hourly,1,Other,hourly,2025-01-01,,",
+                    "4,Undated,1,Other,monthly,,,",
+                    "5,Phone,40,Utilities,monthly,2025-01-05,,1")
+    found = occurrences("2025-01-01", "2025-01-31", path)
+    assert list(found["Description"]) == ["Phone"]
+    assert list(found["Amount"]) == [40.0]
+
+
+def test_occurrences_are_sorted_across_schedules(schedule):
+    path = schedule("1,Rent,1000,Housing,monthly,2025-01-20,,",
+                    "2,Gym,30,Health,biweekly,2025-01-01,,")
+    found = occurrences("2025-01-01", "2025-01-31", path)
+    assert dates(found) == ["2025-01-01", "2025-01-15", "2025-01-20", "2025-01-29"]
+    assert list(found["RecurringId"]) == ["2", "2", "1", "2"]
+
+
+def test_missing_schedule_file_has_no_occurrences(tmp_path):
+    found = occurrences("2025-01-01", "2025-12-31", str(tmp_path / "missing.csv"))
+    assert found.empty
+
+
+def test_month_occurrences_after_a_day(schedule):
+    path = schedule("1,Gym,30,Health,weekly,2025-01-01,,")
+    assert dates(month_occurrences(202501, after=pd.Timestamp("2025-01-15"), path=path)) == [
+        "2025-01-22", "2025-01-29"]
+    assert month_occurrences(202501, after=pd.Timestamp("2025-01-31"), path=path).empty
+
+
+def test_user_without_a_schedule_reads_the_shared_one():
+    assert schedule_file("alice") == RECURRING_FILE
+    os.makedirs(partition_dir("alice"))
+    own = os.path.join(partition_dir("alice"), SCHEDULE_NAME)
+    with open(own, "w") as f:
+        f.write(HEADER)
+    assert schedule_file("alice") == own
+    assert schedule_file() == RECURRING_FILE
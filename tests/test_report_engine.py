@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+
+import expense_store
+import report_engine
+from conftest import expense
+from report_engine import build_report, cancel_report, request_report
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(monkeypatch):
+    # Stores and reports are cached per process; each test has its own folder
+    monkeypatch.setattr(expense_store, "_stores", {})
+    monkeypatch.setattr(report_engine, "_reports", {})
+
+
+def test_report_is_a_pdf(store):
+    store.insert(expense("2025-01-05", 10.0))
+    store.insert(expense("2025-02-05", 20.0, "Travel"))
+    assert build_report(store).startswith(b"%PDF")
+
+
+def test_cancelled_build_stops_before_the_month_pages(store):
+    store.insert(expense("2025-01-05", 10.0))
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(CancelledError):
+        build_report(store, cancelled=cancelled)
+
+
+def test_new_filters_cancel_the_running_build(monkeypatch):
+    started = threading.Event()
+
+    def slow_build(store, filters=None, cancelled=None):
+        started.set()
+        return cancelled.wait(10)
+
+    monkeypatch.setattr(report_engine, "build_report", slow_build)
+    first = request_report("alice", {"categories": ["Food"]})
+    assert started.wait(10)
+    assert request_report("alice", {"categories": ["Food"]}) is first
+    second = request_report("alice", {"categories": ["Travel"]})
+    assert second is not first
+    assert first.result(10) is True
+    cancel_report("alice")
+    assert second.result(10) is True
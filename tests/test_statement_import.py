@@ -0,0 +1,93 @@
+import io
+
+import pandas as pd
+
+from statement_import import _parse_dates, import_statement, read_statement, validate_statement
+
+CATEGORIES = ["Food", "Travel", "Other"]
+
+OFX = """OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>
+<CURDEF>USD
+<BANKACCTFROM><ACCTID>12345</BANKACCTFROM>
+<BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20250105120000[-5:EST]<TRNAMT>-12.50<FITID>A1<NAME>Cafe
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20250106<TRNAMT>-7.00<FITID>A2</STMTTRN>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20250107<TRNAMT>100.00<FITID>A3
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20250108<TRNAMT>-3.00<FITID>A2
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+def _upload(text):
+    return io.BytesIO(text.encode("utf-8"))
+
+
+def test_date_formats_fill_only_rows_earlier_ones_missed():
+    dates = _parse_dates(pd.Series(["2025-01-02", "01/03/2025", "01/04/25", "05.01.2025", "20250106", "soon"]))
+    assert dates.dt.strftime("%Y-%m-%d").tolist()[:5] == [
+        "2025-01-02", "2025-01-03", "2025-01-04", "2025-01-05", "2025-01-06"]
+    assert pd.isna(dates.iloc[5])
+
+
+def test_month_first_wins_for_ambiguous_slashes():
+    assert _parse_dates(pd.Series(["02/03/2025"])).iloc[0] == pd.Timestamp("2025-02-03")
+
+
+def test_ofx_with_unclosed_tags_times_and_credits():
+    raw, charges_negative = read_statement(_upload(OFX), "statement.ofx")
+    assert len(raw) == 4
+    assert raw["Id"].tolist() == ["12345:A1", "12345:A2", "12345:A3", "12345:A2"]
+    expenses, errors, ids = validate_statement(raw, charges_negative, CATEGORIES)
+    assert expenses["Date"].tolist() == ["2025-01-05", "2025-01-06"]
+    assert expenses["Amount"].tolist() == [12.5, 7.0]
+    assert expenses["Currency"].tolist() == ["USD", "USD"]
+    assert dict(zip(errors["Row"], errors["Error"])) == {
+        3: "Credit or payment, not an expense", 4: "Duplicate transaction id"}
+    assert ids == ["12345:A1", "12345:A2"]
+
+
+def test_ofx_detected_by_content_without_an_extension():
+    raw, _ = read_statement(_upload(OFX), "download")
+    assert raw["Id"].notna().all()
+
+
+def test_reimporting_an_ofx_statement_skips_what_is_stored(store, tmp_path):
+    ids_file = str(tmp_path / "imported_ids.txt")
+    first = import_statement(store, _upload(OFX), "a.ofx", CATEGORIES, ids_file)
+    second = import_statement(store, _upload(OFX), "a.ofx", CATEGORIES, ids_file)
+    assert first.inserted == 2
+    assert second.inserted == 0
+    assert (second.errors["Error"] == "Already imported").sum() == 2
+    assert store.count() == 2
+
+
+def test_csv_with_debit_and_credit_columns(store, tmp_path):
+    csv = ("Posted Date,Debit,Credit,Category\n"
+           "2025-01-02,12.00,,food\n"
+           "2025-01-03,,50.00,Travel\n"
+           "2025-01-04,8.50,,Unknown\n")
+    result = import_statement(store, _upload(csv), "card.csv", CATEGORIES, str(tmp_path / "ids.txt"))
+    assert result.inserted == 2
+    assert result.errors["Error"].tolist() == ["Credit or payment, not an expense"]
+    assert store.load()["Category"].astype(str).tolist() == ["Food", "Other"]
+
+
+def test_csv_where_most_amounts_are_negative_reads_them_as_charges():
+    csv = "Date,Amount\n2025-01-02,-12.00\n2025-01-03,-4.00\n2025-01-04,30.00\n"
+    raw, charges_negative = read_statement(_upload(csv), "bank.csv")
+    expenses, errors, _ = validate_statement(raw, charges_negative, CATEGORIES)
+    assert charges_negative
+    assert expenses["Amount"].tolist() == [12.0, 4.0]
+    assert errors["Row"].tolist() == [3]
+
+
+def test_future_and_unreadable_rows_are_reported():
+    csv = "Date,Amount,Currency\n2999-01-01,5.00,\nnope,5.00,\n2025-01-01,abc,\n2025-01-01,5.00,XYZ\n"
+    raw, charges_negative = read_statement(_upload(csv), "x.csv")
+    expenses, errors, _ = validate_statement(raw, charges_negative, CATEGORIES)
+    assert expenses.empty
+    assert errors["Error"].tolist() == ["Date cannot be in the future", "Unreadable date", "Unreadable amount",
+                                        "Unknown currency"]
@@ -0,0 +1,159 @@
+import hashlib
+import io
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+from file_utils import write_atomic
+from profiling import timed
+from receipt_store import RECEIPT_DIR, is_receipt_ref, load_receipt
+
+# Small JPEG previews of receipt images for the Transactions page, made the
+# first time a receipt is shown and kept on disk under receipts/thumbs. The
+# folder is held under THUMB_CACHE_BYTES by removing the least recently
+# shown previews; a hit refreshes the file's mtime, which stands in for
+# last use. Removed previews are simply made again when next needed, since
+# the full images stay in the receipt store.
+
+THUMB_DIR = os.environ.get("EXPENSE_THUMB_DIR", os.path.join(RECEIPT_DIR, "thumbs"))
+THUMB_SIZE = int(os.environ.get("EXPENSE_THUMB_SIZE", "240"))
+THUMB_CACHE_BYTES = int(float(os.environ.get("EXPENSE_THUMB_CACHE_MB", "64")) * 1024 * 1024)
+THUMB_QUALITY = 80
+
+_lock = threading.Lock()
+# Bytes in THUMB_DIR, counted from the folder on first use and kept up to date after
+_cached_bytes = None
+
+
+def _key(value, size):
+    # Blob references are already content hashes; older rows are a file path
+    # (keyed with its mtime, so a replaced file gets a new preview) or base64 text
+    if is_receipt_ref(value):
+        digest = value.split(":", 1)[1]
+    else:
+        source = value
+        if os.path.exists(value):
+            stat = os.stat(value)
+            source = f"{os.path.abspath(value)}:{stat.st_mtime_ns}:{stat.st_size}"
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    return f"{digest}-{size}.jpg"
+
+
+def thumbnail_path(value, size=THUMB_SIZE):
+    name = _key(value, size)
+    return os.path.join(THUMB_DIR, name[:2], name)
+
+
+def _entries():
+    # (mtime, size, path) for every preview on disk
+    found = []
+    for folder, _, files in os.walk(THUMB_DIR):
+        for name in files:
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((stat.st_mtime_ns, stat.st_size, path))
+    return found
+
+
+def cache_size():
+    global _cached_bytes
+    with _lock:
+        if _cached_bytes is None:
+            _cached_bytes = sum(size for _, size, _ in _entries())
+        return _cached_bytes
+
+
+def evict(limit=THUMB_CACHE_BYTES):
+    """Removes the least recently shown previews until THUMB_DIR holds at
+    most limit bytes, and returns how many were removed."""
+    global _cached_bytes
+    with _lock:
+        entries = sorted(_entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        _cached_bytes = total
+        return removed
+
+
+def _render(data, size):
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG decoding can scale down on the way in, which skips most of the work
+        image.draft("RGB", (size * 2, size * 2))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=THUMB_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+@timed("receipt thumbnail")
+def thumbnail(value, size=THUMB_SIZE):
+    """JPEG preview of a receipt at most size pixels on a side, or None if
+    the receipt is missing or not an image.
+
+    Made from the full image on first use and read from THUMB_DIR after.
+    """
+    global _cached_bytes
+    if not isinstance(value, str) or not value or value == "None":
+        return None
+    path = thumbnail_path(value, size)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except FileNotFoundError:
+        pass
+    receipt = load_receipt(value)
+    if receipt is None:
+        return None
+    try:
+        data = _render(receipt, size)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    # Counted before the new file lands, so the first count doesn't include it twice
+    current = cache_size()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, data)
+    if current + len(data) > THUMB_CACHE_BYTES:
+        # Down to 90% so a full cache isn't swept again on every new preview
+        evict(int(THUMB_CACHE_BYTES * 0.9))
+    else:
+        with _lock:
+            _cached_bytes += len(data)
+    return data
+
+
+def clear_thumbnails():
+    return evict(0)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the receipt preview cache")
+    parser.add_argument("command", choices=["status", "evict", "clear"])
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(f"{len(_entries())} previews, {cache_size() / 1024 / 1024:.1f} of "
+              f"{THUMB_CACHE_BYTES / 1024 / 1024:.0f} MB")
+    elif args.command == "evict":
+        print(f"Removed {evict()} previews")
+    else:
+        print(f"Removed {clear_thumbnails()} previews")